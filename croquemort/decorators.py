@@ -6,14 +6,15 @@ from .tools import data_from_request, flatten_get_parameters
 log = logging.info
 
 
-def required_parameters(*parameters):
+def required_parameters(*parameters, with_request=False):
     """A decorator for views with required parameters.
 
     Returns a 400 if parameters are not provided by the client.
 
     Warning: when applied, it turns the request object into a data one,
     as first parameter of the returned function to avoid parsing the
-    JSON data twice.
+    JSON data twice. The request object is passed as second parameter
+    `with_request` (e.g. to read its headers).
     """
     @wrapt.decorator
     def wrapper(wrapped, instance, args, kwargs):
@@ -31,5 +32,7 @@ def required_parameters(*parameters):
                 return 400, ('Please specify a "{parameter}" parameter.'
                              .format(data=data, parameter=parameter))
         args[0] = data
+        if with_request:
+            args.insert(1, request)
         return wrapped(*args, **kwargs)
     return wrapper
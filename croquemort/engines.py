@@ -0,0 +1,224 @@
+from collections import Counter
+from urllib.parse import urlparse
+
+import collections
+import logging
+import time
+
+import eventlet
+import requests
+from eventlet.queue import LightQueue
+from nameko.constants import DEFAULT_MAX_WORKERS, MAX_WORKERS_CONFIG_KEY
+from nameko.extensions import DependencyProvider
+
+from .metrics import collector
+from .politeness import (
+    DOMAIN_CONCURRENCY, DOMAIN_RATE, MAX_RETRY_AFTER, RETRY_AFTER_ATTEMPTS,
+    DomainScheduler, interleave
+)
+from .sessions import PoolStats, build_session
+
+HEAD_TIMEOUT = 10  # in seconds
+GET_TIMEOUT = 3 * 60  # in seconds
+ENGINE_KEY = 'CRAWLER_ENGINE'
+CONCURRENCY = 500  # in-flight checks per process for the green engine
+
+log = logging.info
+FakeResponse = collections.namedtuple('Response', ['status_code', 'headers',
+                                                   'url', 'history'])
+
+
+def conditional_headers(record):
+    """Return the headers making a re-check conditional on `record`.
+
+    Only successful checks are worth revalidating, through their
+    `etag` and/or `last-modified` stored values.
+    """
+    if not record or record.get('final-status-code', '')[:1] != '2':
+        return {}
+    headers = {}
+    if record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+    if record.get('last-modified'):
+        headers['If-Modified-Since'] = record['last-modified']
+    return headers
+
+
+class CrawlerEngine(DependencyProvider):
+    """Perform the HTTP part of the checks.
+
+    Two engines are available through the `CRAWLER_ENGINE` setting:
+
+    - `sync` (default) checks URLs one after the other, within the worker;
+    - `green` multiplexes up to `CRAWLER_CONCURRENCY` checks per process
+      through a pool of green threads shared by all the workers.
+
+    Whatever the engine, checks go through a `DomainScheduler` limiting
+    the load put on each remote host.
+
+    Re-checks are conditional (`CRAWLER_CONDITIONAL_CHECKS`), relying on
+    the stored `etag` and `last-modified` values of the previous check.
+
+    Connections are kept alive within pools (`CRAWLER_POOL_CONNECTIONS`
+    hosts, `CRAWLER_POOL_MAXSIZE` connections per host), sized by default
+    after the number of checks that may run simultaneously.
+    """
+
+    def setup(self):
+        super(CrawlerEngine, self).setup()
+        config = self.container.config
+        self.head_timeout = config.get('CRAWLER_HEAD_TIMEOUT', HEAD_TIMEOUT)
+        self.get_timeout = config.get('CRAWLER_GET_TIMEOUT', GET_TIMEOUT)
+        self.no_head_domains = config.get('HEAD_DOMAINS_BLACKLIST', [])
+        self.conditional = config.get('CRAWLER_CONDITIONAL_CHECKS', True)
+        self.domain_metrics = config.get('METRICS_PER_DOMAIN', False)
+        # Counts conditional checks and those answered as not modified.
+        self.check_stats = Counter()
+        self.retry_after_attempts = config.get(
+            'CRAWLER_RETRY_AFTER_ATTEMPTS', RETRY_AFTER_ATTEMPTS)
+        domain_concurrency = config.get('CRAWLER_DOMAIN_CONCURRENCY',
+                                        DOMAIN_CONCURRENCY)
+        self.scheduler = DomainScheduler(
+            concurrency=domain_concurrency,
+            rate=config.get('CRAWLER_DOMAIN_RATE', DOMAIN_RATE),
+            max_retry_after=config.get('CRAWLER_MAX_RETRY_AFTER',
+                                       MAX_RETRY_AFTER))
+        engine = config.get(ENGINE_KEY, 'sync')
+        if engine == 'sync':
+            concurrency = config.get(MAX_WORKERS_CONFIG_KEY,
+                                     DEFAULT_MAX_WORKERS)
+            self.pool = None
+        elif engine == 'green':
+            concurrency = config.get('CRAWLER_CONCURRENCY', CONCURRENCY)
+            self.pool = eventlet.GreenPool(concurrency)
+        else:
+            raise ValueError('Unknown {key} "{engine}"'.format(
+                key=ENGINE_KEY, engine=engine))
+        self.pool_stats = PoolStats()
+        self.session = build_session(
+            pool_connections=config.get('CRAWLER_POOL_CONNECTIONS',
+                                        concurrency),
+            pool_maxsize=config.get('CRAWLER_POOL_MAXSIZE',
+                                    min(domain_concurrency, concurrency)),
+            stats=self.pool_stats)
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def fetch(self, url, previous=None):
+        """Return the response for `url` (`None` on unexpected errors)
+        and the latency of the check in seconds.
+
+        The check is conditional if the `previous` record allows it.
+        It is retried if the remote asks for it through a `Retry-After`
+        header on a 429 or 503 response, the latency being the one of
+        the last attempt.
+        """
+        domain = urlparse(url).netloc
+        headers = conditional_headers(previous) if self.conditional else {}
+        if headers:
+            self.check_stats['conditional'] += 1
+        for _ in range(self.retry_after_attempts + 1):
+            with self.scheduler.slot(domain):
+                start = time.perf_counter()
+                response = self._fetch(url, domain, headers)
+                latency = time.perf_counter() - start
+            if not self.scheduler.backoff(domain, response):
+                break
+        if response is not None and response.status_code == 304:
+            self.check_stats['not-modified'] += 1
+        outcome = ('error' if response is None
+                   else '{}xx'.format(response.status_code // 100))
+        collector.inc('croquemort_checks_total', outcome=outcome)
+        if self.domain_metrics:
+            collector.observe('croquemort_domain_check_seconds', latency,
+                              buckets=None, domain=domain)
+        return response, latency
+
+    def _fetch(self, url, domain, headers):
+        """Return the response for `url`, `None` on unexpected errors.
+
+        A HEAD request is issued first, falling back to a (streamed) GET
+        for servers not dealing properly with HEAD.
+        """
+        try:
+            head_offend = domain in self.no_head_domains
+            if not head_offend:
+                start = time.perf_counter()
+                try:
+                    response = self.session.head(
+                        url, allow_redirects=True, headers=headers,
+                        timeout=self.head_timeout)
+                except requests.exceptions.ReadTimeout:
+                    # simulate 404 to trigger GET request below
+                    log('Timeout on %s', url)
+                    collector.inc('croquemort_timeouts_total', method='HEAD')
+                    response = FakeResponse(status_code=404, headers={},
+                                            url=url, history=[])
+                collector.observe('croquemort_requests_seconds',
+                                  time.perf_counter() - start, method='HEAD')
+            # Double check for servers not dealing properly with HEAD.
+            if head_offend or response.status_code in (404, 405):
+                log('Checking {url} with a GET'.format(url=url))
+                if not head_offend:
+                    collector.inc('croquemort_get_fallbacks_total')
+                start = time.perf_counter()
+                try:
+                    response = self.session.get(url, allow_redirects=True,
+                                                headers=headers,
+                                                timeout=self.get_timeout,
+                                                stream=True)
+                except requests.exceptions.ReadTimeout:
+                    collector.inc('croquemort_timeouts_total', method='GET')
+                    raise
+                finally:
+                    collector.observe('croquemort_requests_seconds',
+                                      time.perf_counter() - start,
+                                      method='GET')
+                response.close()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ReadTimeout):
+            response = FakeResponse(status_code=503, headers={}, url=url,
+                                    history=[])
+        except Exception as e:
+            logging.error('Error with {url}: {e}'.format(url=url, e=e))
+            return
+        return response
+
+    def _check(self, url, previous=None):
+        """Return the `(url, response, latency)` of a check, whatever
+        happens: a batch waits for the results of all its URLs.
+        """
+        try:
+            return (url, *self.fetch(url, previous))
+        except Exception as e:
+            logging.error('Error with {url}: {e}'.format(url=url, e=e))
+            return url, None, None
+
+    def fetch_many(self, urls, previous_records=None):
+        """Yield `(url, response, latency)` tuples as checks complete.
+
+        URLs are interleaved across domains so that a batch targeting
+        a few hosts does not wait on a single one of them.
+        `previous_records` maps URLs to their records, if any.
+        """
+        urls = list(interleave(urls))
+        previous_records = previous_records or {}
+        if self.pool is None:
+            for url in urls:
+                yield self._check(url, previous_records.get(url))
+            return
+
+        results = LightQueue()
+
+        def check(url):
+            results.put(self._check(url, previous_records.get(url)))
+
+        def feed():
+            # Blocks when the pool is full, hence the dedicated green thread.
+            for url in urls:
+                self.pool.spawn_n(check, url)
+
+        eventlet.spawn_n(feed)
+        for _ in urls:
+            yield results.get()
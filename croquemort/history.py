@@ -0,0 +1,49 @@
+"""Compact encoding of the checks history of a URL.
+
+Each check is packed as a fixed size binary entry (18 bytes): the
+timestamp, the final status code, the latency in milliseconds and
+the content length, unknown values being stored as `-1`. Entries are
+appended to a single Redis string per URL, trimmed to the most recent
+ones from time to time.
+"""
+from datetime import datetime
+
+import struct
+
+HISTORY_SIZE = 100  # entries kept per URL, 0 to disable
+HISTORY_TTL = 60 * 60 * 24 * 90  # in seconds, since the latest check
+ENTRY = struct.Struct('>Ihiq')
+
+
+def history_key(url_hash):
+    return '{url_hash}-history'.format(url_hash=url_hash)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+def pack_entry(timestamp, status_code, latency=None, content_length=None):
+    """Return the binary entry of a check, `latency` being in seconds."""
+    latency = -1 if latency is None else int(latency * 1000)
+    return ENTRY.pack(int(timestamp), _to_int(status_code), latency,
+                      _to_int(content_length))
+
+
+def unpack_entries(data):
+    """Return the list of checks (as dicts) encoded within `data`."""
+    entries = []
+    # Ignore any partial entry, from the oldest end.
+    for offset in range(len(data) % ENTRY.size, len(data), ENTRY.size):
+        timestamp, status_code, latency, content_length = (
+            ENTRY.unpack_from(data, offset))
+        entries.append({
+            'updated': datetime.fromtimestamp(timestamp).isoformat(),
+            'final-status-code': None if status_code < 0 else status_code,
+            'latency': None if latency < 0 else latency,
+            'content-length': None if content_length < 0 else content_length,
+        })
+    return entries
@@ -1,18 +1,36 @@
 import json
+from collections import OrderedDict
+from itertools import chain
 
 import logging
+import time
 import validators
+from nameko.dependency_providers import Config
 from nameko.events import EventDispatcher
 from nameko.rpc import rpc
 from nameko.web.handlers import http
+from werkzeug.wrappers import Response
 
 from .decorators import required_parameters
 from .logger import LoggingDependency
-from .reports import compute_csv
-from .storages import RedisStorage
-from .tools import apply_filters, extract_filters, generate_hash_for
+from .metrics import Metrics
+from .reports import (
+    CSV_CHUNK_SIZE, compute_csv, compute_group, csv_response
+)
+from .storages import INDEXED_FIELDS, URLS_REGISTRY, RedisStorage
+from .tools import (
+    CHECK_BATCH_SIZE, accepts_encoding, chunked, extract_filters,
+    extract_pagination, generate_etag, generate_hash_for, has_current_copy
+)
 
 log = logging.info
+CACHE_TTL = 300  # in seconds, for cached group responses
+CACHE_MAX_SIZE = 1024 * 1024  # in characters, for a cached response
+
+
+def cache_headers(etag):
+    # Clients should revalidate their copy before each use.
+    return {'ETag': '"{etag}"'.format(etag=etag), 'Cache-Control': 'no-cache'}
 
 
 class HttpService(object):
@@ -20,53 +38,199 @@ class HttpService(object):
     dispatch = EventDispatcher()
     storage = RedisStorage()
     logger = LoggingDependency(interval='ms')
+    config = Config()
+    metrics = Metrics()
+
+    def _resolve_filters(self, data):
+        """Return the index selection and the filters left to apply.
+
+        The selection is `None` if no filter targets an indexed field.
+        """
+        filters, excludes = extract_filters(data)
+        if not any(field in INDEXED_FIELDS
+                   for field in chain(filters, excludes)):
+            return None, filters, excludes
+        return self.storage.resolve_filters(filters, excludes)
 
     @http('GET', '/url')
-    @required_parameters('url')
-    def retrieve_url(self, data):
+    @required_parameters('url', with_request=True)
+    def retrieve_url(self, data, request):
         url = data.get('url')
         group = data.get('group')
         log('Retrieving url {url} for group {group}'.format(
             url=url, group=group))
         self.fetch(url, group)  # Try again for later check.
-        return self.retrieve_url_from_hash(data, generate_hash_for('url', url))
+        return self.retrieve_url_from_hash(request,
+                                           generate_hash_for('url', url))
 
     @http('GET', '/url/<url_hash>')
     def retrieve_url_from_hash(self, request_or_data, url_hash):
+        """Return the record of `url_hash`, with an `ETag` header.
+
+        A 304 is returned if the client has the current version.
+        """
         log('Retrieving url hash {hash}'.format(hash=url_hash))
         url_infos = self.storage.get_url(url_hash)
         if not url_infos:
             return 404, ''
+        content = json.dumps(url_infos, indent=2)
+        etag = generate_etag(content)
+        if has_current_copy(request_or_data, etag):
+            return 304, cache_headers(etag), ''
         log('Grabing {infos}'.format(infos=url_infos))
-        return json.dumps(url_infos, indent=2)
+        return 200, cache_headers(etag), content
+
+    @http('GET', '/history')
+    @required_parameters('url')
+    def retrieve_history(self, data):
+        url = data.get('url')
+        log('Retrieving history of url {url}'.format(url=url))
+        return self.retrieve_history_from_hash(data,
+                                               generate_hash_for('url', url))
+
+    @http('GET', '/history/<url_hash>')
+    def retrieve_history_from_hash(self, request_or_data, url_hash):
+        log('Retrieving history of url hash {hash}'.format(hash=url_hash))
+        history = self.storage.get_history(url_hash)
+        if not history:
+            return 404, ''
+        return json.dumps({'url-hash': url_hash, 'history': history},
+                          indent=2)
 
     @http('GET', '/group')
-    @required_parameters('group')
-    def retrieve_group(self, data):
+    @required_parameters('group', with_request=True)
+    def retrieve_group(self, data, request):
         group = data.get('group')
         log('Retrieving group {group}'.format(group=group))
-        return self.retrieve_group_from_hash(data,
-                                             generate_hash_for('group', group))
+        return self.retrieve_group_from_hash(
+            request, generate_hash_for('group', group))
 
     @http('GET', '/group/<group_hash>')
-    @required_parameters()
-    def retrieve_group_from_hash(self, data, group_hash):
+    @required_parameters(with_request=True)
+    def retrieve_group_from_hash(self, data, request, group_hash):
+        """Return the records of the group, with an `ETag` header.
+
+        The entity tag derives from the version of the group, increased
+        on each write of its URLs, and from the parameters. A 304 is
+        returned if the client has the current version, otherwise the
+        response may be served from a cache (unless paginated).
+        The version of a group is only increased by the checks of its
+        URLs made for this group: to bound the staleness of URLs shared
+        by many groups, tags also change every `HTTP_CACHE_TTL` seconds.
+        With a `stale_by` bound, a snapshot of the group is served
+        instead (see `_group_snapshot`).
+        """
         log('Retrieving group hash {hash}'.format(hash=group_hash))
-        group_infos = self.storage.get_group(group_hash)
-        if not group_infos:
-            return 404, ''
-        group_infos.pop('url')
-        infos = {'name': group_infos.pop('name')}
-        filters, excludes = extract_filters(data)
-        urls_infos = []
-        for url_hash, url in group_infos.items():
-            url_infos = self.storage.get_url(url_hash)
-            results = apply_filters(url_infos, filters, excludes)
-            if results:
-                urls_infos.append(results)
-        infos['urls'] = urls_infos
-        log('Returning {num} results'.format(num=len(infos['urls'])))
-        return json.dumps(infos, indent=2)
+        try:
+            limit, cursor = extract_pagination(data)
+        except ValueError as error:
+            return 400, 'Incorrect pagination: {error}'.format(error=error)
+        try:
+            stale_by = int(data.get('stale_by',
+                                    self.config.get('GROUP_STALE_BY', 0)))
+        except ValueError as error:
+            return 400, 'Incorrect stale_by: {error}'.format(error=error)
+        ttl = self.config.get('HTTP_CACHE_TTL', CACHE_TTL)
+        etag = generate_etag(group_hash,
+                             self.storage.get_group_version(group_hash),
+                             int(time.time() // ttl) if ttl else 0, data)
+        if has_current_copy(request, etag):
+            return 304, cache_headers(etag), ''
+        if stale_by and not limit:
+            return self._group_snapshot(data, group_hash, stale_by)
+        key = '{group_hash}-response-{etag}'.format(group_hash=group_hash,
+                                                    etag=etag)
+        cacheable = ttl and not limit
+        if cacheable:
+            cached = self.storage.get_cache(key)
+            if cached:
+                return 200, cache_headers(etag), cached['content']
+        response = self._compute_group(data, group_hash, limit, cursor)
+        if not isinstance(response, Response):
+            return response
+        response.headers.extend(cache_headers(etag))
+        if cacheable:
+            response.response = self._caching(key, response.response, ttl)
+        return response
+
+    def _group_snapshot(self, data, group_hash, stale_by):
+        """Serve a snapshot of the group at most `stale_by` seconds old.
+
+        The snapshot is built while serving the group if there is no
+        recent enough one for these filters. It may be older than the
+        current version of the group, hence no entity tag.
+        """
+        key = self._snapshot_key(data, group_hash)
+        timestamp, chunks = self.storage.get_snapshot(key)
+        if timestamp is not None:
+            age = max(time.time() - timestamp, 0)
+            if age <= stale_by:
+                return Response(chunks, headers={'Age': str(int(age))})
+        response = self._compute_group(data, group_hash, None, None)
+        if not isinstance(response, Response):
+            return response
+        response.headers.set('Age', '0')
+        response.response = self._snapshotting(key, response.response,
+                                               stale_by)
+        return response
+
+    def _compute_group(self, data, group_hash, limit, cursor):
+        selection, filters, excludes = self._resolve_filters(data)
+        if limit:
+            name = self.storage.get_group_name(group_hash)
+            if name is None:
+                return 404, ''
+            next_cursor, url_hashes = self.storage.scan_group(
+                group_hash, cursor, limit)
+        else:
+            next_cursor = None
+            group_infos = self.storage.get_group(group_hash)
+            if not group_infos:
+                return 404, ''
+            group_infos.pop('url')
+            name = group_infos.pop('name')
+            url_hashes = group_infos.keys()
+        log('Returning up to {num} results'.format(num=len(url_hashes)))
+        if selection:
+            url_hashes = selection.apply(url_hashes)
+        urls = self.storage.get_urls(url_hashes)
+        return compute_group(name, urls, filters, excludes, next_cursor)
+
+    def _caching(self, key, chunks, ttl):
+        """Stream `chunks` then cache them under `key` for `ttl` seconds.
+
+        Responses larger than `HTTP_CACHE_MAX_SIZE` are not cached.
+        """
+        max_size = self.config.get('HTTP_CACHE_MAX_SIZE', CACHE_MAX_SIZE)
+        content, size = [], 0
+        for chunk in chunks:
+            if content is not None:
+                size += len(chunk)
+                if size > max_size:
+                    content = None
+                else:
+                    content.append(chunk)
+            yield chunk
+        if content is not None:
+            self.storage.set_cache(key, ''.join(content), ttl)
+
+    @http('GET', '/stats')
+    @required_parameters()
+    def stats(self, data):
+        """Return the counts of checked URLs by status and content type.
+
+        For all URLs, or those of a `group` or a `domain`.
+        """
+        if data.get('group'):
+            scope = ('group', generate_hash_for('group', data['group']))
+        elif data.get('domain'):
+            scope = ('domain', data['domain'])
+        else:
+            scope = ()
+        log('Statistics for {scope}'.format(scope=scope or 'all URLs'))
+        stats = self.storage.get_stats(*scope)
+        stats['urls'] = sum(stats['final-status-code'].values())
+        return json.dumps(stats, indent=2, sort_keys=True)
 
     @http('GET', '/robots.txt')
     def robots_txt(self, data):
@@ -74,16 +238,124 @@ class HttpService(object):
         content = ['User-agent: *', 'Disallow: /']
         return '\n'.join(content)
 
-    # No cache here given the response is streamed.
+    @http('GET', '/metrics')
+    def metrics_report(self, request):
+        log('Metrics report')
+        self.metrics.flush()
+        return Response(self.metrics.render(),
+                        content_type='text/plain; version=0.0.4')
+
     @http('GET', '/csv')
-    @required_parameters()
-    def csv_report(self, data):
+    def csv_report(self, request):
         log('CSV report')
-        all_urls = self.storage.get_all_urls()
-        if not all_urls:
-            return 404, ''
-        filters, excludes = extract_filters(data)
-        return compute_csv(all_urls, filters, excludes)
+        gzipped = (self.config.get('CSV_GZIP', True)
+                   and accepts_encoding(request, 'gzip'))
+        return self._csv_report(request, gzipped)
+
+    @required_parameters()
+    def _csv_report(self, data, gzipped):
+        """Serve the lines of the report, maintained on each check.
+
+        Whole records are only read to apply filters on fields which
+        are not indexed.
+        """
+        try:
+            limit, cursor = extract_pagination(data)
+        except ValueError as error:
+            return 400, 'Incorrect pagination: {error}'.format(error=error)
+        try:
+            stale_by = int(data.get('stale_by',
+                                    self.config.get('CSV_STALE_BY', 0)))
+        except ValueError as error:
+            return 400, 'Incorrect stale_by: {error}'.format(error=error)
+        selection, filters, excludes = self._resolve_filters(data)
+        if limit:
+            next_cursor, url_hashes = self.storage.scan_registry(
+                URLS_REGISTRY, cursor, limit)
+            if selection:
+                url_hashes = selection.apply(url_hashes)
+            if filters or excludes:
+                urls = self.storage.get_urls(url_hashes)
+                return self._compute_csv(urls, filters, excludes, gzipped,
+                                         next_cursor)
+            return self._csv_response(
+                self.storage.get_report_rows(url_hashes), gzipped,
+                next_cursor=next_cursor)
+        if selection:
+            # Only fetch the records matching the indexes.
+            if selection.candidates is not None:
+                url_hashes = selection.apply(selection.candidates)
+            else:
+                url_hashes = selection.apply(
+                    self.storage.iter_registry(URLS_REGISTRY))
+            if filters or excludes:
+                urls = self.storage.get_urls(url_hashes)
+                return self._compute_csv(urls, filters, excludes, gzipped)
+            rows = self.storage.get_report_rows(url_hashes)
+        elif filters or excludes:
+            all_urls = self.storage.get_all_urls()
+            return self._compute_csv(all_urls, filters, excludes, gzipped)
+        else:
+            rows = self.storage.iter_report()
+        if stale_by:
+            return self._csv_snapshot(data, rows, stale_by, gzipped)
+        return self._csv_response(rows, gzipped)
+
+    def _csv_snapshot(self, data, rows, stale_by, gzipped):
+        """Serve a snapshot of the `rows` at most `stale_by` seconds old.
+
+        The snapshot is built while serving the `rows` if there is no
+        recent enough one for these filters.
+        """
+        key = self._snapshot_key(data)
+        timestamp, chunks = self.storage.get_snapshot(key)
+        if timestamp is not None:
+            age = max(time.time() - timestamp, 0)
+            if age <= stale_by:
+                return self._csv_response(chunks, gzipped, age=age)
+        return self._csv_response(self._snapshotting(key, rows, stale_by),
+                                  gzipped, age=0)
+
+    def _snapshot_key(self, data, *scope):
+        """Return the key of the snapshot of `scope` for these filters."""
+        return generate_hash_for('snapshot', json.dumps(list(scope) + sorted(
+            (param, value) for param, value in data.items()
+            if param.startswith(('filter_', 'exclude_')))))
+
+    def _snapshotting(self, key, chunks, stale_by):
+        """Stream `chunks` then publish them as the snapshot `key`.
+
+        The snapshot is stored by chunks of `CSV_CHUNK_SIZE` characters
+        while streaming, and served for `stale_by` seconds.
+        """
+        timestamp = time.time()
+        chunk_size = self.config.get('CSV_CHUNK_SIZE', CSV_CHUNK_SIZE)
+        content, size = [], 0
+        for chunk in chunks:
+            content.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                self.storage.append_snapshot(key, timestamp, ''.join(content),
+                                             stale_by)
+                content, size = [], 0
+            yield chunk
+        if content:
+            self.storage.append_snapshot(key, timestamp, ''.join(content),
+                                         stale_by)
+        self.storage.publish_snapshot(key, timestamp, stale_by)
+
+    def _compute_csv(self, urls, filters, excludes, gzipped,
+                     next_cursor=None):
+        return compute_csv(urls, filters, excludes, next_cursor,
+                           chunk_size=self.config.get('CSV_CHUNK_SIZE',
+                                                      CSV_CHUNK_SIZE),
+                           gzipped=gzipped)
+
+    def _csv_response(self, lines, gzipped, next_cursor=None, age=None):
+        return csv_response(lines, next_cursor,
+                            chunk_size=self.config.get('CSV_CHUNK_SIZE',
+                                                       CSV_CHUNK_SIZE),
+                            gzipped=gzipped, age=age)
 
     @http('POST', '/check/one')
     @required_parameters('url')
@@ -100,7 +372,8 @@ class HttpService(object):
     @http('POST', '/check/many')
     @required_parameters('urls', 'group')
     def check_many(self, data):
-        urls = data.get('urls')
+        # Deduplicate while keeping the submitted order.
+        urls = list(OrderedDict.fromkeys(data.get('urls')))
         group = data.get('group')
         group_hash = generate_hash_for('group', group)
         frequency = data.get('frequency')
@@ -109,8 +382,18 @@ class HttpService(object):
              'with frequency "{frequency}"'.format(num=len(urls), group=group,
                                                    hash=group_hash,
                                                    frequency=frequency)))
-        for url in urls:
-            self.fetch(url, group, frequency, callback_url)
+        if callback_url and not validators.url(callback_url):
+            logging.warning('callback_url is not an url %s' % callback_url)
+            callback_url = None
+        batch_size = self.config.get('CHECK_BATCH_SIZE', CHECK_BATCH_SIZE)
+        for batch in chunked(urls, batch_size):
+            # Same as `fetch` but for a whole batch within a few round trips.
+            if callback_url:
+                self.storage.store_webhooks(batch, callback_url)
+            to_check = self.storage.acquire_check_flags(batch)
+            if to_check:
+                self.dispatch('urls_to_check', [(url, group, frequency)
+                                                for url in to_check])
         return json.dumps({'group-hash': group_hash}, indent=2)
 
     @rpc
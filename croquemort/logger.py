@@ -24,10 +24,11 @@ class LoggingDependency(DependencyProvider):
         status = 'completed' if exc_info is None else 'errored'
         now = datetime.datetime.now()
         worker_started = self.timestamps.pop(worker_ctx)
+        elapsed = (now - worker_started).total_seconds()
         if self.interval == 's':
-            duration = (now - worker_started).seconds
+            duration = round(elapsed, 3)
         elif self.interval == 'ms':
-            duration = (now - worker_started).microseconds
+            duration = int(elapsed * 1000)
         msg = ('Worker {service}.{method} {status} after {duration}{interval}'
                .format(service=service_name, method=method_name, status=status,
                        duration=duration, interval=self.interval))
@@ -0,0 +1,188 @@
+"""Counters and histograms exposed in the Prometheus text format.
+
+Metrics are recorded within each process by the `collector` then
+flushed to Redis by the `Metrics` dependency, so that the `/metrics`
+endpoint of the `http_server` service aggregates all processes.
+"""
+from collections import Counter
+from weakref import WeakKeyDictionary
+
+import logging
+import re
+import time
+
+import redis
+from nameko.extensions import DependencyProvider
+
+from .storages import REDIS_DEFAULT_URI, REDIS_URI_KEY
+
+METRICS_KEY = 'metrics'
+FLUSH_INTERVAL = 5  # in seconds
+DEFAULT_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 180,
+                   float('inf'))
+# name: (type, description)
+METRICS = {
+    'croquemort_worker_seconds': (
+        'histogram', 'Duration of the workers, by service and method.'),
+    'croquemort_checks_total': (
+        'counter', 'Checks by outcome (status class or error).'),
+    'croquemort_requests_seconds': (
+        'histogram', 'Latency of the HEAD and GET requests of the checks.'),
+    'croquemort_get_fallbacks_total': (
+        'counter', 'Checks falling back from a HEAD to a GET request.'),
+    'croquemort_timeouts_total': (
+        'counter', 'Requests of the checks timing out, by method.'),
+    'croquemort_domain_check_seconds': (
+        'summary', 'Latency of the checks, by domain.'),
+    'croquemort_webhooks_total': (
+        'counter', 'Webhook calls by outcome.'),
+    'croquemort_webhook_seconds': (
+        'histogram', 'Latency of the webhook calls.'),
+}
+SUFFIXES = ('_bucket', '_sum', '_count')
+LE_PATTERN = re.compile(r'le="([^"]+)"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def series_key(name, **labels):
+    """Return the Prometheus notation of a series, labels being sorted."""
+    if not labels:
+        return name
+    escaped = (
+        (key, str(value).replace('\\', r'\\').replace('"', r'\"')
+                        .replace('\n', r'\n'))
+        for key, value in sorted(labels.items()))
+    return '{name}{{{labels}}}'.format(name=name, labels=','.join(
+        '{key}="{value}"'.format(key=key, value=value)
+        for key, value in escaped))
+
+
+class Collector(object):
+    """Accumulate metrics within a process until they are flushed."""
+
+    def __init__(self):
+        self.pending = Counter()
+
+    def inc(self, name, value=1, **labels):
+        self.pending[series_key(name, **labels)] += value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """Record `value` within a histogram, or a summary without
+        `buckets` (only its sum and count).
+        """
+        for bucket in buckets or ():
+            # Empty buckets are registered too, for the sake of exports.
+            self.pending[series_key(name + '_bucket',
+                                    le=_format_value(bucket),
+                                    **labels)] += int(value <= bucket)
+        self.pending[series_key(name + '_sum', **labels)] += value
+        self.pending[series_key(name + '_count', **labels)] += 1
+
+    def pop(self):
+        """Return the pending values and reset them."""
+        pending, self.pending = self.pending, Counter()
+        return pending
+
+
+collector = Collector()
+
+
+def _family(key):
+    name = key.split('{', 1)[0]
+    if name not in METRICS:
+        for suffix in SUFFIXES:
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(key):
+    # Buckets are sorted by their upper bound within a series.
+    match = LE_PATTERN.search(key)
+    le = float(match.group(1).replace('+Inf', 'inf')) if match else 0
+    return _family(key), LE_PATTERN.sub('', key), le
+
+
+def render(values):
+    """Return the Prometheus text format of `values` (series: value)."""
+    lines = []
+    family = None
+    for key in sorted(values, key=_sort_key):
+        if _family(key) != family:
+            family = _family(key)
+            if family in METRICS:
+                kind, description = METRICS[family]
+                lines.append('# HELP {name} {description}'.format(
+                    name=family, description=description))
+                lines.append('# TYPE {name} {kind}'.format(
+                    name=family, kind=kind))
+        lines.append('{key} {value}'.format(
+            key=key, value=_format_value(values[key])))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics(DependencyProvider):
+    """Time the workers of a service and flush the metrics to Redis.
+
+    Pending metrics of the process are flushed at the end of a worker,
+    at most every `METRICS_FLUSH_INTERVAL` seconds.
+    """
+
+    def __init__(self):
+        self.timestamps = WeakKeyDictionary()
+
+    def setup(self):
+        super(Metrics, self).setup()
+        config = self.container.config
+        self.database = redis.StrictRedis.from_url(
+            config.get(REDIS_URI_KEY, REDIS_DEFAULT_URI),
+            decode_responses=True, charset='utf-8')
+        self.flush_interval = config.get('METRICS_FLUSH_INTERVAL',
+                                         FLUSH_INTERVAL)
+        self.last_flush = time.time()
+
+    def stop(self):
+        self.flush()
+        super(Metrics, self).stop()
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def worker_setup(self, worker_ctx):
+        self.timestamps[worker_ctx] = time.perf_counter()
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        started = self.timestamps.pop(worker_ctx, None)
+        if started is not None:
+            collector.observe('croquemort_worker_seconds',
+                              time.perf_counter() - started,
+                              service=worker_ctx.service_name,
+                              method=worker_ctx.entrypoint.method_name,
+                              status='completed' if exc_info is None
+                              else 'errored')
+        if time.time() - self.last_flush >= self.flush_interval:
+            try:
+                self.flush()
+            except redis.RedisError as e:
+                logging.error('Error flushing metrics: {e}'.format(e=e))
+
+    def flush(self):
+        """Add the pending metrics of the process to the Redis ones."""
+        self.last_flush = time.time()
+        pending = collector.pop()
+        if not pending:
+            return
+        pipe = self.database.pipeline(transaction=False)
+        for key, value in pending.items():
+            pipe.hincrbyfloat(METRICS_KEY, key, value)
+        pipe.execute()
+
+    def render(self):
+        """Return the aggregated metrics in the Prometheus text format."""
+        return render(self.database.hgetall(METRICS_KEY))
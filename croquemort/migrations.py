@@ -1,11 +1,16 @@
+from collections import Counter, defaultdict
 from urllib.parse import urlparse
 
 import logging
+import time
 from nameko.rpc import rpc
 
 from .logger import LoggingDependency
-from .storages import RedisStorage
-from .tools import HASH_PREFIXES
+from .storages import (
+    FREQUENCIES, FREQUENCY_INTERVALS, REGISTRY_PAGE_SIZE, URLS_REGISTRY,
+    RedisStorage, frequency_registry, stats_counts
+)
+from .tools import HASH_PREFIXES, chunked
 
 log = logging.info
 
@@ -148,7 +153,7 @@ class MigrationsService(object):
                     log('Missing status for hash %s (%s)' % (url_hash, data))
             else:
                 log('No url for hash %s (%s) - deleting' % (url_hash, data))
-                database.lrem('urls', 0, url_hash)
+                database.zrem(URLS_REGISTRY, url_hash)
                 database.delete(url_hash)
 
         log('Url schema migration done.')
@@ -159,8 +164,131 @@ class MigrationsService(object):
         [migration from 1.0.0 to 2.0.0]
 
         Helper to call all migrations needed from v1 to v2.
+
+        Lists are converted to registries once prefixed, URLs being then
+        read from the registry.
         """
         log('Migrating from 1 to 2...')
         self.add_hash_prefixes()
+        self.migrate_lists_to_registries()
         self.migrate_urls_redirect()
         log('Migrations from 1 to 2 done.')
+
+    def _migrate_list_to_registry(self, key, registry):
+        """Used by `migrate_lists_to_registries` to convert a list"""
+        database = self.storage.database
+        if database.type(key) != 'list':
+            return
+        log('Converting list {} to registry {}'.format(key, registry))
+        now = time.time()
+        length = database.llen(key)
+        for start in range(0, length, REGISTRY_PAGE_SIZE):
+            end = start + REGISTRY_PAGE_SIZE - 1
+            members = database.lrange(key, start, end)
+            # Keep the original ordering through slightly increasing scores.
+            database.zadd(registry, {member: now + (start + idx) / length
+                                     for idx, member in enumerate(members)},
+                          nx=True)
+        database.delete(key)
+
+    @rpc
+    def migrate_lists_to_registries(self):
+        """
+        [migration from 2.x to 3.0.0]
+
+        Convert the `urls` and `<frequency>` lists to sorted set registries:
+        - /urls[<u:uhash>] -> /urls-registry{<u:uhash>}
+        - /<frequency>[<g:ghash>] -> /<frequency>-registry{<g:ghash>}
+
+        NB: should be idempotent
+        """
+        log('Migrating lists to registries...')
+        self._migrate_list_to_registry('urls', URLS_REGISTRY)
+        for freq in FREQUENCIES:
+            self._migrate_list_to_registry(freq, frequency_registry(freq))
+        log('Lists migrated to registries.')
+
+    @rpc
+    def build_indexes(self):
+        """
+        [migration from 2.x to 3.0.0]
+
+        Index existing URLs by final status code, content type and domain,
+        indexes are then maintained by the storage on each check.
+
+        NB: should be idempotent
+        """
+        log('Building indexes...')
+        url_hashes = self.storage.iter_registry(URLS_REGISTRY)
+        for url_hash, data in self.storage.get_urls(url_hashes):
+            self.storage.store_indexes(url_hash, data)
+        log('Indexes built.')
+
+    @rpc
+    def schedule_frequencies(self):
+        """
+        [migration from 2.x to 3.0.0]
+
+        Register URLs of groups with a frequency within the rolling schedule,
+        URLs with many frequencies being checked at the highest one.
+
+        NB: should be idempotent
+        """
+        log('Scheduling frequencies...')
+        for freq in FREQUENCIES:
+            # URLs of higher frequencies are skipped.
+            for url in self.storage.get_frequency_urls(frequency=freq):
+                self.storage.schedule_url(url, FREQUENCY_INTERVALS[freq])
+        log('Frequencies scheduled.')
+
+    @rpc
+    def build_report(self):
+        """
+        [migration from 2.x to 3.0.0]
+
+        Write the CSV report lines of the checked URLs, lines are then
+        maintained by the storage on each check.
+
+        NB: should be idempotent
+        """
+        log('Building report...')
+        for records in chunked(self.storage.get_all_urls(),
+                               REGISTRY_PAGE_SIZE):
+            self.storage.store_report_rows(records)
+        log('Report built.')
+
+    @rpc
+    def build_stats(self):
+        """
+        [migration from 2.x to 3.0.0]
+
+        Count the checked URLs by status and content type, for all of them,
+        per group and per domain, counters are then maintained by the
+        storage on each check.
+
+        NB: should be idempotent
+        """
+        log('Building statistics...')
+        counters = defaultdict(Counter)
+        for url_hash, data in self.storage.get_all_urls():
+            if data.get('checked-url'):
+                for key, field in stats_counts(data['checked-url'], data):
+                    counters[key][field] += 1
+        self.storage.replace_stats(counters)
+        log('Statistics built.')
+
+    @rpc
+    def encode_records(self):
+        """
+        [migration from 2.x to 3.0.0]
+
+        Rewrite the URL records in the format set by `COMPACT_RECORDS`,
+        e.g. once compact records are switched on (or off).
+
+        NB: should be idempotent
+        """
+        log('Encoding records...')
+        for records in chunked(self.storage.get_all_urls(),
+                               REGISTRY_PAGE_SIZE):
+            self.storage.rewrite_records(records)
+        log('Records encoded.')
@@ -0,0 +1,127 @@
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import logging
+import time
+
+import eventlet
+from eventlet.semaphore import Semaphore
+
+DOMAIN_CONCURRENCY = 10  # simultaneous checks per domain
+DOMAIN_RATE = 10  # checks per second and per domain, 0 to disable
+MAX_RETRY_AFTER = 60  # in seconds
+RETRY_AFTER_ATTEMPTS = 1
+RETRY_AFTER_STATUSES = (429, 503)
+
+log = logging.info
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds from a `Retry-After` header value.
+
+    The value is either a number of seconds or an HTTP date,
+    `None` is returned if it cannot be parsed.
+    """
+    if not value:
+        return
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def interleave(urls):
+    """Reorder `urls` in a round-robin fashion across their domains."""
+    domains = OrderedDict()
+    for url in urls:
+        domains.setdefault(urlparse(url).netloc, []).append(url)
+    queues = [iter(domain_urls) for domain_urls in domains.values()]
+    while queues:
+        for queue in list(queues):
+            try:
+                yield next(queue)
+            except StopIteration:
+                queues.remove(queue)
+
+
+class DomainScheduler(object):
+    """Bound the load put on each remote host, keyed by `netloc`.
+
+    Limits are per process: the number of simultaneous checks for a
+    given domain, the rate of checks for that domain and a delay
+    requested by the remote through a `Retry-After` header.
+    Idle domains are forgotten once their next slot has passed.
+    """
+
+    def __init__(self, concurrency=DOMAIN_CONCURRENCY, rate=DOMAIN_RATE,
+                 max_retry_after=MAX_RETRY_AFTER):
+        self.concurrency = concurrency
+        self.interval = 1 / rate if rate else 0
+        self.max_retry_after = max_retry_after
+        self.semaphores = defaultdict(lambda: Semaphore(concurrency))
+        # Least recently scheduled domains first, see `_prune`.
+        self.next_slots = OrderedDict()
+
+    @contextmanager
+    def slot(self, domain):
+        """Wait for the domain to accept a new check and hold it."""
+        try:
+            with self.semaphores[domain]:
+                now = time.time()
+                slot = max(now, self.next_slots.get(domain, 0))
+                self._set_next_slot(domain, slot + self.interval)
+                if slot > now:
+                    eventlet.sleep(slot - now)
+                yield
+        finally:
+            self._prune()
+
+    def _set_next_slot(self, domain, next_slot):
+        self.next_slots[domain] = next_slot
+        self.next_slots.move_to_end(domain)
+
+    def _prune(self):
+        """Forget the domains without any check to hold nor delay.
+
+        Domains are walked from the least recently scheduled one, until
+        one is still in use: the state kept stays bounded by the hosts
+        recently checked.
+        """
+        now = time.time()
+        while self.next_slots:
+            domain, next_slot = next(iter(self.next_slots.items()))
+            semaphore = self.semaphores.get(domain)
+            if next_slot > now or (semaphore is not None
+                                   and semaphore.balance < self.concurrency):
+                return
+            del self.next_slots[domain]
+            self.semaphores.pop(domain, None)
+
+    def backoff(self, domain, response):
+        """Delay the next checks of `domain` if asked by the response.
+
+        Returns `True` if the check is worth retrying, i.e. the delay
+        asked does not exceed the `max_retry_after` bound.
+        """
+        if (response is None
+                or response.status_code not in RETRY_AFTER_STATUSES):
+            return False
+        delay = parse_retry_after(response.headers.get('retry-after'))
+        if delay is None:
+            return False
+        log('Backing off {domain} for {delay}s'.format(domain=domain,
+                                                       delay=delay))
+        bounded_delay = min(delay, self.max_retry_after)
+        self._set_next_slot(domain, max(self.next_slots.get(domain, 0),
+                                        time.time() + bounded_delay))
+        return delay <= self.max_retry_after
@@ -0,0 +1,85 @@
+"""Compact encoding of the URL records.
+
+Each URL is stored within its own Redis hash. In the compact format
+(`COMPACT_RECORDS`), field names are replaced by short codes and empty
+values are omitted, these being restored when decoding the record of a
+checked URL. Records are decoded whatever their format: if a field is
+stored in both (e.g. until the `encode_records` migration is run), the
+value of the configured format prevails.
+"""
+
+FIELD_CODES = {
+    'checked-url': 'u',
+    'final-url': 'f',
+    'final-status-code': 's',
+    'updated': 'd',
+    'etag': 'e',
+    'expires': 'x',
+    'last-modified': 'm',
+    'content-type': 't',
+    'content-length': 'l',
+    'content-disposition': 'n',
+    'content-md5': '5',
+    'content-encoding': 'z',
+    'content-location': 'o',
+    'charset': 'c',
+    'redirect-url': 'r',
+    'redirect-status-code': 'R',
+    'group': 'g',
+    'frequency': 'q',
+    'interval': 'i',
+    'stable-checks': 'k',
+    'flaps': 'p',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+def encode_field(name, compact):
+    return FIELD_CODES.get(name, name) if compact else name
+
+
+def encode_record(data, compact):
+    """Return the fields to write for `data` and the empty ones to remove."""
+    if not compact:
+        return dict(data), []
+    mapping, empty = {}, []
+    for name, value in data.items():
+        field = encode_field(name, compact)
+        if value is None or value == '':
+            empty.append(field)
+        else:
+            mapping[field] = value
+    return mapping, empty
+
+
+def decode_record(data, compact, defaults=()):
+    """Return the record `data` with full field names, whatever its format.
+
+    The `defaults` fields are restored as empty values within compact
+    records of checked URLs.
+    """
+    coded = {FIELD_NAMES[field]: value for field, value in data.items()
+             if field in FIELD_NAMES}
+    if not coded:
+        return data
+    verbose = {field: value for field, value in data.items()
+               if field not in FIELD_NAMES}
+    record = dict(verbose, **coded) if compact else dict(coded, **verbose)
+    if record.get('final-status-code'):
+        for name in defaults:
+            record.setdefault(name, '')
+    return record
+
+
+def both_fields(names):
+    """Return the `names` followed by their codes, see `decode_values`."""
+    return list(names) + [FIELD_CODES[name] for name in names]
+
+
+def decode_values(values, compact):
+    """Return the values of fields read in both formats (`both_fields`)."""
+    half = len(values) // 2
+    verbose, coded = values[:half], values[half:]
+    preferred, other = (coded, verbose) if compact else (verbose, coded)
+    return [value if value is not None else fallback
+            for value, fallback in zip(preferred, other)]
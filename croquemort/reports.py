@@ -1,56 +1,121 @@
-import csv
+import json
+import logging
+import zlib
 from datetime import datetime
-from io import StringIO
 
 from jinja2 import Environment, PackageLoader
 from werkzeug.datastructures import Headers
 from werkzeug.wrappers import Response
 
-from .tools import apply_filters
+from .tools import chunked, compile_filters, format_csv
 
 loader = PackageLoader('croquemort', 'templates')
 env = Environment(loader=loader, autoescape=True)
+log = logging.info
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+CSV_CHUNK_SIZE = 64 * 1024  # in characters, per chunk of the response
+CSV_PAGE_SIZE = 1000  # records filtered and written at once
+CSV_HEADER = ('URL', 'Status', 'Content-Type', 'Updated')
 
 
-def compute_csv(urls, filters, excludes):
-    """Generate a streamed CSV of all data, optionally filtered."""
+def gzip_chunks(chunks):
+    """Compress a stream of (text) `chunks` in the gzip format."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def compute_csv(urls, filters, excludes, next_cursor=None,
+                chunk_size=CSV_CHUNK_SIZE, gzipped=False):
+    """Generate a streamed CSV of all data, optionally filtered.
+
+    Rows are buffered and sent by chunks of (at least) `chunk_size`
+    characters, compressed with gzip if `gzipped`.
+    If the data is paginated, `next_cursor` is set as a header.
+    """
 
     def generate():
         """A generator is required to stream the actual CSV."""
-        fake_file = StringIO()
-        w = csv.writer(fake_file)
+        keep = compile_filters(filters, excludes)
+        for page in chunked(urls, CSV_PAGE_SIZE):
+            # Records without status (never checked) are skipped.
+            yield format_csv(
+                (data['checked-url'], data['final-status-code'],
+                 data.get('content-type', ''), data.get('updated', ''))
+                for _, data in page
+                if data.get('final-status-code') and keep(data))
 
-        # Write the header.
-        w.writerow(('URL', 'Status', 'Content-Type', 'Updated'))
-        yield fake_file.getvalue()
-        fake_file.seek(0)
-        fake_file.truncate(0)
+    return csv_response(generate(), next_cursor, chunk_size, gzipped)
 
-        for url_hash, data in urls:
-            # Filtering.
-            data = apply_filters(data, filters, excludes)
-            if not data:
-                continue
 
-            # Statuses.
-            status = data.get('final-status-code', '')
-            if not status:
-                continue
+def csv_response(lines, next_cursor=None, chunk_size=CSV_CHUNK_SIZE,
+                 gzipped=False, age=None):
+    """Return a streamed CSV response of `lines`, the header aside.
 
-            url = data['checked-url']
-            content_type = data.get('content-type', '')
-            updated = data.get('updated', '')
+    `lines` are buffered and sent by chunks of (at least) `chunk_size`
+    characters, compressed with gzip if `gzipped`. The `age` of the
+    content (in seconds) is set as a header if it comes from a snapshot.
+    """
 
-            w.writerow((url, status, content_type, updated))
-            yield fake_file.getvalue()
-            fake_file.seek(0)
-            fake_file.truncate(0)
+    def generate():
+        buffer = [format_csv([CSV_HEADER])]
+        size = len(buffer[0])
+        for line in lines:
+            buffer.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        yield ''.join(buffer)
 
     # Set headers with the appropriated filename.
     headers = Headers()
     headers.set('Content-Disposition', 'attachment',
                 filename='croquemort-{date_iso}.csv'.format(
                     date_iso=datetime.now().date().isoformat()))
+    if next_cursor is not None:
+        headers.set(NEXT_CURSOR_HEADER, str(next_cursor))
+    if age is not None:
+        headers.set('Age', str(int(age)))
+    headers.set('Vary', 'Accept-Encoding')
 
     # Stream the response as the data is generated.
+    if gzipped:
+        headers.set('Content-Encoding', 'gzip')
+        return Response(gzip_chunks(generate()), mimetype='text/csv',
+                        headers=headers)
     return Response(generate(), mimetype='text/csv', headers=headers)
+
+
+def compute_group(name, urls, filters, excludes, next_cursor=None):
+    """Generate a streamed JSON of the group's URLs, optionally filtered.
+
+    If the URLs are paginated, `next_cursor` is set both as a header
+    and as a `next-cursor` field (`null` for the last page).
+    """
+
+    def generate():
+        """Records are serialized and filtered one at a time."""
+        yield '{\n  "name": ' + json.dumps(name) + ','
+        if next_cursor is not None:
+            yield '\n  "next-cursor": ' + json.dumps(
+                str(next_cursor) if next_cursor else None) + ','
+        yield '\n  "urls": ['
+        num = 0
+        keep = compile_filters(filters, excludes)
+        for url_hash, data in urls:
+            if not data or not keep(data):
+                continue
+            yield '{separator}\n    {data}'.format(
+                separator=',' if num else '', data=json.dumps(data))
+            num += 1
+        yield '\n  ]\n}'
+        log('Returned {num} results'.format(num=num))
+
+    headers = Headers()
+    if next_cursor is not None:
+        headers.set(NEXT_CURSOR_HEADER, str(next_cursor))
+    return Response(generate(), headers=headers)
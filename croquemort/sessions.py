@@ -0,0 +1,79 @@
+from collections import Counter
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import poolmanager
+
+
+class PoolStats(Counter):
+    """Counters about the reuse of connections by a session.
+
+    - `checkouts`: connections taken from the pools to issue a request;
+    - `connects`: connections actually opened (i.e. pool misses),
+      `tls-handshakes` being the subset of those over HTTPS;
+    - `discarded`: connections closed because their pool was full.
+    """
+
+    def as_dict(self):
+        stats = {key: self[key] for key in ('checkouts', 'connects',
+                                            'tls-handshakes', 'discarded')}
+        stats['hits'] = max(self['checkouts'] - self['connects'], 0)
+        stats['misses'] = self['connects']
+        return stats
+
+
+def _counting_pool_class(pool_class, stats):
+    """Return a subclass of `pool_class` reporting to `stats`."""
+    tls = pool_class.scheme == 'https'
+
+    class CountingConnection(pool_class.ConnectionCls):
+
+        def connect(self):
+            stats['connects'] += 1
+            if tls:
+                stats['tls-handshakes'] += 1
+            return super().connect()
+
+    class CountingPool(pool_class):
+        ConnectionCls = CountingConnection
+
+        def _get_conn(self, timeout=None):
+            stats['checkouts'] += 1
+            return super()._get_conn(timeout=timeout)
+
+        def _put_conn(self, conn):
+            if self.pool is not None and self.pool.full():
+                stats['discarded'] += 1
+            return super()._put_conn(conn)
+
+    return CountingPool
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """An adapter which pools report connections reuse to `stats`."""
+
+    def __init__(self, stats, *args, **kwargs):
+        self.stats = stats
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: _counting_pool_class(pool_class, self.stats)
+            for scheme, pool_class
+            in poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+def build_session(pool_connections, pool_maxsize, stats):
+    """Return a session with a keep-alive pool for both HTTP and HTTPS.
+
+    `pool_connections` is the number of hosts to keep a pool for and
+    `pool_maxsize` the number of connections kept per host.
+    """
+    session = requests.Session()
+    adapter = CountingHTTPAdapter(stats, pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
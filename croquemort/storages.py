@@ -1,19 +1,289 @@
 from datetime import datetime
+from urllib.parse import urlparse
+import json
+import random
+import time
+import uuid
 
 import redis
 from nameko.extensions import DependencyProvider
 from kombu.utils.encoding import str_to_bytes
 
-from .tools import generate_hash_for
+from .history import (
+    ENTRY, HISTORY_SIZE, HISTORY_TTL, history_key, pack_entry, unpack_entries
+)
+from .records import (
+    both_fields, decode_record, decode_values, encode_field, encode_record
+)
+from .tools import (
+    chunked, generate_hash_for, parse_content_type, report_row
+)
 
 
 REDIS_URI_KEY = 'REDIS_URI'
 REDIS_DEFAULT_URI = 'redis://localhost:6379/5'
+CHECK_LEASE_DURATION = 60 * 10  # in seconds
 HEADERS = (
     'etag', 'expires', 'last-modified', 'content-type', 'content-length',
     'content-disposition', 'content-md5', 'content-encoding',
     'content-location'
 )
+# Fields compared with the previous check to detect a change.
+CHANGE_FIELDS = ('final-status-code', 'etag', 'last-modified',
+                 'content-length')
+FREQUENCIES = ('hourly', 'daily', 'monthly')
+FREQUENCY_INTERVALS = {  # in seconds
+    'hourly': 60 * 60,
+    'daily': 60 * 60 * 24,
+    'monthly': 60 * 60 * 24 * 30,
+}
+# Sorted set of URL hashes scored by next due timestamp.
+SCHEDULE = 'schedule'
+# Schedule a URL unless it already is at a lower (or equal) interval,
+# see `_schedule_url`.
+SCHEDULE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current and ARGV[2] ~= ARGV[1] then
+    current = redis.call('HGET', KEYS[1], ARGV[2])
+end
+if current and tonumber(current) <= tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[2], 'NX', ARGV[4], KEYS[1])
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+local due = redis.call('ZSCORE', KEYS[2], KEYS[1])
+if not due or tonumber(due) > tonumber(ARGV[4]) then
+    redis.call('ZADD', KEYS[2], ARGV[4], KEYS[1])
+end
+return 1
+"""
+# Claim (at most) a number of due URLs, rescheduling them at the end of
+# a lease, see `pop_due_urls`.
+CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #due, 2 do
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[3], due[i])
+end
+return due
+"""
+# Sorted sets of hashes scored by insertion time, see `iter_registry`.
+URLS_REGISTRY = 'urls-registry'
+REGISTRY_PAGE_SIZE = 1000
+GROUPS_PAGE_SIZE = 100  # groups read per round trip
+# Fields with a set of URL hashes per value, see `resolve_filters`.
+INDEXED_FIELDS = ('final-status-code', 'content-type', 'domain')
+# CSV lines of the report of the checked URLs, by URL hash.
+REPORT = 'report'
+# Versions of the groups, increased whenever one of their URLs is written.
+GROUP_VERSIONS = 'group-versions'
+SNAPSHOT_PAGE_SIZE = 16  # chunks of a CSV snapshot read per round trip
+# Fields counted by value within the statistics of each scope (all
+# checked URLs, per group and per domain), see `stats_counts`.
+STATS_FIELDS = ('final-status-code', 'content-type')
+# Move a checked URL between the indexes and statistics of its values,
+# reading the stored ones atomically, see `_queue_moves`.
+# The keys of the statistics of the stored group are built within the
+# script, thus not declared: as the transactions of this module, it only
+# supports a single Redis instance (not Redis Cluster).
+MOVE_SCRIPT = """
+local url_hash, member = KEYS[1], ARGV[1]
+local function stored(preferred, fallback)
+    local value = redis.call('HGET', url_hash, preferred)
+    if not value and fallback ~= preferred then
+        value = redis.call('HGET', url_hash, fallback)
+    end
+    return value
+end
+local function count(scopes, field, increment)
+    for _, scope in ipairs(scopes) do
+        redis.call('HINCRBY', scope, field, increment)
+    end
+end
+local checked = stored(ARGV[2], ARGV[3])
+if checked == '' then
+    checked = false
+end
+local counted = checked or ARGV[8] == '1'
+local old_group, new_group = stored(ARGV[4], ARGV[5]) or '', ARGV[7]
+if new_group == '' then
+    new_group = old_group
+elseif new_group ~= old_group then
+    redis.call('HSET', url_hash, ARGV[4], new_group)
+end
+local old_scopes, new_scopes = {KEYS[2], KEYS[3]}, {KEYS[2], KEYS[3]}
+if old_group ~= '' then
+    table.insert(old_scopes, ARGV[6] .. old_group)
+end
+if new_group ~= '' then
+    table.insert(new_scopes, ARGV[6] .. new_group)
+    redis.call('HINCRBY', KEYS[4], new_group, 1)
+end
+local unexpected = {}
+for i = 9, #ARGV, 6 do
+    local name, old = ARGV[i], stored(ARGV[i + 1], ARGV[i + 2])
+    local keep, new, expected = ARGV[i + 3], ARGV[i + 4], ARGV[i + 5]
+    local new_index = KEYS[5 + (i - 9) / 3]
+    local expected_index = KEYS[6 + (i - 9) / 3]
+    if not old and checked then
+        old = ''
+    end
+    if keep == '1' then
+        new = old or ''
+    end
+    if not checked or old ~= new or old_group ~= new_group then
+        if checked then
+            count(old_scopes, name .. ':' .. old, -1)
+        end
+        if counted then
+            count(new_scopes, name .. ':' .. new, 1)
+        end
+    end
+    if keep ~= '1' and old ~= new then
+        redis.call('SADD', new_index, member)
+        if old == expected then
+            redis.call('SREM', expected_index, member)
+        elseif old then
+            table.insert(unexpected, name)
+            table.insert(unexpected, old)
+        end
+    end
+end
+return unexpected
+"""
+# Remove a URL from the index of a value unless it is the stored one.
+UNINDEX_SCRIPT = """
+local value = redis.call('HGET', KEYS[1], ARGV[2])
+if not value and ARGV[3] ~= ARGV[2] then
+    value = redis.call('HGET', KEYS[1], ARGV[3])
+end
+if (value or '') ~= ARGV[4] then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+"""
+# Append an entry to the history of a URL, trimming it to its latest
+# entries once twice as long, see `_execute_with_history`.
+HISTORY_SCRIPT = """
+local length = redis.call('APPEND', KEYS[1], ARGV[1])
+local max_length = tonumber(ARGV[3])
+if length >= 2 * max_length then
+    redis.call('SET', KEYS[1],
+               redis.call('GETRANGE', KEYS[1], -max_length, -1))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+"""
+# Webhook deliveries: ids scored by due date (queue) or by the end of
+# their lease (in flight), their payloads within a hash.
+WEBHOOK_QUEUE = 'webhook-queue'
+WEBHOOK_INFLIGHT = 'webhook-inflight'
+WEBHOOK_JOBS = 'webhook-jobs'
+WEBHOOK_DEAD_LETTERS = 'webhook-dead-letters'
+# Consecutive failures per callback endpoint.
+WEBHOOK_FAILURES = 'webhook-failures'
+# Callback URLs with buffered results, scored by the oldest one.
+WEBHOOK_BUFFERS = 'webhook-buffers'
+
+
+def frequency_registry(frequency):
+    """Return the key of the registry of groups for `frequency`."""
+    return '{frequency}-registry'.format(frequency=frequency)
+
+
+def frequency_interval(frequency):
+    """Return the interval in seconds for a named or numeric `frequency`.
+
+    Raises a `ValueError` if it is neither known nor a positive number.
+    """
+    if frequency in FREQUENCY_INTERVALS:
+        return FREQUENCY_INTERVALS[frequency]
+    interval = int(frequency)
+    if interval <= 0:
+        raise ValueError('Invalid frequency {frequency}'.format(
+            frequency=frequency))
+    return interval
+
+
+def change_counters(previous, metadata):
+    """Return the `stable-checks` and `flaps` counters of a check.
+
+    `stable-checks` is the number of consecutive checks without any
+    change of the `CHANGE_FIELDS` and `flaps` the number of consecutive
+    checks with a change of status code.
+    """
+    if not previous or not previous.get('final-status-code'):
+        return {'stable-checks': 0, 'flaps': 0}
+    status_changed = (str(metadata['final-status-code'])
+                      != previous['final-status-code'])
+    changed = any(str(metadata[field]) != previous.get(field, '')
+                  for field in CHANGE_FIELDS if field in metadata)
+    return {
+        'stable-checks': (0 if changed
+                          else int(previous.get('stable-checks', 0)) + 1),
+        'flaps': int(previous.get('flaps', 0)) + 1 if status_changed else 0,
+    }
+
+
+def circuit_key(endpoint):
+    return 'webhook-circuit-{endpoint}'.format(endpoint=endpoint)
+
+
+def buffer_key(callback_url):
+    return generate_hash_for('buffer', callback_url)
+
+
+def stats_key(scope=None, value=None):
+    """Return the key of the counters of a scope, all URLs by default."""
+    if scope is None:
+        return 'stats'
+    return 'stats-{scope}-{value}'.format(scope=scope, value=value)
+
+
+def stats_counts(url, data):
+    """Return the `(key, field)` counters of a checked record.
+
+    Its values are counted for all URLs, for its domain and its group.
+    """
+    if not data.get('final-status-code'):
+        return []
+    keys = [stats_key(), stats_key('domain', urlparse(url).netloc)]
+    if data.get('group'):
+        keys.append(stats_key('group', data['group']))
+    return [(key, '{field}:{value}'.format(field=field,
+                                           value=data.get(field, '')))
+            for key in keys for field in STATS_FIELDS]
+
+
+def snapshot_key(key, timestamp):
+    """Return the key of the chunks of a snapshot built at `timestamp`."""
+    return '{key}-{timestamp}'.format(key=key, timestamp=timestamp)
+
+
+def index_key(field, value):
+    """Return the key of the set of URL hashes with `field` == `value`."""
+    return generate_hash_for(
+        'index', '{field}={value}'.format(field=field, value=value))
+
+
+class IndexSelection(object):
+    """URL hashes selected by filters and excludes through the indexes.
+
+    `candidates` is `None` if no filter applies to an indexed field,
+    otherwise the set of URL hashes matching all of them; `excluded`
+    is the set of URL hashes matching any indexed exclude.
+    """
+
+    def __init__(self, candidates=None, excluded=None):
+        self.candidates = candidates
+        self.excluded = excluded or set()
+
+    def apply(self, url_hashes):
+        """Yield the `url_hashes` within the selection."""
+        for url_hash in url_hashes:
+            if self.candidates is not None \
+                    and url_hash not in self.candidates:
+                continue
+            if url_hash not in self.excluded:
+                yield url_hash
 
 
 class RedisStorage(DependencyProvider):
@@ -25,20 +295,124 @@ class RedisStorage(DependencyProvider):
         self.database = redis.StrictRedis.from_url(redis_uri,
                                                    decode_responses=True,
                                                    charset='utf-8')
+        # The history is binary, hence a dedicated connection to read it.
+        self.binary_database = redis.StrictRedis.from_url(redis_uri)
+        self.check_lease = self.container.config.get('CHECK_LEASE_DURATION',
+                                                     CHECK_LEASE_DURATION)
+        self.history_size = self.container.config.get('CHECK_HISTORY_SIZE',
+                                                      HISTORY_SIZE)
+        self.history_ttl = self.container.config.get('CHECK_HISTORY_TTL',
+                                                     HISTORY_TTL)
+        self.compact = self.container.config.get('COMPACT_RECORDS', False)
 
     def get_dependency(self, worker_ctx):
         return self
 
-    def get_all_urls(self):
-        for url_hash in self.database.lrange('urls', 0, -1):
-            yield url_hash, self.get_url(url_hash)
+    def iter_registry(self, key, page_size=REGISTRY_PAGE_SIZE):
+        """Iterate over the members of a registry, one page at a time.
+
+        Pages are read by increasing scores (which never change), from
+        the score of the last member read, so that members can be safely
+        added or removed during the iteration (e.g. by a migration) and
+        none is read twice, unlike with ZSCAN.
+        """
+        score, tied = '-inf', set()  # members read with the last score
+        while True:
+            count = len(tied) + page_size
+            page = self.database.zrangebyscore(key, score, '+inf', start=0,
+                                               num=count, withscores=True)
+            for member, member_score in page:
+                if member in tied:
+                    continue
+                if member_score != score:
+                    score, tied = member_score, set()
+                tied.add(member)
+                yield member
+            if len(page) < count:
+                return
+
+    def scan_registry(self, key, cursor=0, count=REGISTRY_PAGE_SIZE):
+        """Return the next cursor and about `count` members of a registry.
+
+        The next cursor is `0` once the whole registry has been scanned.
+        """
+        members = []
+        while True:
+            cursor, page = self.database.zscan(key, cursor=cursor,
+                                               count=count)
+            members.extend(member for member, _ in page)
+            if not cursor or len(members) >= count:
+                return cursor, members
+
+    def get_all_urls(self, page_size=REGISTRY_PAGE_SIZE):
+        """Yield `(url_hash, data)` tuples, pipelining reads by pages."""
+        return self.get_urls(self.iter_registry(URLS_REGISTRY, page_size),
+                             page_size)
+
+    def _field(self, name):
+        """Return the field of the URL records for `name`."""
+        return encode_field(name, self.compact)
+
+    def _decode(self, data):
+        return decode_record(data, self.compact, HEADERS)
 
     def get_url(self, url_hash):
-        return self.database.hgetall(str_to_bytes(url_hash))
+        return self._decode(self.database.hgetall(str_to_bytes(url_hash)))
+
+    def get_urls(self, url_hashes, page_size=REGISTRY_PAGE_SIZE):
+        """Yield `(url_hash, data)` tuples, pipelining reads by pages."""
+        for page in chunked(url_hashes, page_size):
+            pipe = self.database.pipeline(transaction=False)
+            for url_hash in page:
+                pipe.hgetall(str_to_bytes(url_hash))
+            yield from zip(page, map(self._decode, pipe.execute()))
+
+    def iter_report(self, page_size=REGISTRY_PAGE_SIZE):
+        """Iterate over the CSV lines of the report, one page at a time.
+
+        The registry is walked rather than the report itself, HSCAN
+        possibly returning a line more than once.
+        """
+        return self.get_report_rows(
+            self.iter_registry(URLS_REGISTRY, page_size), page_size)
+
+    def get_report_rows(self, url_hashes, page_size=REGISTRY_PAGE_SIZE):
+        """Yield the CSV lines of the report for the checked `url_hashes`."""
+        for page in chunked(url_hashes, page_size):
+            yield from filter(None, self.database.hmget(REPORT, page))
+
+    def store_report_rows(self, records):
+        """Write the report lines of `(url_hash, data)` checked records."""
+        pipe = self.database.pipeline(transaction=False)
+        for url_hash, data in records:
+            if data.get('final-status-code'):
+                pipe.hset(REPORT, url_hash,
+                          report_row(data['checked-url'], data))
+        pipe.execute()
 
     def get_group(self, group_hash):
         return self.database.hgetall(str_to_bytes(group_hash))
 
+    def get_group_version(self, group_hash):
+        return int(self.database.hget(GROUP_VERSIONS, group_hash) or 0)
+
+    def get_group_name(self, group_hash):
+        return self.database.hget(str_to_bytes(group_hash), 'name')
+
+    def scan_group(self, group_hash, cursor=0, count=REGISTRY_PAGE_SIZE):
+        """Return the next cursor and about `count` URL hashes of a group.
+
+        The next cursor is `0` once the whole group has been scanned.
+        """
+        url_hashes = []
+        while True:
+            cursor, page = self.database.hscan(str_to_bytes(group_hash),
+                                               cursor=cursor, count=count)
+            url_hashes.extend(key for key in page
+                              if key not in ('name', 'url'))
+            if not cursor or len(url_hashes) >= count:
+                return cursor, url_hashes
+
     def get_webhooks_for_url(self, url):
         w_hash = generate_hash_for('webhook', url)
         return self.database.lrange(str_to_bytes(w_hash), 0, -1)
@@ -46,55 +420,292 @@ class RedisStorage(DependencyProvider):
     def delete_url(self, url_hash, data=None):
         if data is None:
             data = self.get_url(url_hash)
-        for key in data:
-            self.database.hdel(url_hash, key)
-        self.database.lrem('urls', 0, url_hash)
+        pipe = self.database.pipeline()
+        if data:
+            # Whatever the format of the record.
+            pipe.hdel(url_hash, *{field for key in data
+                                  for field in (key, encode_field(key, True))})
+        pipe.zrem(URLS_REGISTRY, url_hash)
+        for field, value in self._indexed_values(data).items():
+            pipe.srem(index_key(field, value), url_hash)
+        pipe.delete(history_key(url_hash))
+        pipe.hdel(REPORT, url_hash)
+        if data.get('group'):
+            pipe.hincrby(GROUP_VERSIONS, data['group'], 1)
+        if data.get('checked-url'):
+            for key, field in stats_counts(data['checked-url'], data):
+                pipe.hincrby(key, field, -1)
+        pipe.execute()
 
     def store_url(self, url):
+        """Register `url` and return its current record."""
         url_hash = generate_hash_for('url', url)
-        self.database.hset(url_hash, 'checked-url', str_to_bytes(url))
-        if url_hash not in self.database.lrange('urls', 0, -1):
-            self.database.rpush('urls', str_to_bytes(url_hash))
+        pipe = self.database.pipeline()
+        pipe.hset(url_hash, self._field('checked-url'), str_to_bytes(url))
+        pipe.zadd(URLS_REGISTRY, {url_hash: time.time()}, nx=True)
+        pipe.sadd(index_key('domain', urlparse(url).netloc), url_hash)
+        pipe.hgetall(url_hash)
+        return self._decode(pipe.execute()[-1])
 
     def store_group(self, url, group):
+        """Set the group of `url`, moving its statistics if it changes.
+
+        The statistics are moved from the stored values atomically
+        (see `_queue_moves`).
+        """
         url_hash = generate_hash_for('url', url)
         group_hash = generate_hash_for('group', group)
-        self.database.hset(url_hash, 'group', str_to_bytes(group_hash))
-        self.database.hset(group_hash, 'name', str_to_bytes(group))
-        self.database.hset(group_hash, url_hash, str_to_bytes(url))
-        self.database.hset(group_hash, 'url', str_to_bytes(url))
+        pipe = self.database.pipeline()
+        self._queue_moves(pipe, url, {}, {}, group=group_hash)
+        pipe.hset(group_hash, mapping={
+            'name': str_to_bytes(group),
+            url_hash: str_to_bytes(url),
+            'url': str_to_bytes(url),
+        })
+        pipe.execute()
 
     def store_frequency(self, url, group, frequency):
         url_hash = generate_hash_for('url', url)
         group_hash = generate_hash_for('group', group)
-        self.database.hset(url_hash, 'frequency', str_to_bytes(frequency))
-        if group_hash not in self.database.lrange(frequency, 0, -1):
-            self.database.rpush(frequency, str_to_bytes(group_hash))
+        pipe = self.database.pipeline()
+        pipe.hset(url_hash, self._field('frequency'),
+                  str_to_bytes(frequency))
+        pipe.zadd(frequency_registry(frequency), {group_hash: time.time()},
+                  nx=True)
+        pipe.hincrby(GROUP_VERSIONS, group_hash, 1)
+        try:
+            self._schedule_url(pipe, url_hash, frequency_interval(frequency))
+        except ValueError:
+            pass
+        pipe.execute()
+
+    def _schedule_url(self, pipe, url_hash, interval):
+        """Queue the scheduling of `url_hash` every `interval` within `pipe`.
+
+        The first due date is randomly spread over the interval so that
+        URLs registered together are not all due at the same time.
+        The highest frequency wins: a URL already scheduled at a lower
+        interval keeps it, along with its due date, which is otherwise
+        brought forward within the new interval if needed.
+        """
+        due = time.time() + random.uniform(0, interval)
+        pipe.eval(SCHEDULE_SCRIPT, 2, url_hash, SCHEDULE,
+                  *self._fields('interval'), interval, due)
+
+    def schedule_url(self, url, interval):
+        """Check `url` every `interval` seconds in the rolling schedule."""
+        pipe = self.database.pipeline()
+        self._schedule_url(pipe, generate_hash_for('url', url), interval)
+        pipe.execute()
+
+    def pop_due_urls(self, limit, adapt=None):
+        """Return (at most) `limit` URLs due for a check and reschedule them.
+
+        URLs are rescheduled one interval after their previous due date,
+        or randomly within the next interval if they are late by more
+        than one interval (e.g. after a downtime) to smooth the load.
+        The optional `adapt` callable computes the interval to use from
+        the registered one and the `stable-checks` and `flaps` counters.
+        Due URLs are first claimed atomically, being rescheduled at the
+        end of a lease (`CHECK_LEASE_DURATION`): overlapping calls (e.g.
+        from many timers) never return the same URLs.
+        """
+        now = time.time()
+        claimed = self.database.eval(CLAIM_SCRIPT, 1, SCHEDULE, now, limit,
+                                     now + self.check_lease)
+        if not claimed:
+            return []
+        due_hashes = list(zip(claimed[::2], map(float, claimed[1::2])))
+        pipe = self.database.pipeline(transaction=False)
+        for url_hash, _ in due_hashes:
+            pipe.hmget(url_hash, both_fields((
+                'checked-url', 'interval', 'stable-checks', 'flaps')))
+        records = pipe.execute()
+        urls, schedule, unscheduled = [], {}, []
+        for (url_hash, due), record in zip(due_hashes, records):
+            url, interval, stable_checks, flaps = decode_values(record,
+                                                                self.compact)
+            if not url or not interval:
+                unscheduled.append(url_hash)
+                continue
+            interval = int(interval)
+            if adapt is not None:
+                interval = adapt(interval, int(stable_checks or 0),
+                                 int(flaps or 0))
+            if due + interval > now:
+                schedule[url_hash] = due + interval
+            else:
+                schedule[url_hash] = now + random.uniform(0, interval)
+            urls.append(url)
+        pipe = self.database.pipeline()
+        if schedule:
+            pipe.zadd(SCHEDULE, schedule, xx=True)
+        if unscheduled:
+            pipe.zrem(SCHEDULE, *unscheduled)
+        pipe.execute()
+        return urls
+
+    def _fields(self, name):
+        """Return the fields of `name`, in the configured format first."""
+        return encode_field(name, self.compact), encode_field(
+            name, not self.compact)
 
-    def store_metadata(self, url, response):
+    def _queue_moves(self, pipe, url, previous, metadata, group=None):
+        """Queue the moves of `url` between indexes and statistics.
+
+        The values are read from the record when the script runs, the
+        `previous` ones being expected: the URL is removed from their
+        indexes, other values being returned (see `_unindex`).
+        The URL is moved to the `group` hash if given, the version of
+        its group being increased.
+        """
         url_hash = generate_hash_for('url', url)
-        self.database.hset(url_hash, 'final-url',
-                           str_to_bytes(response.url))
-        self.database.hset(url_hash, 'final-status-code',
-                           str_to_bytes(response.status_code))
-        self.database.hset(url_hash, 'updated',
-                           str_to_bytes(datetime.now().isoformat()))
+        keys = [url_hash, stats_key(),
+                stats_key('domain', urlparse(url).netloc), GROUP_VERSIONS]
+        args = [url_hash,
+                *self._fields('final-status-code'), *self._fields('group'),
+                stats_key('group', ''), group or '',
+                int('final-status-code' in metadata)]
+        for field in STATS_FIELDS:
+            keep = field not in metadata
+            value = '' if keep else str(metadata[field])
+            expected = previous.get(field)
+            expected = '' if expected is None else expected
+            keys.extend([index_key(field, value), index_key(field, expected)])
+            args.extend([field, *self._fields(field), int(keep), value,
+                         expected])
+        pipe.eval(MOVE_SCRIPT, len(keys), *keys, *args)
+
+    def _unindex(self, url_hash, unexpected, previous):
+        """Remove `url_hash` from the indexes of `unexpected` values.
+
+        Those were stored instead of the `previous` ones (e.g. by an
+        overlapping check) and may have changed since, hence a check.
+        """
+        if not unexpected:
+            return
+        pipe = self.database.pipeline()
+        for field, value in zip(unexpected[::2], unexpected[1::2]):
+            pipe.eval(UNINDEX_SCRIPT, 2, url_hash, index_key(field, value),
+                      url_hash, *self._fields(field), value)
+        pipe.execute()
+
+    def _touch_group(self, pipe, previous):
+        """Increase the version of the group of a `previous` record."""
+        if previous.get('group'):
+            pipe.hincrby(GROUP_VERSIONS, previous['group'], 1)
+
+    def _indexed_values(self, data):
+        """Return the values of `data` for the indexed fields."""
+        values = {field: data[field] for field in INDEXED_FIELDS
+                  if data.get(field) is not None}
+        if data.get('checked-url'):
+            values['domain'] = urlparse(data['checked-url']).netloc
+        return values
+
+    def _update_indexes(self, pipe, url_hash, previous, metadata):
+        """Queue the moves of `url_hash` between indexes within `pipe`."""
+        old_values = self._indexed_values(previous)
+        for field, value in self._indexed_values(metadata).items():
+            value = str(value)
+            old_value = old_values.get(field)
+            if old_value == value:
+                continue
+            if old_value is not None:
+                pipe.srem(index_key(field, old_value), url_hash)
+            pipe.sadd(index_key(field, value), url_hash)
+
+    def _execute_with_history(self, pipe, url_hash, entry):
+        """Execute `pipe` along with the history `entry` of `url_hash`.
+
+        The results of the commands of `pipe` are returned.
+        The history is kept between `history_size` and twice as many
+        entries, trimming it only once in a while (atomically, not to
+        lose the entries of overlapping checks).
+        """
+        if not self.history_size:
+            return pipe.execute()
+        pipe.eval(HISTORY_SCRIPT, 1, history_key(url_hash), entry,
+                  self.history_ttl, self.history_size * ENTRY.size)
+        return pipe.execute()[:-1]
+
+    def get_history(self, url_hash):
+        """Return the list of the latest checks of `url_hash`, oldest first."""
+        data = self.binary_database.get(history_key(url_hash)) or b''
+        return unpack_entries(data[-self.history_size * ENTRY.size:])
+
+    def store_metadata(self, url, response, previous=None, latency=None):
+        """Store the results of a check and return the whole URL record.
+
+        The record is built in memory then written and read back
+        within a single pipelined transaction (one round trip).
+        The `previous` record (as returned by `store_url`) is used to
+        compute the counters of changes, it is retrieved if not provided.
+        Indexes and statistics are maintained from the values stored at
+        the time of the write, previous checks may have overlapped.
+        A 304 response only refreshes the `updated` date (and counts
+        as a stable check).
+        The check is also appended to the history of the URL, along with
+        its `latency` (in seconds), and its line of the CSV report is
+        updated.
+        """
+        url_hash = generate_hash_for('url', url)
+        if previous is None:
+            previous = self.get_url(url_hash)
+        now = datetime.now()
+        if response.status_code == 304 and previous:
+            # Not modified since the previous check, only refresh the date.
+            pipe = self.database.pipeline()
+            pipe.hset(url_hash, mapping={
+                self._field('updated'): str_to_bytes(now.isoformat()),
+                self._field('flaps'): 0,
+            })
+            pipe.hincrby(url_hash, self._field('stable-checks'), 1)
+            pipe.hset(REPORT, url_hash, report_row(
+                url, dict(previous, updated=now.isoformat())))
+            self._touch_group(pipe, previous)
+            pipe.hgetall(url_hash)
+            entry = pack_entry(now.timestamp(),
+                               previous.get('final-status-code'), latency,
+                               previous.get('content-length'))
+            return self._decode(
+                self._execute_with_history(pipe, url_hash, entry)[-1])
+        metadata = {
+            'final-url': response.url,
+            'final-status-code': response.status_code,
+            'updated': now.isoformat(),
+        }
         if response.headers:
             for header in HEADERS:
                 value = response.headers.get(header, '')
 
                 # Special treatment for content type which may contain charset.
                 if header == 'content-type' and ';' in value:
-                    self.store_content_type(url_hash, value)
+                    metadata.update(parse_content_type(value))
                 else:
-                    self.database.hset(url_hash, header, str_to_bytes(value))
+                    metadata[header] = value
         # deal w/ redirect if any
         if len(response.history):
-            self.database.hset(url_hash, 'redirect-url',
-                               str_to_bytes(response.history[0].url))
-            self.database.hset(url_hash, 'redirect-status-code',
-                               str_to_bytes(response.history[0].status_code))
-        return self.get_url(url_hash)
+            metadata['redirect-url'] = response.history[0].url
+            metadata['redirect-status-code'] = response.history[0].status_code
+        metadata.update(change_counters(previous, metadata))
+        mapping, empty = encode_record(metadata, self.compact)
+        pipe = self.database.pipeline()
+        # Before the write, to read the stored values.
+        self._queue_moves(pipe, url, previous, metadata)
+        pipe.hset(url_hash, mapping={key: str_to_bytes(value)
+                                     for key, value in mapping.items()})
+        if empty:
+            pipe.hdel(url_hash, *empty)
+        # Headers missing from the response keep their stored values.
+        pipe.hset(REPORT, url_hash, report_row(url, dict(previous,
+                                                         **metadata)))
+        pipe.hgetall(url_hash)
+        entry = pack_entry(now.timestamp(), response.status_code, latency,
+                           metadata.get('content-length'))
+        results = self._execute_with_history(pipe, url_hash, entry)
+        self._unindex(url_hash, results[0], previous)
+        return self._decode(results[-1])
 
     def store_webhook(self, url, callback_url):
         """
@@ -104,56 +715,426 @@ class RedisStorage(DependencyProvider):
             w_hash = generate_hash_for('webhook', url)
             self.database.rpush(w_hash, str_to_bytes(callback_url))
 
+    def store_webhooks(self, urls, callback_url):
+        """Store a webhook for each of the `urls`, within one round trip."""
+        pipe = self.database.pipeline()
+        for url in urls:
+            w_hash = generate_hash_for('webhook', url)
+            # Remove it first to keep callback URLs unique.
+            pipe.lrem(w_hash, 0, str_to_bytes(callback_url))
+            pipe.rpush(w_hash, str_to_bytes(callback_url))
+        pipe.execute()
+
+    def remove_webhooks(self, urls, callback_url):
+        """Remove the webhook of each of the `urls`, within one round trip."""
+        pipe = self.database.pipeline(transaction=False)
+        for url in urls:
+            w_hash = generate_hash_for('webhook', url)
+            pipe.lrem(w_hash, 0, str_to_bytes(callback_url))
+        pipe.execute()
+
+    def buffer_webhooks(self, callback_urls, data, size):
+        """Buffer `data` for a batched delivery to the `callback_urls`.
+
+        Returns the callback URLs whose buffer holds (at least) `size`
+        results, to be flushed.
+        """
+        now = time.time()
+        item = json.dumps({'buffered': now, 'data': data})
+        pipe = self.database.pipeline()
+        for callback_url in callback_urls:
+            pipe.rpush(buffer_key(callback_url), item)
+            pipe.zadd(WEBHOOK_BUFFERS, {callback_url: now}, nx=True)
+        lengths = pipe.execute()[::2]
+        return [callback_url
+                for callback_url, length in zip(callback_urls, lengths)
+                if length >= size]
+
+    def get_expired_webhook_buffers(self, latency):
+        """Return the callback URLs buffering results for `latency`s."""
+        return self.database.zrangebyscore(WEBHOOK_BUFFERS, '-inf',
+                                           time.time() - latency)
+
+    def flush_webhook_buffer(self, callback_url, size):
+        """Queue the delivery of (at most) `size` results buffered for
+        `callback_url`, as a single batch.
+
+        Returns the number of results remaining within the buffer.
+        """
+        key = buffer_key(callback_url)
+
+        def flush(pipe):
+            items = pipe.lrange(key, 0, size - 1)
+            oldest = pipe.lindex(key, size)
+            remaining = pipe.llen(key) - len(items)
+            pipe.multi()
+            pipe.ltrim(key, len(items), -1)
+            if oldest is None:
+                pipe.zrem(WEBHOOK_BUFFERS, callback_url)
+            else:
+                pipe.zadd(WEBHOOK_BUFFERS,
+                          {callback_url: json.loads(oldest)['buffered']})
+            if items:
+                job = {
+                    'url': callback_url,
+                    'data': [json.loads(item)['data'] for item in items],
+                    'attempts': 0,
+                    'batch': True,
+                }
+                job_id = uuid.uuid4().hex
+                pipe.hset(WEBHOOK_JOBS, job_id, json.dumps(job))
+                pipe.zadd(WEBHOOK_QUEUE, {job_id: time.time()})
+            return remaining
+
+        # Retried if results are buffered meanwhile.
+        return self.database.transaction(flush, key,
+                                         value_from_callable=True)
+
+    def enqueue_webhooks(self, callback_urls, data):
+        """Queue the delivery of `data` to each of the `callback_urls`."""
+        now = time.time()
+        pipe = self.database.pipeline()
+        for callback_url in callback_urls:
+            job = {'url': callback_url, 'data': data, 'attempts': 0}
+            job_id = uuid.uuid4().hex
+            pipe.hset(WEBHOOK_JOBS, job_id, json.dumps(job))
+            pipe.zadd(WEBHOOK_QUEUE, {job_id: now})
+        pipe.execute()
+
+    def pop_due_webhooks(self, limit, lease):
+        """Return (at most) `limit` due deliveries as `(job_id, job)`.
+
+        Deliveries are claimed for `lease` seconds: unless settled by then
+        (completed, rescheduled or dead-lettered), they are queued again
+        by `requeue_expired_webhooks`. A delivery is thus made at least
+        once, even if a process dies while delivering it.
+        """
+        now = time.time()
+        job_ids = self.database.zrangebyscore(WEBHOOK_QUEUE, '-inf', now,
+                                              start=0, num=limit)
+        if not job_ids:
+            return []
+        pipe = self.database.pipeline()
+        for job_id in job_ids:
+            # Only the process removing it from the queue claims it.
+            pipe.zrem(WEBHOOK_QUEUE, job_id)
+            pipe.zadd(WEBHOOK_INFLIGHT, {job_id: now + lease})
+        pipe.hmget(WEBHOOK_JOBS, *job_ids)
+        results = pipe.execute()
+        jobs, missing = [], []
+        for job_id, claimed, job in zip(job_ids, results[:-1:2],
+                                        results[-1]):
+            if not claimed:
+                continue
+            if job is None:
+                missing.append(job_id)
+                continue
+            jobs.append((job_id, json.loads(job)))
+        if missing:
+            self.database.zrem(WEBHOOK_INFLIGHT, *missing)
+        return jobs
+
+    def requeue_expired_webhooks(self):
+        """Queue again the deliveries whose lease expired, return them."""
+        now = time.time()
+        job_ids = self.database.zrangebyscore(WEBHOOK_INFLIGHT, '-inf', now)
+        if job_ids:
+            pipe = self.database.pipeline()
+            pipe.zrem(WEBHOOK_INFLIGHT, *job_ids)
+            pipe.zadd(WEBHOOK_QUEUE, {job_id: now for job_id in job_ids},
+                      nx=True)
+            pipe.execute()
+        return job_ids
+
+    def complete_webhooks(self, job_ids, endpoints=()):
+        """Forget delivered `job_ids`, closing circuits of `endpoints`."""
+        pipe = self.database.pipeline()
+        if job_ids:
+            pipe.hdel(WEBHOOK_JOBS, *job_ids)
+            pipe.zrem(WEBHOOK_INFLIGHT, *job_ids)
+        if endpoints:
+            pipe.hdel(WEBHOOK_FAILURES, *endpoints)
+        pipe.execute()
+
+    def reschedule_webhooks(self, schedule):
+        """Queue again deliveries, `schedule` being `{job_id: (job, due)}`."""
+        if not schedule:
+            return
+        pipe = self.database.pipeline()
+        for job_id, (job, due) in schedule.items():
+            pipe.hset(WEBHOOK_JOBS, job_id, json.dumps(job))
+            pipe.zadd(WEBHOOK_QUEUE, {job_id: due})
+        pipe.zrem(WEBHOOK_INFLIGHT, *schedule)
+        pipe.execute()
+
+    def dead_letter_webhooks(self, jobs, size):
+        """Move `(job_id, job)` deliveries to the dead letters.
+
+        Only the `size` most recent dead letters are kept.
+        """
+        if not jobs:
+            return
+        pipe = self.database.pipeline()
+        for job_id, job in jobs:
+            pipe.lpush(WEBHOOK_DEAD_LETTERS,
+                       json.dumps(dict(job, id=job_id, failed=time.time())))
+        pipe.ltrim(WEBHOOK_DEAD_LETTERS, 0, size - 1)
+        job_ids = [job_id for job_id, _ in jobs]
+        pipe.hdel(WEBHOOK_JOBS, *job_ids)
+        pipe.zrem(WEBHOOK_INFLIGHT, *job_ids)
+        pipe.execute()
+
+    def get_dead_letters(self, start=0, count=100):
+        """Return dead letters, the most recent first."""
+        return [json.loads(job) for job in self.database.lrange(
+            WEBHOOK_DEAD_LETTERS, start, start + count - 1)]
+
+    def replay_dead_letters(self, count=None):
+        """Queue again the `count` oldest dead letters (all by default).
+
+        Returns the number of deliveries queued, their attempts being reset.
+        """
+        jobs = self.database.lrange(WEBHOOK_DEAD_LETTERS,
+                                    -count if count else 0, -1)
+        if not jobs:
+            return 0
+        now = time.time()
+        pipe = self.database.pipeline()
+        # Dead letters are pushed on the head, replayed from the tail.
+        pipe.ltrim(WEBHOOK_DEAD_LETTERS, 0, -len(jobs) - 1)
+        for job in map(json.loads, jobs):
+            job_id = job.pop('id')
+            job.pop('failed', None)
+            job.pop('error', None)
+            job['attempts'] = 0
+            pipe.hset(WEBHOOK_JOBS, job_id, json.dumps(job))
+            pipe.zadd(WEBHOOK_QUEUE, {job_id: now})
+        pipe.execute()
+        return len(jobs)
+
+    def get_open_circuits(self, endpoints):
+        """Return `{endpoint: seconds}` until the circuits are closed."""
+        endpoints = list(endpoints)
+        pipe = self.database.pipeline(transaction=False)
+        for endpoint in endpoints:
+            pipe.pttl(circuit_key(endpoint))
+        return {endpoint: ttl / 1000
+                for endpoint, ttl in zip(endpoints, pipe.execute())
+                if ttl > 0}
+
+    def record_webhook_failures(self, failures, threshold, cooldown):
+        """Count failures per endpoint, `failures` being a mapping.
+
+        The circuit of an endpoint is opened for `cooldown` seconds once
+        it reaches `threshold` consecutive failures, and opened again
+        at the first failure after that (until a success).
+        Returns the endpoints whose circuit has been opened.
+        """
+        if not failures:
+            return []
+        endpoints = list(failures)
+        pipe = self.database.pipeline()
+        for endpoint in endpoints:
+            pipe.hincrby(WEBHOOK_FAILURES, endpoint, failures[endpoint])
+        opened = [endpoint
+                  for endpoint, count in zip(endpoints, pipe.execute())
+                  if count >= threshold]
+        if opened:
+            pipe = self.database.pipeline()
+            for endpoint in opened:
+                pipe.set(circuit_key(endpoint), 1, ex=cooldown)
+            pipe.execute()
+        return opened
+
     def store_content_type(self, url_hash, value):
-        try:
-            content_type, charset = value.split(';')
-        except ValueError:
-            # Weird e.g.: text/html;h5ai=0.20;charset=UTF-8
-            content_type, _, charset = value.split(';')
-
-        value = content_type.strip().lower()
-        if '=' in charset:
-            _, charset = charset.split('=')
-            self.database.hset(
-                url_hash,
-                'charset',
-                str_to_bytes(charset.strip().lower()))
-        self.database.hset(url_hash, 'content-type', str_to_bytes(value))
+        metadata = parse_content_type(value)
+        pipe = self.database.pipeline()
+        pipe.hset(url_hash, mapping={
+            self._field(key): str_to_bytes(value)
+            for key, value in metadata.items()})
+        self._update_indexes(pipe, url_hash, {'content-type': value},
+                             metadata)
+        pipe.execute()
+
+    def store_indexes(self, url_hash, data):
+        """Add `url_hash` to the indexes matching its current `data`."""
+        pipe = self.database.pipeline()
+        self._update_indexes(pipe, url_hash, {}, data)
+        pipe.execute()
+
+    def rewrite_records(self, records):
+        """Rewrite `(url_hash, data)` records in the configured format.
+
+        Fields are written before removing those of the other format,
+        readers preferring the configured one meanwhile.
+        """
+        pipe = self.database.pipeline()
+        for url_hash, data in records:
+            mapping, empty = encode_record(data, self.compact)
+            stale = {encode_field(name, not self.compact) for name in data}
+            stale = stale.union(empty).difference(mapping)
+            if mapping:
+                pipe.hset(url_hash, mapping={
+                    key: str_to_bytes(value) for key, value in mapping.items()
+                })
+            if stale:
+                pipe.hdel(url_hash, *stale)
+        pipe.execute()
+
+    def get_stats(self, scope=None, value=None):
+        """Return the counters of a scope as `{field: {value: count}}`."""
+        stats = {field: {} for field in STATS_FIELDS}
+        for counter, count in self.database.hgetall(
+                stats_key(scope, value)).items():
+            field, field_value = counter.split(':', 1)
+            if int(count) > 0 and field in stats:
+                stats[field][field_value] = int(count)
+        return stats
+
+    def replace_stats(self, counters):
+        """Replace all the statistics by `counters` (`{key: {field: n}}`)."""
+        stale = set(self.database.scan_iter(match=stats_key('*', '*')))
+        stale.add(stats_key())
+        pipe = self.database.pipeline()
+        pipe.delete(*stale)
+        for key, counts in counters.items():
+            if counts:
+                pipe.hset(key, mapping=counts)
+        pipe.execute()
+
+    def resolve_filters(self, filters, excludes):
+        """Resolve equality filters on indexed fields through the indexes.
+
+        Returns an `IndexSelection` and the remaining filters and excludes,
+        to be applied on the records themselves (see `apply_filters`).
+        """
+        filters, excludes = filters.copy(), excludes.copy()
+        filter_keys = [index_key(field, filters.pop(field))
+                       for field in INDEXED_FIELDS if field in filters]
+        exclude_keys = [index_key(field, excludes.pop(field))
+                        for field in INDEXED_FIELDS if field in excludes]
+        if not filter_keys and not exclude_keys:
+            return IndexSelection(), filters, excludes
+        pipe = self.database.pipeline(transaction=False)
+        if filter_keys:
+            pipe.sinter(filter_keys)
+        if exclude_keys:
+            pipe.sunion(exclude_keys)
+        results = pipe.execute()
+        candidates = results.pop(0) if filter_keys else None
+        excluded = results.pop(0) if exclude_keys else None
+        return IndexSelection(candidates, excluded), filters, excludes
+
+    def _iter_frequency_groups(self, frequency, command='hgetall',
+                               page_size=GROUPS_PAGE_SIZE):
+        """Yield the result of `command` for each group of `frequency`.
+
+        Groups are read through pipelined batches of `page_size`.
+        """
+        group_hashes = self.iter_registry(frequency_registry(frequency))
+        for batch in chunked(group_hashes, page_size):
+            pipe = self.database.pipeline(transaction=False)
+            for group_hash in batch:
+                getattr(pipe, command)(group_hash)
+            yield from pipe.execute()
 
     def get_frequency_urls(self, frequency='hourly'):
-        for group_hash in self.database.lrange(frequency, 0, -1):
-            group_infos = self.get_group(group_hash)
-            group_infos.pop('name')
-            group_infos.pop('url')
+        """Yield URLs of the groups checked at `frequency`, once each.
+
+        URLs shared with groups of a higher frequency are skipped,
+        given they are already checked more often.
+        """
+        seen = set()
+        if frequency in FREQUENCIES:
+            for higher in FREQUENCIES[:FREQUENCIES.index(frequency)]:
+                for url_hashes in self._iter_frequency_groups(higher,
+                                                              'hkeys'):
+                    seen.update(url_hashes)
+        for group_infos in self._iter_frequency_groups(frequency):
             for url_hash, url in group_infos.items():
+                if url_hash in ('name', 'url') or url_hash in seen:
+                    continue
+                seen.add(url_hash)
                 yield url
 
-    def is_currently_checked(self, url, delay=60*10):  # In seconds.
-        """Will look for check flag and set it if not there.
+    def is_currently_checked(self, url, delay=None):
+        """Will look for check flag and set it if not there, atomically.
 
-        The flag should be removed by `remove_check_flag` but will be removed
-        after `delay` anyhow.
+        The flag is a lease which should be released by `remove_check_flag`
+        but will expire after `delay` seconds (`CHECK_LEASE_DURATION`
+        by default) anyhow.
         """
         check_url_hash = generate_hash_for('check', url)
-        if self.database.exists(check_url_hash):
-            return True
-        else:
-            self.database.set(check_url_hash, url)
-            self.database.expire(check_url_hash, delay)
-            return False
+        acquired = self.database.set(check_url_hash, str_to_bytes(url),
+                                     nx=True, ex=delay or self.check_lease)
+        return not acquired
+
+    def acquire_check_flags(self, urls, delay=None):
+        """Set the check flags of `urls` within one round trip.
+
+        Returns the URLs which were not currently checked, see
+        `is_currently_checked`.
+        """
+        pipe = self.database.pipeline(transaction=False)
+        for url in urls:
+            pipe.set(generate_hash_for('check', url), str_to_bytes(url),
+                     nx=True, ex=delay or self.check_lease)
+        return [url for url, acquired in zip(urls, pipe.execute())
+                if acquired]
 
     def remove_check_flag(self, url):
-        check_url_hash = generate_hash_for('check', url)
-        if self.database.exists(check_url_hash):
-            self.database.delete(check_url_hash)
+        self.database.delete(generate_hash_for('check', url))
 
     def get_cache(self, key):
         return self.database.hgetall(str_to_bytes(key))
 
-    def set_cache(self, key, content):
-        self.database.hset(key, 'timestamp',
-                           str_to_bytes(datetime.now().isoformat()))
-        self.database.hset(key, 'content', str_to_bytes(content))
+    def set_cache(self, key, content, duration=None):
+        """Cache `content` under `key`, for `duration` seconds if given."""
+        pipe = self.database.pipeline()
+        pipe.hset(key, mapping={
+            'timestamp': str_to_bytes(datetime.now().isoformat()),
+            'content': str_to_bytes(content),
+        })
+        if duration:
+            pipe.expire(key, duration)
+        pipe.execute()
 
     def expire_cache(self, key, duration):
         self.database.expire(key, duration)
+
+    def get_snapshot(self, key, page_size=SNAPSHOT_PAGE_SIZE):
+        """Return the build time of the snapshot `key` and its chunks.
+
+        The time is in seconds since the epoch, `(None, None)` being
+        returned without any snapshot. Chunks are read by pages.
+        """
+        timestamp = self.database.get(key)
+        if timestamp is None:
+            return None, None
+        return float(timestamp), self._iter_chunks(
+            snapshot_key(key, timestamp), page_size)
+
+    def _iter_chunks(self, key, page_size):
+        start = 0
+        while True:
+            page = self.database.lrange(key, start, start + page_size - 1)
+            yield from page
+            if len(page) < page_size:
+                return
+            start += page_size
+
+    def append_snapshot(self, key, timestamp, chunk, duration):
+        """Append `chunk` to the snapshot `key` built since `timestamp`.
+
+        Chunks are kept twice as long as the snapshot is served, to be
+        read until the end by clients which got it before it expired.
+        """
+        chunks_key = snapshot_key(key, timestamp)
+        pipe = self.database.pipeline()
+        pipe.rpush(chunks_key, str_to_bytes(chunk))
+        pipe.expire(chunks_key, 2 * duration)
+        pipe.execute()
+
+    def publish_snapshot(self, key, timestamp, duration):
+        """Serve the snapshot `key` built at `timestamp` for `duration`."""
+        self.database.set(key, timestamp, ex=duration)
@@ -1,34 +1,120 @@
 import logging
+import math
 
+from nameko.dependency_providers import Config
 from nameko.events import EventDispatcher
 from nameko.timer import timer
 
 from .logger import LoggingDependency
 from .storages import RedisStorage
+from .tools import CHECK_BATCH_SIZE, chunked
 
 log = logging.info
+SCHEDULER_TICK = 10  # in seconds
+SCHEDULER_RATE = 50  # URLs released per second by the rolling scheduler
+ADAPTIVE_STABLE_CHECKS = 3  # stable checks before lengthening the interval
+ADAPTIVE_FACTOR = 2
+ADAPTIVE_MIN_INTERVAL = 60 * 60  # in seconds
+ADAPTIVE_MAX_INTERVAL = 60 * 60 * 24 * 7  # in seconds
+
+
+def adaptive_interval(interval, stable_checks, flaps,
+                      stable_threshold=ADAPTIVE_STABLE_CHECKS,
+                      factor=ADAPTIVE_FACTOR,
+                      min_interval=ADAPTIVE_MIN_INTERVAL,
+                      max_interval=ADAPTIVE_MAX_INTERVAL):
+    """Return `interval` adapted to the observed changes of a URL.
+
+    The interval is multiplied by `factor` for every `stable_threshold`
+    consecutive stable checks and divided by `factor` for every
+    consecutive change of status (`flaps`), within the bounds.
+    The bounds are widened to include the registered interval if needed.
+    """
+    exponent = stable_checks // stable_threshold - flaps
+    lower, upper = min(interval, min_interval), max(interval, max_interval)
+    if factor > 1 and lower > 0:
+        # Enough steps to reach either bound, without overflowing.
+        steps = math.ceil(math.log(upper / lower, factor))
+        exponent = min(max(exponent, -steps), steps)
+    else:
+        exponent = 0
+    adapted = interval * factor ** exponent
+    return int(min(max(adapted, lower), upper))
 
 
 class TimerService(object):
+    """Periodically re-check URLs registered with a frequency.
+
+    With the default `buckets` mode (`TIMER_MODE`), all the URLs of a
+    given frequency are re-checked at once every hour, day or month.
+    The `rolling` mode spreads those checks over the period instead,
+    releasing due URLs at a bounded rate (`SCHEDULER_RATE`).
+    The `adaptive` mode is a rolling one adapting the interval of each
+    URL to its observed changes (see `adaptive_interval`).
+    """
     name = 'timer'
     dispatch = EventDispatcher()
     storage = RedisStorage()
     logger = LoggingDependency()
+    config = Config()
+
+    @property
+    def rolling(self):
+        return self.config.get('TIMER_MODE', 'buckets') in ('rolling',
+                                                            'adaptive')
+
+    def _adapt(self, interval, stable_checks, flaps):
+        config = self.config
+        return adaptive_interval(
+            interval, stable_checks, flaps,
+            stable_threshold=config.get('ADAPTIVE_STABLE_CHECKS',
+                                        ADAPTIVE_STABLE_CHECKS),
+            factor=config.get('ADAPTIVE_FACTOR', ADAPTIVE_FACTOR),
+            min_interval=config.get('ADAPTIVE_MIN_INTERVAL',
+                                    ADAPTIVE_MIN_INTERVAL),
+            max_interval=config.get('ADAPTIVE_MAX_INTERVAL',
+                                    ADAPTIVE_MAX_INTERVAL))
+
+    def _dispatch_batches(self, urls):
+        batch_size = self.config.get('CHECK_BATCH_SIZE', CHECK_BATCH_SIZE)
+        for batch in chunked(urls, batch_size):
+            self.dispatch('urls_to_check', [(url, None, None)
+                                            for url in batch])
 
     @timer(60*60)
     def check_hourly(self):
+        if self.rolling:
+            return
         log('Checking hourly resources')
-        for url in self.storage.get_frequency_urls(frequency='hourly'):
-            self.dispatch('url_to_check', (url, None, None))
+        self._dispatch_batches(
+            self.storage.get_frequency_urls(frequency='hourly'))
 
     @timer(60*60*24)
     def check_daily(self):
+        if self.rolling:
+            return
         log('Checking daily resources')
-        for url in self.storage.get_frequency_urls(frequency='daily'):
-            self.dispatch('url_to_check', (url, None, None))
+        self._dispatch_batches(
+            self.storage.get_frequency_urls(frequency='daily'))
 
     @timer(60*60*24*30)
     def check_monthly(self):
+        if self.rolling:
+            return
         log('Checking monthly resources')
-        for url in self.storage.get_frequency_urls(frequency='monthly'):
-            self.dispatch('url_to_check', (url, None, None))
+        self._dispatch_batches(
+            self.storage.get_frequency_urls(frequency='monthly'))
+
+    @timer(SCHEDULER_TICK)
+    def check_due(self):
+        if not self.rolling:
+            return
+        rate = self.config.get('SCHEDULER_RATE', SCHEDULER_RATE)
+        adaptive = self.config.get('TIMER_MODE') == 'adaptive'
+        urls = self.storage.pop_due_urls(limit=int(rate * SCHEDULER_TICK),
+                                         adapt=self._adapt if adaptive
+                                         else None)
+        if not urls:
+            return
+        log('Checking {num} due resources'.format(num=len(urls)))
+        self._dispatch_batches(urls)
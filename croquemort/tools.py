@@ -1,11 +1,15 @@
+import csv
 import json
 import hashlib
 from datetime import datetime
+from io import StringIO
+from itertools import islice
 from urllib.parse import urlparse
 
 import logging
 
 log = logging.info
+CHECK_BATCH_SIZE = 100  # URLs per `urls_to_check` event
 
 # /!\ dict values should be kept unique for sanity
 HASH_PREFIXES = {
@@ -13,6 +17,9 @@ HASH_PREFIXES = {
     'group': 'g',
     'check': 'c',
     'webhook': 'w',
+    'index': 'i',
+    'buffer': 'b',
+    'snapshot': 's',
 }
 
 
@@ -36,6 +43,38 @@ def flatten_get_parameters(request):
             for k, v in dict(request.args).items()}
 
 
+def format_csv(rows):
+    """Return the CSV lines of `rows`, each one being a tuple of values."""
+    fake_file = StringIO()
+    csv.writer(fake_file).writerows(rows)
+    return fake_file.getvalue()
+
+
+def report_row(url, data):
+    """Return the CSV line of the report for the record of `url`."""
+    return format_csv([(url, data.get('final-status-code', ''),
+                        data.get('content-type', ''),
+                        data.get('updated', ''))])
+
+
+def generate_etag(*values):
+    """Return an entity tag for the (JSON serializable) `values`."""
+    serialized = json.dumps(values, sort_keys=True).encode('utf-8')
+    return hashlib.md5(serialized).hexdigest()[:16]
+
+
+def has_current_copy(request, etag):
+    """Tell whether the client of `request` has the `etag` version."""
+    etags = getattr(request, 'if_none_match', None)
+    return bool(etags) and etags.contains(etag)
+
+
+def accepts_encoding(request, encoding):
+    """Tell whether the client of `request` accepts the `encoding`."""
+    accepted = getattr(request, 'accept_encodings', None)
+    return bool(accepted) and encoding in accepted
+
+
 def _generate_hash(value):
     """Custom hash to avoid long values."""
     return hashlib.md5(value.encode('utf-8')).hexdigest()[:8]
@@ -69,36 +108,86 @@ def extract_filters(querystring_dict):
     return filters, excludes
 
 
-def apply_filters(data, filters, excludes):
-    """Return filtered data."""
-    filters = filters.copy()
-    excludes = excludes.copy()
+def extract_pagination(querystring_dict):
+    """Extracting the page size and the opaque cursor from the querystring.
+
+    Returns a `(limit, cursor)` tuple, `limit` being `None` if the
+    results are not paginated. Raises a `ValueError` if invalid.
+    """
+    limit = querystring_dict.get('limit')
+    cursor = querystring_dict.get('cursor') or 0
+    if limit is None:
+        return None, None
+    limit, cursor = int(limit), int(cursor)
+    if limit <= 0 or cursor < 0:
+        raise ValueError('limit must be positive and cursor a valid one')
+    return limit, cursor
+
+
+def compile_filters(filters, excludes):
+    """Return a predicate telling whether a record is kept by the filters.
+
+    Filters are parsed once, to be applied to many records in a row.
+    """
+    filters = dict(filters)
+    excludes = dict(excludes)
     has_domain_filter = 'domain' in filters
     has_domain_exclude = 'domain' in excludes
-    has_domain = has_domain_filter or has_domain_exclude
-    filtered_domain = (
-        has_domain_filter
-        and urlparse(data['checked-url']).netloc == filters.pop('domain'))
-    excluded_domain = (
-        has_domain_exclude
-        and urlparse(data['checked-url']).netloc == excludes.pop('domain'))
-    kept_domain = ((has_domain_filter and filtered_domain)
-                   or (has_domain_exclude and not excluded_domain))
-    has_props = all(data.get(prop) == value
-                    for prop, value in filters.items())
-    has_not_props = all(data.get(prop) != value
-                        and data.get(prop) is not None
-                        for prop, value in excludes.items()
-                        if prop in data)
-    if has_domain and not kept_domain:
-        return
-    elif filters and excludes and not has_props or not has_not_props:
-        return
-    elif filters and not has_props:
-        return
-    elif excludes and not has_not_props:
-        return
-    return data
+    domain_filter = filters.pop('domain', None)
+    domain_exclude = excludes.pop('domain', None)
+    filters = tuple(filters.items())
+    excludes = tuple(excludes.items())
+
+    def keep(data):
+        if has_domain_filter or has_domain_exclude:
+            domain = urlparse(data['checked-url']).netloc
+            if not ((has_domain_filter and domain == domain_filter)
+                    or (has_domain_exclude and domain != domain_exclude)):
+                return False
+        for prop, value in filters:
+            if data.get(prop) != value:
+                return False
+        for prop, value in excludes:
+            if prop in data and (data[prop] == value or data[prop] is None):
+                return False
+        return True
+
+    return keep
+
+
+def apply_filters(data, filters, excludes):
+    """Return filtered data."""
+    if compile_filters(filters, excludes)(data):
+        return data
+
+
+def parse_content_type(value):
+    """Split a Content-Type header value into its type and charset.
+
+    Returns a dict with a lowercased `content-type` and, if present,
+    a lowercased `charset`.
+    """
+    try:
+        content_type, charset = value.split(';')
+    except ValueError:
+        # Weird e.g.: text/html;h5ai=0.20;charset=UTF-8
+        content_type, _, charset = value.split(';')
+
+    parsed = {'content-type': content_type.strip().lower()}
+    if '=' in charset:
+        _, charset = charset.split('=')
+        parsed['charset'] = charset.strip().lower()
+    return parsed
+
+
+def chunked(iterable, size):
+    """Yield lists of (at most) `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def retrieve_datetime(datetime_isoformat):
@@ -1,11 +1,19 @@
+from collections import Counter
+from urllib.parse import urlparse
+
 import logging
-import requests
+import time
 
-from nameko.dependency_providers import Config
+import eventlet
+import requests
 from nameko.events import event_handler
-from nameko.utils.retry import retry
+from nameko.extensions import DependencyProvider
+from nameko.rpc import rpc
+from nameko.timer import timer
 
 from .logger import LoggingDependency
+from .metrics import Metrics, collector
+from .sessions import PoolStats, build_session
 from .storages import RedisStorage
 
 log = logging.info
@@ -18,6 +26,22 @@ DELAY_INTERVAL = 10  # in seconds
 NB_RETRY = 3
 # increase the retry delay by this factor at each try
 BACKOFF_FACTOR = 2
+CONCURRENCY = 100  # simultaneous webhook calls per process
+POOL_MAXSIZE = 10  # connections kept alive per callback host
+QUEUE_TICK = 1  # in seconds, between deliveries of the queue
+QUEUE_LEASE = 60 * 5  # in seconds, before a claimed delivery is requeued
+ENDPOINT_CONCURRENCY = 10  # simultaneous calls per callback endpoint
+# consecutive failures of an endpoint before delaying its deliveries
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60  # in seconds
+DEAD_LETTERS_SIZE = 10000
+BATCH_SIZE = 0  # results per call of a webhook, 0 to call it per result
+BATCH_LATENCY = 10  # in seconds, before calling a webhook with a partial batch
+
+
+def endpoint_of(url):
+    """Return the endpoint of a callback URL, subject to circuit breaking."""
+    return urlparse(url).netloc
 
 
 class WebhookUnreachableException(Exception):
@@ -29,46 +53,214 @@ class WebhookUnreachableException(Exception):
         self.original_exception = original_exception
 
 
-class WebhookService(object):
-    name = 'webhook_dispatcher'
-    storage = RedisStorage()
-    logger = LoggingDependency()
-    config = Config()
+class WebhookDelivery(DependencyProvider):
+    """Call webhooks through a pooled keep-alive session.
+
+    Calls are issued concurrently within a pool of green threads
+    (`WEBHOOK_CONCURRENCY`), at most `WEBHOOK_ENDPOINT_CONCURRENCY` at
+    a time per callback endpoint.
+    """
+
+    def setup(self):
+        super(WebhookDelivery, self).setup()
+        config = self.container.config
+        self.nb_retry = config.get('WEBHOOK_NB_RETRY', NB_RETRY)
+        self.delay = config.get('WEBHOOK_DELAY_INTERVAL', DELAY_INTERVAL)
+        self.backoff = config.get('WEBHOOK_BACKOFF_FACTOR', BACKOFF_FACTOR)
+        self.lease = config.get('WEBHOOK_QUEUE_LEASE', QUEUE_LEASE)
+        self.endpoint_concurrency = config.get('WEBHOOK_ENDPOINT_CONCURRENCY',
+                                               ENDPOINT_CONCURRENCY)
+        self.circuit_threshold = config.get('WEBHOOK_CIRCUIT_THRESHOLD',
+                                            CIRCUIT_THRESHOLD)
+        self.circuit_cooldown = config.get('WEBHOOK_CIRCUIT_COOLDOWN',
+                                           CIRCUIT_COOLDOWN)
+        self.dead_letters_size = config.get('WEBHOOK_DEAD_LETTERS_SIZE',
+                                            DEAD_LETTERS_SIZE)
+        self.batch_size = config.get('WEBHOOK_BATCH_SIZE', BATCH_SIZE)
+        self.batch_latency = config.get('WEBHOOK_BATCH_LATENCY',
+                                        BATCH_LATENCY)
+        self.concurrency = config.get('WEBHOOK_CONCURRENCY', CONCURRENCY)
+        self.pool = eventlet.GreenPool(self.concurrency)
+        self.pool_stats = PoolStats()
+        self.session = build_session(
+            pool_connections=self.concurrency,
+            pool_maxsize=config.get('WEBHOOK_POOL_MAXSIZE', POOL_MAXSIZE),
+            stats=self.pool_stats)
+        self.inflight = Counter()  # calls per endpoint
+
+    def stop(self):
+        # Unsettled deliveries would be requeued once their lease expired.
+        self.pool.waitall()
+        super(WebhookDelivery, self).stop()
 
-    def _send(self, url, metadata):
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def send(self, url, metadata):
         """POST metadata to url"""
+        start = time.perf_counter()
         try:
-            response = requests.post(url, json={'data': metadata},
-                                     timeout=TIMEOUT)
+            response = self.session.post(url, json={'data': metadata},
+                                         timeout=TIMEOUT)
         except (requests.Timeout, requests.RequestException) as e:
+            collector.inc('croquemort_webhooks_total', outcome='unreachable')
             raise WebhookUnreachableException('Unreachable', url, 503,
                                               original_exception=e)
+        finally:
+            collector.observe('croquemort_webhook_seconds',
+                              time.perf_counter() - start)
         if response.status_code < 200 or response.status_code >= 400:
+            collector.inc('croquemort_webhooks_total', outcome='failure')
             raise WebhookUnreachableException('Unreachable', url,
                                               response.status_code)
+        collector.inc('croquemort_webhooks_total', outcome='success')
         log('Successfully called webhook {url}'.format(url=url))
 
+    def retry_delay(self, attempts):
+        """Return the delay before the next attempt, `None` if exhausted."""
+        if attempts > self.nb_retry:
+            return None
+        return self.delay * self.backoff ** attempts
+
+
+class WebhookService(object):
+    """Deliver the results of the checks to their webhooks.
+
+    Deliveries are queued within Redis then made by a timer, so that
+    neither a backlog nor a failing endpoint holds the workers. A failed
+    delivery is retried `WEBHOOK_NB_RETRY` times, the delay growing from
+    `WEBHOOK_DELAY_INTERVAL` by a factor of `WEBHOOK_BACKOFF_FACTOR`,
+    before being moved to the dead letters. The deliveries to an
+    endpoint failing `WEBHOOK_CIRCUIT_THRESHOLD` times in a row are
+    delayed by `WEBHOOK_CIRCUIT_COOLDOWN` seconds (circuit breaker).
+
+    With a `WEBHOOK_BATCH_SIZE`, the results for a webhook are buffered
+    and delivered as a list, once the batch is full or its oldest result
+    has waited for `WEBHOOK_BATCH_LATENCY` seconds. The webhooks of the
+    delivered results are then unregistered.
+    """
+    name = 'webhook_dispatcher'
+    storage = RedisStorage()
+    logger = LoggingDependency()
+    metrics = Metrics()
+    delivery = WebhookDelivery()
+
     @event_handler('url_crawler', 'url_crawled')
     def send_response(self, metadata):
-        """Call a webhook with checked url results"""
+        """Queue the calls of the webhooks with checked url results"""
         url = metadata.get('checked-url')
         callback_urls = self.storage.get_webhooks_for_url(url)
         if not callback_urls:
             return
-        for callback_url in callback_urls:
+        log(('Queuing webhook urls {callback_urls} for checked url {url}'
+             .format(callback_urls=', '.join(callback_urls), url=url)))
+        batch_size = self.delivery.batch_size
+        if not batch_size:
+            self.storage.enqueue_webhooks(callback_urls, metadata)
+            return
+        for callback_url in self.storage.buffer_webhooks(
+                callback_urls, metadata, batch_size):
+            self._flush(callback_url)
+
+    def _flush(self, callback_url):
+        """Queue the results buffered for `callback_url`, by batches."""
+        batch_size = self.delivery.batch_size
+        while self.storage.flush_webhook_buffer(
+                callback_url, batch_size) >= batch_size:
+            pass
+
+    @timer(QUEUE_TICK)
+    def deliver_webhooks(self):
+        """Call the due webhooks, concurrently"""
+        if self.delivery.batch_size:
+            for callback_url in self.storage.get_expired_webhook_buffers(
+                    self.delivery.batch_latency):
+                self._flush(callback_url)
+        requeued = self.storage.requeue_expired_webhooks()
+        if requeued:
+            logging.warning('Requeued {num} expired webhook calls'.format(
+                num=len(requeued)))
+        start = time.time()
+        # Hand over to the next tick for pending deliveries to be waited.
+        while time.time() - start < QUEUE_TICK:
+            jobs = self.storage.pop_due_webhooks(
+                limit=self.delivery.concurrency, lease=self.delivery.lease)
+            if not jobs:
+                break
+            self._dispatch(jobs)
+
+    def _dispatch(self, jobs):
+        delivery = self.delivery
+        circuits = self.storage.get_open_circuits(
+            {endpoint_of(job['url']) for _, job in jobs})
+        deferred = {}
+        for job_id, job in jobs:
+            endpoint = endpoint_of(job['url'])
+            if endpoint in circuits:
+                deferred[job_id] = (job, time.time() + circuits[endpoint])
+            elif delivery.inflight[endpoint] >= delivery.endpoint_concurrency:
+                deferred[job_id] = (job, time.time() + QUEUE_TICK)
+            else:
+                delivery.inflight[endpoint] += 1
+                # Waits for a free green thread if the pool is full.
+                delivery.pool.spawn_n(self._deliver, job_id, job, endpoint)
+        self.storage.reschedule_webhooks(deferred)
+
+    def _deliver(self, job_id, job, endpoint):
+        if job.get('batch'):
+            urls = [data.get('checked-url') for data in job['data']]
+            log(('Calling webhook url {callback_url} for {num} checked urls'
+                 .format(callback_url=job['url'], num=len(urls))))
+        else:
             log(('Calling webhook url {callback_url} for checked url {url}'
-                 .format(callback_url=callback_url, url=url)))
-            try:
-                send = retry(
-                    self._send,
-                    for_exceptions=WebhookUnreachableException,
-                    max_attempts=self.config.get('WEBHOOK_NB_RETRY', NB_RETRY),
-                    delay=self.config.get('WEBHOOK_DELAY_INTERVAL',
-                                          DELAY_INTERVAL),
-                    backoff=self.config.get('WEBHOOK_BACKOFF_FACTOR',
-                                            BACKOFF_FACTOR))
-                send(callback_url, metadata)
-            except WebhookUnreachableException as e:
-                logging.error(('Webhook unreachable: {url} - {code} ({detail})'
-                               .format(url=callback_url, code=e.status,
-                                       detail=e.original_exception)))
+                 .format(callback_url=job['url'],
+                         url=job['data'].get('checked-url'))))
+        try:
+            self.delivery.send(job['url'], job['data'])
+        except WebhookUnreachableException as e:
+            self._fail(job_id, job, endpoint, e)
+        else:
+            self.storage.complete_webhooks([job_id], [endpoint])
+            if job.get('batch'):
+                self.storage.remove_webhooks(urls, job['url'])
+        finally:
+            inflight = self.delivery.inflight
+            inflight[endpoint] -= 1
+            if not inflight[endpoint]:
+                del inflight[endpoint]
+
+    def _fail(self, job_id, job, endpoint, error):
+        delivery = self.delivery
+        opened = self.storage.record_webhook_failures(
+            {endpoint: 1}, delivery.circuit_threshold,
+            delivery.circuit_cooldown)
+        if opened:
+            logging.warning(('Delaying webhook calls to {endpoint} '
+                             'for {delay}s'.format(
+                                 endpoint=endpoint,
+                                 delay=delivery.circuit_cooldown)))
+        job['attempts'] += 1
+        job['error'] = str(error.status)
+        if error.original_exception is not None:
+            job['error'] += ' ({detail})'.format(
+                detail=error.original_exception)
+        delay = delivery.retry_delay(job['attempts'])
+        if delay is None:
+            logging.error(('Webhook unreachable: {url} - {error}'
+                           .format(url=job['url'], error=job['error'])))
+            self.storage.dead_letter_webhooks([(job_id, job)],
+                                              delivery.dead_letters_size)
+            return
+        log('Retrying webhook {url} in {delay}s'.format(
+            url=job['url'], delay=delay))
+        self.storage.reschedule_webhooks({job_id: (job, time.time() + delay)})
+
+    @rpc
+    def dead_letters(self, start=0, count=100):
+        """Return the webhook calls given up, the most recent first."""
+        return self.storage.get_dead_letters(start, count)
+
+    @rpc
+    def replay_dead_letters(self, count=None):
+        """Queue again the `count` oldest calls given up (all by default)."""
+        return self.storage.replay_dead_letters(count)
@@ -71,6 +71,15 @@ def cover(ctx, html=False):
         ctx.run(cmd, pty=True)
 
 
+@task
+def bench(ctx, urls=10000, checks=1000):
+    '''Run the benchmarks against a local Redis'''
+    header(bench.__doc__)
+    cmd = 'python -m tests.benchmarks.run --urls {0} --checks {1}'
+    with ctx.cd(ROOT):
+        ctx.run(cmd.format(urls, checks), pty=True)
+
+
 @task
 def qa(ctx):
     '''Run a quality report'''
@@ -0,0 +1,95 @@
+"""A local stand-in for the remote hosts checked by the crawler.
+
+Each port served is a distinct host (domain) for the crawler. The
+behaviour of a URL is driven by its query string:
+
+- `latency`: milliseconds to wait before responding;
+- `status`: the status code of the response (200 by default);
+- `redirect`: the number of 301 redirections before the final response;
+- `nohead`: refuse HEAD requests with a 405.
+
+    $ python -m tests.benchmarks.farm --port 8800 --hosts 4
+"""
+import argparse
+import random
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlencode
+
+import eventlet
+from eventlet import wsgi
+
+DEFAULT_PORT = 8800
+# (share of the URLs, query string parameters)
+MIX = (
+    (0.85, {}),
+    (0.05, {'status': 404}),
+    (0.04, {'redirect': 1}),
+    (0.03, {'status': 500}),
+    (0.03, {'nohead': 1}),
+)
+
+
+def app(environ, start_response):
+    params = dict(parse_qsl(environ['QUERY_STRING']))
+    latency = float(params.get('latency', 0)) / 1000
+    if latency:
+        eventlet.sleep(latency)
+    if params.get('nohead') and environ['REQUEST_METHOD'] == 'HEAD':
+        start_response('405 Method Not Allowed', [('Content-Length', '0')])
+        return [b'']
+    redirect = int(params.get('redirect', 0))
+    if redirect:
+        params['redirect'] = redirect - 1
+        location = '{path}?{query}'.format(path=environ['PATH_INFO'],
+                                           query=urlencode(params))
+        start_response('301 Moved Permanently', [
+            ('Location', location), ('Content-Length', '0')])
+        return [b'']
+    status = HTTPStatus(int(params.get('status', 200)))
+    body = b'<html>croquemort</html>'
+    headers = [
+        ('Content-Type', 'text/html; charset=utf-8'),
+        ('Content-Length', str(len(body))),
+        ('ETag', '"{path}"'.format(path=environ['PATH_INFO'])),
+    ]
+    start_response('{code} {phrase}'.format(code=status.value,
+                                            phrase=status.phrase), headers)
+    return [body]
+
+
+def generate_urls(count, hosts, port=DEFAULT_PORT, latency=20, seed=42):
+    """Return `count` URLs spread over `hosts` following the `MIX`.
+
+    Latencies follow an exponential distribution of mean `latency` (ms),
+    the `seed` making the list reproducible.
+    """
+    rng = random.Random(seed)
+    shares, profiles = zip(*MIX)
+    urls = []
+    for idx in range(count):
+        params = dict(rng.choices(profiles, weights=shares)[0])
+        if latency:
+            params['latency'] = int(rng.expovariate(1 / latency))
+        urls.append('http://127.0.0.1:{port}/{idx}?{query}'.format(
+            port=port + idx % hosts, idx=idx, query=urlencode(params)))
+    return urls
+
+
+def serve(port=DEFAULT_PORT, hosts=1):
+    """Serve the farm on `hosts` consecutive ports, within green threads."""
+    for offset in range(hosts):
+        sock = eventlet.listen(('127.0.0.1', port + offset), backlog=1024)
+        eventlet.spawn_n(wsgi.server, sock, app, log_output=False,
+                         max_size=10000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--hosts', type=int, default=4)
+    args = parser.parse_args()
+    serve(args.port, args.hosts)
+    print('Serving {hosts} hosts from port {port}'.format(
+        hosts=args.hosts, port=args.port))
+    while True:
+        eventlet.sleep(60)
@@ -0,0 +1,288 @@
+"""Benchmark the crawler, the HTTP service, the CSV export and the memory.
+
+The services are driven within this process against a local Redis (the
+given database is flushed) and the hosts of a local fake web farm:
+
+    $ python -m tests.benchmarks.run --urls 100000 --checks 5000
+
+For each scenario are reported the throughput, the p50/p99 latencies
+of the operations and the number of Redis round trips per operation.
+The `memory` scenario reports the bytes used per URL by both formats
+of the records (see `COMPACT_RECORDS`).
+"""
+import eventlet
+eventlet.monkey_patch()  # noqa: as done by `nameko run`
+
+import argparse  # noqa: E402
+import socket  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from collections import namedtuple  # noqa: E402
+from itertools import islice  # noqa: E402
+
+from nameko.testing.services import worker_factory  # noqa: E402
+
+from croquemort.crawler import CrawlerService  # noqa: E402
+from croquemort.engines import CrawlerEngine  # noqa: E402
+from croquemort.http import HttpService  # noqa: E402
+from croquemort.storages import URLS_REGISTRY, RedisStorage  # noqa: E402
+from croquemort.tools import chunked, generate_hash_for  # noqa: E402
+from .farm import DEFAULT_PORT, generate_urls  # noqa: E402
+from ..utils import RoundTripCounter  # noqa: E402
+
+GROUP = 'benchmark'
+FakeResponse = namedtuple('FakeResponse',
+                          ['url', 'status_code', 'headers', 'history'])
+
+
+class Container(object):
+    """Just enough of a nameko container to set dependencies up."""
+
+    def __init__(self, config):
+        self.config = config
+
+
+def setup_dependency(provider, config):
+    provider.container = Container(config)
+    provider.setup()
+    return provider
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class Report(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, scenario, durations, elapsed, round_trips, ops=None):
+        """Add a line, `durations` being those of each request.
+
+        Throughput and round trips are per request, unless the number
+        of `ops` (e.g. exported URLs) is given.
+        """
+        ops = len(durations) if ops is None else ops
+        self.lines.append((
+            scenario, ops, elapsed, ops / elapsed if elapsed else 0,
+            percentile(durations, 50) * 1000,
+            percentile(durations, 99) * 1000,
+            round_trips / ops if ops else 0,
+        ))
+        self.display(self.lines[-1])
+
+    @staticmethod
+    def display(line):
+        print(('{:<24} {:>9} {:>9.2f}s {:>10.1f}/s '
+               'p50 {:>8.2f}ms p99 {:>8.2f}ms {:>7.2f} round trips/op'
+               ).format(*line))
+
+
+def timed(durations, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    durations.append(time.perf_counter() - start)
+    return result
+
+
+def start_farm(port, hosts):
+    farm = subprocess.Popen([sys.executable, '-m', 'tests.benchmarks.farm',
+                             '--port', str(port), '--hosts', str(hosts)],
+                            stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port + hosts - 1)).close()
+            return farm
+        except ConnectionRefusedError:
+            time.sleep(.1)
+    farm.kill()
+    raise RuntimeError('The web farm did not start')
+
+
+def bench_crawl(report, storage, config, urls, batch_size):
+    engine = setup_dependency(CrawlerEngine(), config)
+    service = worker_factory(CrawlerService, storage=storage, engine=engine)
+    durations = []
+    fetch = engine.fetch
+
+    def timed_fetch(url, previous=None):
+        response, latency = fetch(url, previous)
+        durations.append(latency)
+        return response, latency
+
+    engine.fetch = timed_fetch
+    start = time.perf_counter()
+    with RoundTripCounter(storage.database) as counter:
+        for batch in chunked(urls, batch_size):
+            service.check_urls([(url, GROUP, None) for url in batch])
+    report.add('crawl', durations, time.perf_counter() - start,
+               counter.count)
+    print('  pool stats: {stats}'.format(stats=engine.pool_stats.as_dict()))
+
+
+def seed(storage, count, offset):
+    """Register `count` checked URLs without crawling them."""
+    statuses = (200,) * 17 + (404, 500, 301)
+    start = time.perf_counter()
+    for idx in range(offset, count):
+        url = 'http://seed{domain}.example.org/{idx}'.format(
+            domain=idx % 100, idx=idx)
+        status = statuses[idx % len(statuses)]
+        storage.store_group(url, GROUP)
+        previous = storage.store_url(url)
+        storage.store_metadata(url, FakeResponse(url, status, {
+            'content-type': 'text/csv; charset=utf-8',
+            'content-length': str(idx),
+            'etag': '"{idx}"'.format(idx=idx),
+        }, []), previous=previous)
+        if idx and not idx % 10000:
+            print('  {idx} URLs seeded'.format(idx=idx))
+    print('  {count} URLs seeded in {elapsed:.2f}s'.format(
+        count=count - offset, elapsed=time.perf_counter() - start))
+
+
+def bench_http(report, storage, config, samples):
+    service = worker_factory(HttpService, storage=storage, config=config)
+    group_hash = generate_hash_for('group', GROUP)
+    url_hashes = list(islice(storage.iter_registry(URLS_REGISTRY), samples))
+    urls = [data['checked-url'] for _, data in storage.get_urls(url_hashes)]
+
+    durations = []
+    start = time.perf_counter()
+    with RoundTripCounter(storage.database) as counter:
+        for url_hash in url_hashes:
+            timed(durations, service.retrieve_url_from_hash, {}, url_hash)
+    report.add('http /url', durations, time.perf_counter() - start,
+               counter.count)
+
+    durations = []
+    start = time.perf_counter()
+    with RoundTripCounter(storage.database) as counter:
+        cursor = 0
+        while True:
+            response = timed(durations, lambda: _consume(
+                service.retrieve_group_from_hash(
+                    {'limit': 1000, 'cursor': cursor}, group_hash)))
+            cursor = int(response.headers['X-Next-Cursor'])
+            if not cursor:
+                break
+    report.add('http /group (pages)', durations, time.perf_counter() - start,
+               counter.count)
+
+    durations = []
+    start = time.perf_counter()
+    with RoundTripCounter(storage.database) as counter:
+        for batch in chunked(urls, 100):
+            timed(durations, service.check_many,
+                  {'urls': batch, 'group': GROUP})
+    report.add('http /check/many', durations, time.perf_counter() - start,
+               counter.count)
+
+
+def _consume(response):
+    """Read a streamed response like a client would."""
+    response.lines = 0
+    for chunk in response.response:
+        response.lines += chunk.count('\n' if isinstance(chunk, str)
+                                      else b'\n')
+    return response
+
+
+def bench_csv(report, storage, config):
+    service = worker_factory(HttpService, storage=storage, config=config)
+    for scenario, data in (('csv (per URL)', {}),
+                           ('csv 404 (per URL)',
+                            {'filter_final-status-code': '404'})):
+        durations = []
+        start = time.perf_counter()
+        with RoundTripCounter(storage.database) as counter:
+            response = timed(durations,
+                             lambda: _consume(service.csv_report(data)))
+        # Per exported URL, the header aside.
+        report.add(scenario, durations, time.perf_counter() - start,
+                   counter.count, ops=response.lines - 1)
+
+
+def bench_memory(config, count, samples):
+    """Compare the memory used per URL by verbose and compact records."""
+    for compact in (False, True):
+        storage = setup_dependency(RedisStorage(),
+                                   dict(config, COMPACT_RECORDS=compact))
+        storage.database.flushdb()
+        used_memory = storage.database.info('memory')['used_memory']
+        seed(storage, count, 0)
+        used_memory = storage.database.info('memory')['used_memory'] \
+            - used_memory
+        url_hashes = list(islice(storage.iter_registry(URLS_REGISTRY),
+                                 samples))
+        record_size = sum(storage.database.memory_usage(url_hash, samples=0)
+                          for url_hash in url_hashes) / len(url_hashes)
+        print(('{format:<24} {record:>9.0f} bytes/URL record '
+               '{total:>9.0f} bytes/URL overall').format(
+            format='memory ({})'.format('compact' if compact else 'verbose'),
+            record=record_size, total=used_memory / count))
+        storage.database.flushdb()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--redis-uri', default='redis://localhost:6379/15',
+                        help='Redis database to use, it will be flushed')
+    parser.add_argument('--urls', type=int, default=10000,
+                        help='number of URLs stored for the HTTP and CSV '
+                             'scenarios')
+    parser.add_argument('--checks', type=int, default=1000,
+                        help='number of URLs crawled')
+    parser.add_argument('--samples', type=int, default=1000,
+                        help='number of operations for the HTTP scenario')
+    parser.add_argument('--hosts', type=int, default=4)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=int, default=20,
+                        help='mean latency of the hosts (ms)')
+    parser.add_argument('--engine', default='green')
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--domain-rate', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--scenarios', default='crawl,http,csv',
+                        help='among crawl, http, csv and memory')
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(',')
+
+    config = {
+        'REDIS_URI': args.redis_uri,
+        'CRAWLER_ENGINE': args.engine,
+        'CRAWLER_CONCURRENCY': args.concurrency,
+        'CRAWLER_DOMAIN_RATE': args.domain_rate,
+        'CRAWLER_DOMAIN_CONCURRENCY': args.concurrency,
+        'CHECK_BATCH_SIZE': args.batch_size,
+    }
+    storage = setup_dependency(RedisStorage(), config)
+    storage.database.flushdb()
+    report = Report()
+
+    urls = generate_urls(args.checks, args.hosts, args.port, args.latency)
+    if 'crawl' in scenarios:
+        farm = start_farm(args.port, args.hosts)
+        try:
+            bench_crawl(report, storage, config, urls, args.batch_size)
+        finally:
+            farm.kill()
+    if 'http' in scenarios or 'csv' in scenarios:
+        crawled = args.checks if 'crawl' in scenarios else 0
+        seed(storage, max(args.urls, crawled), crawled)
+        if 'http' in scenarios:
+            bench_http(report, storage, config, args.samples)
+        if 'csv' in scenarios:
+            bench_csv(report, storage, config)
+    storage.database.flushdb()
+    if 'memory' in scenarios:
+        bench_memory(config, args.urls, args.samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@ from nameko.testing.utils import get_extension
 from nameko.standalone.events import event_dispatcher
 
 from croquemort.crawler import CrawlerService
+from croquemort.engines import CrawlerEngine
+from croquemort.http import HttpService
+from croquemort.sessions import CountingHTTPAdapter
 from croquemort.storages import RedisStorage
 from croquemort.tools import generate_hash_for
 from ..utils import filter_mock_requests
@@ -113,3 +116,102 @@ def test_crawling_head_offender_url(
     requests_l = filter_mock_requests(url_to_check, rmock.request_history)
     assert len(requests_l) == 1
     assert requests_l[0].method == 'GET'
+
+
+@requests_mock.Mocker(kw='rmock', real_http=True)
+def test_crawling_urls_green_engine(
+        container_factory, web_container_config, rmock=None):
+    urls_to_check = ['http://example-green.com/{idx}'.format(idx=idx)
+                     for idx in range(5)]
+    for url_to_check in urls_to_check:
+        rmock.head(url_to_check)
+    web_container_config['CRAWLER_ENGINE'] = 'green'
+    crawler_container = container_factory(CrawlerService, web_container_config)
+    storage, dispatch_dep = replace_dependencies(crawler_container, 'storage',
+                                                 'dispatch')
+    crawler_container.start()
+    dispatch = event_dispatcher(web_container_config)
+    with entrypoint_waiter(crawler_container, 'check_urls'):
+        dispatch('http_server', 'urls_to_check',
+                 [[url_to_check, None, None] for url_to_check in urls_to_check
+                  ] + [['not a url', None, None]])
+    assert storage.store_url.call_count == 5
+    assert storage.remove_check_flag.call_count == 5
+    assert storage.store_metadata.call_count == 5
+    # fired 'url_crawled' for each URL
+    assert dispatch_dep.call_count == 5
+
+
+@requests_mock.Mocker(kw='rmock', real_http=True)
+def test_crawling_retry_after(
+        container_factory, web_container_config, rmock=None):
+    url_to_check = 'http://example-busy.com/test_crawling_retry_after'
+    rmock.head(url_to_check, [
+        {'status_code': 429, 'headers': {'Retry-After': '1'}},
+        {'status_code': 200},
+    ])
+    crawler_container = container_factory(CrawlerService, web_container_config)
+    storage = replace_dependencies(crawler_container, 'storage')
+    crawler_container.start()
+    dispatch = event_dispatcher(web_container_config)
+    with entrypoint_waiter(crawler_container, 'check_url'):
+        dispatch('http_server', 'url_to_check',
+                 [url_to_check, None, None])
+    requests_l = filter_mock_requests(url_to_check, rmock.request_history)
+    assert len(requests_l) == 2
+    assert storage.store_metadata.call_count == 1
+    _, response = storage.store_metadata.call_args[0]
+    assert response.status_code == 200
+
+
+def test_crawler_session_pools(container_factory, web_container_config,
+                               web_config_port):
+    web_container_config['CRAWLER_POOL_MAXSIZE'] = 42
+    # The HTTP service stands for a remote host.
+    http_container = container_factory(HttpService, web_container_config)
+    replace_dependencies(http_container, 'storage')
+    http_container.start()
+    crawler_container = container_factory(CrawlerService, web_container_config)
+    crawler_container.start()
+    engine = get_extension(crawler_container, CrawlerEngine)
+    for scheme in ('http', 'https'):
+        adapter = engine.session.get_adapter(
+            '{scheme}://example.org'.format(scheme=scheme))
+        assert isinstance(adapter, CountingHTTPAdapter)
+        assert adapter._pool_maxsize == 42
+    url = 'http://127.0.0.1:{port}/robots.txt'.format(port=web_config_port)
+    for _ in range(3):
+        response, _ = engine.fetch(url)
+        assert response.status_code == 200
+    stats = engine.pool_stats.as_dict()
+    assert stats['checkouts'] == 3
+    assert stats['connects'] == 1
+    assert stats['tls-handshakes'] == 0
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+
+@requests_mock.Mocker(kw='rmock', real_http=True)
+def test_crawling_conditional(
+        container_factory, web_container_config, rmock=None):
+    url_to_check = 'http://example-etag.com/test_crawling_conditional'
+    rmock.head(url_to_check, status_code=304)
+    crawler_container = container_factory(CrawlerService, web_container_config)
+    storage = replace_dependencies(crawler_container, 'storage')
+    previous = {'checked-url': url_to_check, 'final-status-code': '200',
+                'etag': '"abc"', 'last-modified': ''}
+    storage.store_url.return_value = previous
+    crawler_container.start()
+    dispatch = event_dispatcher(web_container_config)
+    with entrypoint_waiter(crawler_container, 'check_url'):
+        dispatch('timer', 'url_to_check', [url_to_check, None, None])
+    requests_l = filter_mock_requests(url_to_check, rmock.request_history)
+    assert len(requests_l) == 1
+    assert requests_l[0].headers['If-None-Match'] == '"abc"'
+    assert 'If-Modified-Since' not in requests_l[0].headers
+    _, response = storage.store_metadata.call_args[0]
+    assert response.status_code == 304
+    assert storage.store_metadata.call_args[1]['previous'] == previous
+    assert storage.store_metadata.call_args[1]['latency'] >= 0
+    engine = get_extension(crawler_container, CrawlerEngine)
+    assert engine.check_stats == {'conditional': 1, 'not-modified': 1}
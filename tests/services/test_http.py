@@ -1,14 +1,25 @@
 import json
+import time
 from mock import ANY
 
 from nameko.testing.services import replace_dependencies
 
 from croquemort.http import HttpService
+from ..utils import get_urls_from
+
+
+def replace_storage(container):
+    """Replace the storage, without any group version, cache nor snapshot."""
+    storage = replace_dependencies(container, 'storage')
+    storage.get_group_version.return_value = 0
+    storage.get_cache.return_value = {}
+    storage.get_snapshot.return_value = None, None
+    return storage
 
 
 def test_retrieve_url(container_factory, web_session, web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     storage.get_url = lambda url_hash: {'url': url_hash}
     http_container.start()
     rv = web_session.get('/url', data=json.dumps({
@@ -21,7 +32,7 @@ def test_retrieve_url(container_factory, web_session, web_container_config):
 def test_retrieve_url_with_group(
         container_factory, web_session, web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     storage.get_url = lambda url_hash: {
         'url': url_hash,
         'group': 'datagouvfr'
@@ -34,15 +45,49 @@ def test_retrieve_url_with_group(
     assert rv.json()['group'] == 'datagouvfr'
 
 
+def test_retrieve_url_not_modified(
+        container_factory, web_session, web_container_config):
+    http_container = container_factory(HttpService, web_container_config)
+    storage = replace_storage(http_container)
+    storage.get_url = lambda url_hash: {'url': url_hash}
+    http_container.start()
+    rv = web_session.get('/url/u:9c01c218')
+    assert rv.headers['Cache-Control'] == 'no-cache'
+    etag = rv.headers['ETag']
+    rv = web_session.get('/url/u:9c01c218', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.headers['ETag'] == etag
+    storage.get_url = lambda url_hash: {'url': url_hash, 'group': 'g:1'}
+    rv = web_session.get('/url/u:9c01c218', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_retrieve_history(
+        container_factory, web_session, web_container_config):
+    http_container = container_factory(HttpService, web_container_config)
+    storage = replace_storage(http_container)
+    storage.get_history = lambda url_hash: [{'final-status-code': 404}]
+    http_container.start()
+    rv = web_session.get('/history', data=json.dumps({
+        'url': 'http://example.org/test_retrieve_url'
+    }))
+    assert rv.json()['url-hash'] == 'u:9c01c218'
+    assert rv.json()['history'] == [{'final-status-code': 404}]
+    storage.get_history = lambda url_hash: []
+    rv = web_session.get('/history/u:9c01c218')
+    assert rv.status_code == 404
+
+
 def test_retrieve_group(container_factory, web_session, web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     storage.get_group = lambda group_hash: {
         'url': group_hash,
         'name': 'datagouvfr',
         'url_hash': 'url'
     }
-    storage.get_url = lambda url_hash: {'url': url_hash}
+    storage.get_urls = get_urls_from(lambda url_hash: {'url': url_hash})
     http_container.start()
     rv = web_session.get('/group', data=json.dumps({
         'group': 'datagouvfr'
@@ -55,7 +100,7 @@ def test_retrieve_group(container_factory, web_session, web_container_config):
 def test_retrieve_group_filtered(
         container_factory, web_session, web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     storage.get_group = lambda group_hash: {
         'url': group_hash,
         'name': 'datagouvfr',
@@ -69,7 +114,7 @@ def test_retrieve_group_filtered(
             result['metadata'] = 'meta'
         return result
 
-    storage.get_url = get_url
+    storage.get_urls = get_urls_from(get_url)
     http_container.start()
     rv = web_session.get('/group', data=json.dumps({
         'group': 'datagouvfr',
@@ -84,7 +129,7 @@ def test_retrieve_group_filtered(
 def test_retrieve_group_excluded(
         container_factory, web_session, web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     storage.get_group = lambda group_hash: {
         'url': group_hash,
         'name': 'datagouvfr',
@@ -98,7 +143,7 @@ def test_retrieve_group_excluded(
             result['metadata'] = 'meta'
         return result
 
-    storage.get_url = get_url
+    storage.get_urls = get_urls_from(get_url)
     http_container.start()
     rv = web_session.get('/group', data=json.dumps({
         'group': 'datagouvfr',
@@ -113,7 +158,7 @@ def test_retrieve_group_excluded(
 def test_retrieve_group_excluded_empty(
         container_factory, web_session, web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     storage.get_group = lambda group_hash: {
         'url': group_hash,
         'name': 'datagouvfr',
@@ -127,7 +172,7 @@ def test_retrieve_group_excluded_empty(
             result['metadata'] = ''
         return result
 
-    storage.get_url = get_url
+    storage.get_urls = get_urls_from(get_url)
     http_container.start()
     rv = web_session.get('/group', data=json.dumps({
         'group': 'datagouvfr',
@@ -139,6 +184,152 @@ def test_retrieve_group_excluded_empty(
     assert 'url_hash2' in result['urls'][0].values()
 
 
+def test_retrieve_group_paginated(
+        container_factory, web_session, web_container_config):
+    http_container = container_factory(HttpService, web_container_config)
+    storage = replace_storage(http_container)
+    storage.get_group_name = lambda group_hash: 'datagouvfr'
+    storage.scan_group = lambda group_hash, cursor, limit: (
+        42, ['url_hash{idx}'.format(idx=cursor + idx) for idx in range(limit)])
+    storage.get_urls = get_urls_from(lambda url_hash: {'url': url_hash})
+    http_container.start()
+    rv = web_session.get('/group', data=json.dumps({
+        'group': 'datagouvfr',
+        'limit': 2,
+        'cursor': '10',
+    }))
+    result = rv.json()
+    assert result['name'] == 'datagouvfr'
+    assert result['next-cursor'] == '42'
+    assert rv.headers['X-Next-Cursor'] == '42'
+    assert [url['url'] for url in result['urls']] == ['url_hash10',
+                                                      'url_hash11']
+    rv = web_session.get('/group', data=json.dumps({
+        'group': 'datagouvfr',
+        'limit': 'foo',
+    }))
+    assert rv.status_code == 400
+
+
+def test_retrieve_group_cached(
+        container_factory, web_session, web_container_config):
+    http_container = container_factory(HttpService, web_container_config)
+    storage = replace_storage(http_container)
+    storage.get_group = lambda group_hash: {
+        'url': group_hash,
+        'name': 'datagouvfr',
+        'url_hash': 'url'
+    }
+    storage.get_urls = get_urls_from(lambda url_hash: {'url': url_hash})
+    http_container.start()
+    rv = web_session.get('/group/g:1')
+    etag = rv.headers['ETag']
+    key, content, ttl = storage.set_cache.call_args[0]
+    assert key.endswith(etag.strip('"'))
+    assert json.loads(content) == rv.json()
+    assert ttl == 300
+    rv = web_session.get('/group/g:1', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    # A new version of the group is served, from the cache if any.
+    storage.get_group_version.return_value = 1
+    storage.get_cache.return_value = {'content': '{"name": "cached"}'}
+    rv = web_session.get('/group/g:1', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.json() == {'name': 'cached'}
+    assert rv.headers['ETag'] != etag
+
+
+def test_retrieve_group_snapshot(
+        container_factory, web_session, web_container_config):
+    http_container = container_factory(HttpService, web_container_config)
+    storage = replace_storage(http_container)
+    storage.get_group = lambda group_hash: {
+        'url': group_hash,
+        'name': 'datagouvfr',
+        'url_hash': 'url'
+    }
+    storage.get_urls = get_urls_from(lambda url_hash: {'url': url_hash})
+    http_container.start()
+    rv = web_session.get('/group/g:1?stale_by=60')
+    assert rv.headers['Age'] == '0'
+    assert 'ETag' not in rv.headers
+    key, timestamp, content, stale_by = storage.append_snapshot.call_args[0]
+    assert json.loads(content) == rv.json()
+    assert stale_by == 60
+    storage.publish_snapshot.assert_called_once_with(key, timestamp, 60)
+    assert not storage.set_cache.called
+    # Then served within the `stale_by` bound.
+    storage.get_snapshot.return_value = time.time(), iter(
+        ['{"name": ', '"snapshot"}'])
+    rv = web_session.get('/group/g:1?stale_by=60')
+    assert rv.json() == {'name': 'snapshot'}
+    assert int(rv.headers['Age']) <= 60
+    rv = web_session.get('/group/g:1?stale_by=foo')
+    assert rv.status_code == 400
+
+
+def test_csv_report(container_factory, web_session, web_container_config):
+    web_container_config['CSV_CHUNK_SIZE'] = 10
+    http_container = container_factory(HttpService, web_container_config)
+    storage = replace_storage(http_container)
+    rows = ['http://example.org/1,200,text/csv,2017-07-10T12:50:20\r\n',
+            'http://example.org/2,404,,2017-07-10T12:50:21\r\n']
+    storage.iter_report = lambda: iter(rows)
+    http_container.start()
+    rv = web_session.get('/csv', headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert rv.text.splitlines() == [
+        'URL,Status,Content-Type,Updated',
+        'http://example.org/1,200,text/csv,2017-07-10T12:50:20',
+        'http://example.org/2,404,,2017-07-10T12:50:21',
+    ]
+    assert 'Age' not in rv.headers
+    assert not storage.append_snapshot.called
+    # A snapshot is built by chunks, then served within `stale_by`.
+    rv = web_session.get('/csv?stale_by=60')
+    assert rv.headers['Age'] == '0'
+    key, timestamp, _ = storage.publish_snapshot.call_args[0]
+    assert [call[0] for call in storage.append_snapshot.call_args_list] == [
+        (key, timestamp, row, 60) for row in rows]
+    storage.get_snapshot.return_value = time.time(), iter([
+        'http://example.org/1,200,text/csv,2017-07-10\r\n'])
+    storage.iter_report = lambda: iter([])
+    rv = web_session.get('/csv?stale_by=60')
+    assert rv.text.splitlines()[1:] == [
+        'http://example.org/1,200,text/csv,2017-07-10']
+    assert int(rv.headers['Age']) <= 60
+
+
+def test_stats(container_factory, web_session, web_container_config):
+    http_container = container_factory(HttpService, web_container_config)
+    storage = replace_storage(http_container)
+    storage.get_stats.side_effect = lambda *scope: {
+        'final-status-code': {'200': 2, '404': 1},
+        'content-type': {'text/csv': 3},
+    }
+    http_container.start()
+    rv = web_session.get('/stats')
+    assert rv.json()['urls'] == 3
+    assert rv.json()['final-status-code'] == {'200': 2, '404': 1}
+    storage.get_stats.assert_called_with()
+    web_session.get('/stats?group=datagouvfr')
+    storage.get_stats.assert_called_with('group', 'g:efcf3897')
+    web_session.get('/stats?domain=example.org')
+    storage.get_stats.assert_called_with('domain', 'example.org')
+
+
+def test_metrics(container_factory, web_session, web_container_config):
+    http_container = container_factory(HttpService, web_container_config)
+    replace_dependencies(http_container, 'storage')
+    http_container.start()
+    web_session.get('/robots.txt')
+    rv = web_session.get('/metrics')
+    assert rv.headers['Content-Type'].startswith('text/plain')
+    assert '# TYPE croquemort_worker_seconds histogram' in rv.text
+    assert ('croquemort_worker_seconds_count{method="robots_txt",'
+            'service="http_server",status="completed"} 1') in rv.text
+
+
 def test_checking_one(container_factory, web_session, web_container_config):
     http_container = container_factory(HttpService, web_container_config)
     dispatch = replace_dependencies(http_container, 'dispatch')
@@ -153,7 +344,7 @@ def test_checking_one(container_factory, web_session, web_container_config):
 def test_checking_one_webhook(container_factory, web_session,
                               web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     http_container.start()
     web_session.post('/check/one', data=json.dumps({
         'url': 'http://example.org/test_checking_one',
@@ -165,7 +356,7 @@ def test_checking_one_webhook(container_factory, web_session,
 def test_checking_one_webhook_wrong_url(container_factory, web_session,
                                         web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     http_container.start()
     web_session.post('/check/one', data=json.dumps({
         'url': 'http://example.org/test_checking_one',
@@ -186,13 +377,45 @@ def test_checking_many(container_factory, web_session, web_container_config):
         'group': 'datagouvfr'
     }))
     assert rv.json()['group-hash'] == 'g:efcf3897'
-    assert dispatch.call_count == 2
+    # A single batch for both URLs.
+    assert dispatch.call_count == 1
+    event_type, urls_groups_frequencies = dispatch.call_args[0]
+    assert event_type == 'urls_to_check'
+    assert urls_groups_frequencies == [
+        ('http://example.org/test_checking_many', 'datagouvfr', None),
+        ('http://example.com/test_checking_many', 'datagouvfr', None),
+    ]
+
+
+def test_checking_many_batches(container_factory, web_session,
+                               web_container_config):
+    web_container_config['CHECK_BATCH_SIZE'] = 2
+    http_container = container_factory(HttpService, web_container_config)
+    dispatch = replace_dependencies(http_container, 'dispatch')
+    http_container.start()
+    urls = ['http://example.org/test_checking_many_batches/{idx}'.format(
+        idx=idx) for idx in range(5)]
+    web_session.post('/check/many', data=json.dumps({
+        'urls': urls + urls,
+        'group': 'datagouvfr'
+    }))
+    # Deduplicated then dispatched by batches.
+    assert dispatch.call_count == 3
+    checked = [url for call in dispatch.call_args_list
+               for url, _, _ in call[0][1]]
+    assert checked == urls
+    # Checks in progress are not dispatched again.
+    web_session.post('/check/many', data=json.dumps({
+        'urls': urls,
+        'group': 'datagouvfr'
+    }))
+    assert dispatch.call_count == 3
 
 
 def test_checking_many_webhook(container_factory, web_session,
                                web_container_config):
     http_container = container_factory(HttpService, web_container_config)
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     http_container.start()
     web_session.post('/check/many', data=json.dumps({
         'urls': [
@@ -202,7 +425,10 @@ def test_checking_many_webhook(container_factory, web_session,
         'callback_url': 'http://example.org/cb',
         'group': 'datagouvfr'
     }))
-    assert storage.store_webhook.call_count == 2
+    assert storage.store_webhooks.call_count == 1
+    urls, callback_url = storage.store_webhooks.call_args[0]
+    assert len(urls) == 2
+    assert callback_url == 'http://example.org/cb'
 
 
 def test_fetching(container_factory, rpc_proxy_factory, web_container_config):
@@ -218,7 +444,7 @@ def test_fetching_w_webhook(container_factory, rpc_proxy_factory,
                             web_container_config):
     http_container = container_factory(HttpService, web_container_config)
     http_server = rpc_proxy_factory('http_server')
-    storage = replace_dependencies(http_container, 'storage')
+    storage = replace_storage(http_container)
     http_container.start()
     http_server.fetch('http://example.org/test_fetching',
                       callback_url='http://example.org/cb')
@@ -0,0 +1,158 @@
+from nameko.testing.services import worker_factory
+from nameko.testing.utils import get_extension
+
+from croquemort.migrations import MigrationsService
+from croquemort.storages import (
+    REPORT, SCHEDULE, URLS_REGISTRY, RedisStorage, frequency_registry,
+    index_key, stats_key
+)
+from croquemort.tools import generate_hash_for
+
+
+def test_migrate_lists_to_registries(container_factory, web_container_config):
+    container = container_factory(MigrationsService, web_container_config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    storage.database.rpush('urls', 'u:00000001', 'u:00000002')
+    storage.database.rpush('hourly', 'g:00000001')
+    service = worker_factory(MigrationsService, storage=storage)
+    service.migrate_lists_to_registries()
+    # Should be idempotent.
+    service.migrate_lists_to_registries()
+    assert (storage.database.zrange(URLS_REGISTRY, 0, -1)
+            == ['u:00000001', 'u:00000002'])
+    assert (storage.database.zrange(frequency_registry('hourly'), 0, -1)
+            == ['g:00000001'])
+    assert not storage.database.exists('urls')
+    assert not storage.database.exists('hourly')
+
+
+def test_migrate_from_1_to_2(container_factory, web_container_config):
+    container = container_factory(MigrationsService, web_container_config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    storage.database.rpush('urls', '00000001')
+    storage.database.hset('00000001', mapping={
+        'url': 'http://example.org/test_migrate_from_1_to_2',
+        'status': '404',
+    })
+    service = worker_factory(MigrationsService, storage=storage)
+    service.migrate_from_1_to_2()
+    assert storage.database.zrange(URLS_REGISTRY, 0, -1) == ['u:00000001']
+    assert storage.database.hgetall('u:00000001') == {
+        'checked-url': 'http://example.org/test_migrate_from_1_to_2',
+        'final-status-code': '404',
+    }
+    assert not storage.database.exists('urls')
+    assert not storage.database.exists('00000001')
+
+
+def test_build_indexes(container_factory, web_container_config):
+    container = container_factory(MigrationsService, web_container_config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    storage.database.zadd(URLS_REGISTRY, {'u:00000001': 1})
+    storage.database.hset('u:00000001', mapping={
+        'checked-url': 'http://example.org/test_build_indexes',
+        'final-status-code': '404',
+        'content-type': 'text/csv',
+    })
+    service = worker_factory(MigrationsService, storage=storage)
+    service.build_indexes()
+    for field, value in (('final-status-code', '404'),
+                         ('content-type', 'text/csv'),
+                         ('domain', 'example.org')):
+        assert storage.database.smembers(
+            index_key(field, value)) == {'u:00000001'}
+
+
+def test_build_report(container_factory, web_container_config):
+    container = container_factory(MigrationsService, web_container_config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    storage.database.zadd(URLS_REGISTRY, {'u:00000001': 1, 'u:00000002': 2})
+    storage.database.hset('u:00000001', mapping={
+        'checked-url': 'http://example.org/test_build_report',
+        'final-status-code': '404',
+        'content-type': 'text/csv',
+        'updated': '2017-07-10T12:50:20.219819',
+    })
+    storage.database.hset('u:00000002', mapping={
+        'checked-url': 'http://example.org/unchecked',
+    })
+    service = worker_factory(MigrationsService, storage=storage)
+    service.build_report()
+    assert storage.database.hgetall(REPORT) == {
+        'u:00000001': ('http://example.org/test_build_report,404,text/csv,'
+                       '2017-07-10T12:50:20.219819\r\n'),
+    }
+
+
+def test_build_stats(container_factory, web_container_config):
+    container = container_factory(MigrationsService, web_container_config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    storage.database.zadd(URLS_REGISTRY, {'u:00000001': 1, 'u:00000002': 2})
+    storage.database.hset('u:00000001', mapping={
+        'checked-url': 'http://example.org/test_build_stats',
+        'final-status-code': '404',
+        'content-type': 'text/csv',
+        'group': 'g:00000001',
+    })
+    storage.database.hset('u:00000002', mapping={
+        'checked-url': 'http://example.org/unchecked',
+    })
+    storage.database.hset(stats_key('domain', 'example.com'), 'foo', 1)
+    service = worker_factory(MigrationsService, storage=storage)
+    service.build_stats()
+    # Should be idempotent.
+    service.build_stats()
+    expected = {'final-status-code': {'404': 1},
+                'content-type': {'text/csv': 1}}
+    assert storage.get_stats() == expected
+    assert storage.get_stats('group', 'g:00000001') == expected
+    assert storage.get_stats('domain', 'example.org') == expected
+    assert not storage.database.exists(stats_key('domain', 'example.com'))
+
+
+def test_encode_records(container_factory, web_container_config):
+    web_container_config['COMPACT_RECORDS'] = True
+    container = container_factory(MigrationsService, web_container_config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    storage.database.zadd(URLS_REGISTRY, {'u:00000001': 1})
+    record = {
+        'checked-url': 'http://example.org/test_encode_records',
+        'final-status-code': '404',
+        'content-type': 'text/csv',
+        'etag': '',
+    }
+    storage.database.hset('u:00000001', mapping=record)
+    service = worker_factory(MigrationsService, storage=storage)
+    service.encode_records()
+    # Should be idempotent.
+    service.encode_records()
+    assert storage.database.hgetall('u:00000001') == {
+        'u': 'http://example.org/test_encode_records',
+        's': '404',
+        't': 'text/csv',
+    }
+    assert storage.get_url('u:00000001')['etag'] == ''
+
+
+def test_schedule_frequencies(container_factory, web_container_config):
+    container = container_factory(MigrationsService, web_container_config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    url = 'http://example.org/test_schedule_frequencies'
+    url_hash = generate_hash_for('url', url)
+    for group, frequency in (('group1', 'hourly'), ('group2', 'daily')):
+        storage.store_group(url, group)
+        storage.database.zadd(frequency_registry(frequency),
+                              {generate_hash_for('group', group): 1})
+    service = worker_factory(MigrationsService, storage=storage)
+    service.schedule_frequencies()
+    # Should be idempotent.
+    service.schedule_frequencies()
+    assert storage.database.zrange(SCHEDULE, 0, -1) == [url_hash]
+    assert storage.database.hget(url_hash, 'interval') == str(60 * 60)
@@ -0,0 +1,57 @@
+from nameko.testing.services import worker_factory
+
+from croquemort.timer import TimerService, adaptive_interval
+
+
+def test_buckets_mode():
+    service = worker_factory(TimerService)
+    service.config = {}
+    service.storage.get_frequency_urls.return_value = ['http://example.org']
+    service.check_hourly()
+    service.check_due()
+    service.dispatch.assert_called_once_with(
+        'urls_to_check', [('http://example.org', None, None)])
+    assert not service.storage.pop_due_urls.called
+
+
+def test_rolling_mode():
+    service = worker_factory(TimerService)
+    service.config = {'TIMER_MODE': 'rolling', 'SCHEDULER_RATE': 2,
+                      'CHECK_BATCH_SIZE': 2}
+    urls = ['http://example.org/{idx}'.format(idx=idx) for idx in range(3)]
+    service.storage.pop_due_urls.return_value = urls
+    service.check_hourly()
+    service.check_due()
+    assert not service.storage.get_frequency_urls.called
+    service.storage.pop_due_urls.assert_called_once_with(limit=20, adapt=None)
+    assert [call[0] for call in service.dispatch.call_args_list] == [
+        ('urls_to_check', [(urls[0], None, None), (urls[1], None, None)]),
+        ('urls_to_check', [(urls[2], None, None)]),
+    ]
+
+
+def test_adaptive_mode():
+    service = worker_factory(TimerService)
+    service.config = {'TIMER_MODE': 'adaptive', 'ADAPTIVE_FACTOR': 3}
+    service.storage.pop_due_urls.return_value = []
+    service.check_due()
+    adapt = service.storage.pop_due_urls.call_args[1]['adapt']
+    assert adapt(60 * 60 * 24, 3, 0) == 60 * 60 * 24 * 3
+
+
+def test_adaptive_interval():
+    day = 60 * 60 * 24
+    assert adaptive_interval(day, 0, 0) == day
+    assert adaptive_interval(day, 2, 0) == day
+    assert adaptive_interval(day, 3, 0) == 2 * day
+    assert adaptive_interval(day, 7, 0) == 4 * day
+    assert adaptive_interval(day, 100, 0) == 7 * day
+    assert adaptive_interval(day, 0, 1) == day / 2
+    assert adaptive_interval(day, 0, 100) == 60 * 60
+    # Bounds never apply against the registered interval.
+    assert adaptive_interval(60, 0, 1) == 60
+    assert adaptive_interval(30 * day, 3, 0) == 30 * day
+    # Large counters are clamped to the bounds.
+    assert adaptive_interval(day, 10 ** 6, 0) == 7 * day
+    assert adaptive_interval(day, 0, 10 ** 6) == 60 * 60
+    assert adaptive_interval(day, 10 ** 6, 0, factor=1.5) == 7 * day
@@ -1,11 +1,25 @@
+import eventlet
 import requests
 import requests_mock
 
 from nameko.standalone.events import event_dispatcher
-from nameko.testing.services import entrypoint_waiter, replace_dependencies
+from nameko.testing.services import entrypoint_waiter
+from nameko.testing.utils import get_extension
 
-from croquemort.webhook import WebhookService
-from ..utils import filter_mock_requests
+from croquemort.sessions import CountingHTTPAdapter
+from croquemort.storages import RedisStorage
+from croquemort.webhook import WebhookDelivery, WebhookService
+from ..utils import filter_mock_requests, wait_for
+
+
+def start_webhook_service(container_factory, config, test_url, cb_urls):
+    """Start the service, with `cb_urls` registered for `test_url`."""
+    container = container_factory(WebhookService, config)
+    container.start()
+    storage = get_extension(container, RedisStorage)
+    for cb_url in cb_urls:
+        storage.store_webhook(test_url, cb_url)
+    return container, storage
 
 
 @requests_mock.Mocker(kw='rmock', real_http=True)
@@ -13,20 +27,22 @@ def test_webhook_valid_call(
         web_container_config, container_factory, rmock=None):
     test_url = 'http://example.org'
     test_cb_url = 'http://example.org/cb'
-    container = container_factory(WebhookService, web_container_config)
-    storage = replace_dependencies(container, 'storage')
-    storage.get_webhooks_for_url = lambda url: [test_cb_url]
-    container.start()
+    container, storage = start_webhook_service(
+        container_factory, web_container_config, test_url, [test_cb_url])
     dispatch = event_dispatcher(web_container_config)
     rmock.post(test_cb_url, text='xxx')
     with entrypoint_waiter(container, 'send_response'):
         dispatch('url_crawler', 'url_crawled', {'checked-url': test_url})
+    # Calls are queued then delivered by a timer.
+    assert wait_for(lambda: filter_mock_requests(
+        test_cb_url, rmock.request_history))
     requests_l = filter_mock_requests(test_cb_url, rmock.request_history)
     assert len(requests_l) == 1
     request = requests_l[0]
     assert request.method == 'POST'
     assert request.url == test_cb_url
     assert request.json() == {'data': {'checked-url': test_url}}
+    assert wait_for(lambda: not storage.database.exists('webhook-jobs'))
 
 
 @requests_mock.Mocker(kw='rmock', real_http=True)
@@ -36,17 +52,16 @@ def test_webhook_retry(
     test_cb_url = 'http://example.org/cb'
     web_container_config['WEBHOOK_DELAY_INTERVAL'] = 1
     web_container_config['WEBHOOK_BACKOFF_FACTOR'] = 1
-    container = container_factory(WebhookService, web_container_config)
-    storage = replace_dependencies(container, 'storage')
-    storage.get_webhooks_for_url = lambda url: [test_cb_url]
-    container.start()
+    container, _ = start_webhook_service(
+        container_factory, web_container_config, test_url, [test_cb_url])
     dispatch = event_dispatcher(web_container_config)
     # 1 failed response and then a valid one
     rmock.post(test_cb_url, [{'status_code': 404}, {'status_code': 200}])
     with entrypoint_waiter(container, 'send_response'):
         dispatch('url_crawler', 'url_crawled', {'checked-url': test_url})
+    assert wait_for(lambda: len(filter_mock_requests(
+        test_cb_url, rmock.request_history)) == 2)
     requests_l = filter_mock_requests(test_cb_url, rmock.request_history)
-    assert len(requests_l) == 2
     request = requests_l[-1]
     assert request.method == 'POST'
     assert request.url == test_cb_url
@@ -60,18 +75,17 @@ def test_webhook_timeout_retry(
     test_cb_url = 'http://example.org/cb'
     web_container_config['WEBHOOK_DELAY_INTERVAL'] = 1
     web_container_config['WEBHOOK_BACKOFF_FACTOR'] = 1
-    container = container_factory(WebhookService, web_container_config)
-    storage = replace_dependencies(container, 'storage')
-    storage.get_webhooks_for_url = lambda url: [test_cb_url]
-    container.start()
+    container, _ = start_webhook_service(
+        container_factory, web_container_config, test_url, [test_cb_url])
     dispatch = event_dispatcher(web_container_config)
     # 1 failed response and then a valid one
     rmock.post(test_cb_url, [{'exc': requests.exceptions.ConnectTimeout},
                              {'status_code': 200}])
     with entrypoint_waiter(container, 'send_response'):
         dispatch('url_crawler', 'url_crawled', {'checked-url': test_url})
+    assert wait_for(lambda: len(filter_mock_requests(
+        test_cb_url, rmock.request_history)) == 2)
     requests_l = filter_mock_requests(test_cb_url, rmock.request_history)
-    assert len(requests_l) == 2
     request = requests_l[-1]
     assert request.method == 'POST'
     assert request.url == test_cb_url
@@ -84,18 +98,104 @@ def test_webhook_multiple_urls(
     test_url = 'http://example.org'
     test_cb_url = 'http://example.org/cb'
     test_cb_url_2 = 'http://example.org/cb2'
-    container = container_factory(WebhookService, web_container_config)
-    storage = replace_dependencies(container, 'storage')
-    storage.get_webhooks_for_url = lambda url: [test_cb_url, test_cb_url_2]
-    container.start()
+    container, _ = start_webhook_service(
+        container_factory, web_container_config, test_url,
+        [test_cb_url, test_cb_url_2])
     dispatch = event_dispatcher(web_container_config)
     rmock.post(test_cb_url, text='xxx')
     rmock.post(test_cb_url_2, text='xxx')
     with entrypoint_waiter(container, 'send_response'):
         dispatch('url_crawler', 'url_crawled', {'checked-url': test_url})
+    assert wait_for(lambda: len(filter_mock_requests(
+        test_cb_url, rmock.request_history)) == 2)
     requests_l = filter_mock_requests(test_cb_url, rmock.request_history)
-    assert len(requests_l) == 2
+    assert {request.url for request in requests_l} == {
+        test_cb_url, test_cb_url_2}
     for request in requests_l:
         assert request.method == 'POST'
-        assert request.url == test_cb_url or test_cb_url_2
         assert request.json() == {'data': {'checked-url': test_url}}
+
+
+@requests_mock.Mocker(kw='rmock', real_http=True)
+def test_webhook_dead_letters(web_container_config, container_factory,
+                              rpc_proxy_factory, rmock=None):
+    test_url = 'http://example.org'
+    test_cb_url = 'http://example.org/cb'
+    web_container_config['WEBHOOK_NB_RETRY'] = 0
+    container, _ = start_webhook_service(
+        container_factory, web_container_config, test_url, [test_cb_url])
+    webhook_dispatcher = rpc_proxy_factory('webhook_dispatcher')
+    dispatch = event_dispatcher(web_container_config)
+    rmock.post(test_cb_url, [{'status_code': 500}, {'status_code': 200}])
+    with entrypoint_waiter(container, 'send_response'):
+        dispatch('url_crawler', 'url_crawled', {'checked-url': test_url})
+    assert wait_for(lambda: webhook_dispatcher.dead_letters())
+    dead_letter, = webhook_dispatcher.dead_letters()
+    assert dead_letter['url'] == test_cb_url
+    assert dead_letter['data'] == {'checked-url': test_url}
+    assert dead_letter['attempts'] == 1
+    assert dead_letter['error'].startswith('500')
+    assert webhook_dispatcher.replay_dead_letters() == 1
+    assert wait_for(lambda: len(filter_mock_requests(
+        test_cb_url, rmock.request_history)) == 2)
+    assert webhook_dispatcher.dead_letters() == []
+
+
+@requests_mock.Mocker(kw='rmock', real_http=True)
+def test_webhook_circuit_breaker(
+        web_container_config, container_factory, rmock=None):
+    test_url = 'http://example.org'
+    test_cb_url = 'http://example.org/cb'
+    web_container_config['WEBHOOK_DELAY_INTERVAL'] = 1
+    web_container_config['WEBHOOK_BACKOFF_FACTOR'] = 1
+    web_container_config['WEBHOOK_CIRCUIT_THRESHOLD'] = 1
+    container, storage = start_webhook_service(
+        container_factory, web_container_config, test_url, [test_cb_url])
+    dispatch = event_dispatcher(web_container_config)
+    rmock.post(test_cb_url, status_code=503)
+    with entrypoint_waiter(container, 'send_response'):
+        dispatch('url_crawler', 'url_crawled', {'checked-url': test_url})
+    assert wait_for(lambda: storage.get_open_circuits(['example.org']))
+    # The retry is delayed until the circuit is closed.
+    eventlet.sleep(3)
+    assert len(filter_mock_requests(test_cb_url, rmock.request_history)) == 1
+
+
+@requests_mock.Mocker(kw='rmock', real_http=True)
+def test_webhook_batches(
+        web_container_config, container_factory, rmock=None):
+    test_urls = ['http://example.org/{idx}'.format(idx=idx)
+                 for idx in range(3)]
+    test_cb_url = 'http://example.org/cb'
+    web_container_config['WEBHOOK_BATCH_SIZE'] = 2
+    web_container_config['WEBHOOK_BATCH_LATENCY'] = 1
+    container, storage = start_webhook_service(
+        container_factory, web_container_config, test_urls[0], [test_cb_url])
+    storage.store_webhooks(test_urls, test_cb_url)
+    dispatch = event_dispatcher(web_container_config)
+    rmock.post(test_cb_url, text='xxx')
+    for test_url in test_urls:
+        with entrypoint_waiter(container, 'send_response'):
+            dispatch('url_crawler', 'url_crawled', {'checked-url': test_url})
+    # A full batch, then the last result once the latency is reached.
+    assert wait_for(lambda: len(filter_mock_requests(
+        test_cb_url, rmock.request_history)) == 2)
+    requests_l = filter_mock_requests(test_cb_url, rmock.request_history)
+    assert [request.json() for request in requests_l] == [
+        {'data': [{'checked-url': test_urls[0]},
+                  {'checked-url': test_urls[1]}]},
+        {'data': [{'checked-url': test_urls[2]}]},
+    ]
+    # Delivered results do not call the webhook anymore.
+    assert wait_for(lambda: not any(
+        storage.get_webhooks_for_url(test_url) for test_url in test_urls))
+
+
+def test_webhook_session(web_container_config, container_factory):
+    web_container_config['WEBHOOK_POOL_MAXSIZE'] = 42
+    container = container_factory(WebhookService, web_container_config)
+    container.start()
+    delivery = get_extension(container, WebhookDelivery)
+    adapter = delivery.session.get_adapter('https://example.org/cb')
+    assert isinstance(adapter, CountingHTTPAdapter)
+    assert adapter._pool_maxsize == 42
@@ -0,0 +1,42 @@
+from unittest.mock import Mock
+
+import eventlet
+
+from croquemort.engines import CrawlerEngine, conditional_headers
+
+
+def test_conditional_headers():
+    assert conditional_headers(None) == {}
+    assert conditional_headers({}) == {}
+    assert conditional_headers({'final-status-code': '404',
+                                'etag': '"abc"'}) == {}
+    assert conditional_headers({'final-status-code': '200', 'etag': '',
+                                'last-modified': ''}) == {}
+    assert conditional_headers({
+        'final-status-code': '200',
+        'etag': '"abc"',
+        'last-modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+    }) == {
+        'If-None-Match': '"abc"',
+        'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+    }
+
+
+def test_fetch_many_errors():
+    engine = CrawlerEngine()
+    engine.container = Mock(config={'CRAWLER_ENGINE': 'green'})
+    engine.setup()
+
+    def fetch(url, previous=None):
+        if url.endswith('/error'):
+            raise RuntimeError('Unexpected')
+        return 'response', 0.1
+
+    engine.fetch = fetch
+    with eventlet.Timeout(5):
+        results = list(engine.fetch_many(['http://example.org/error',
+                                          'http://example.org/ok']))
+    assert sorted(results) == [
+        ('http://example.org/error', None, None),
+        ('http://example.org/ok', 'response', 0.1),
+    ]
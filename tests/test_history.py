@@ -0,0 +1,25 @@
+from croquemort.history import ENTRY, pack_entry, unpack_entries
+
+
+def test_pack_entry():
+    entry = pack_entry(1500000000.5, 200, 0.1234, '227090')
+    assert len(entry) == ENTRY.size
+    history = unpack_entries(entry)
+    assert len(history) == 1
+    assert history[0]['final-status-code'] == 200
+    assert history[0]['latency'] == 123
+    assert history[0]['content-length'] == 227090
+
+
+def test_pack_entry_unknown_values():
+    history = unpack_entries(pack_entry(1500000000, '', None, ''))
+    assert history[0]['final-status-code'] is None
+    assert history[0]['latency'] is None
+    assert history[0]['content-length'] is None
+
+
+def test_unpack_entries_partial():
+    data = pack_entry(1500000000, 404) + pack_entry(1500000060, 200)
+    history = unpack_entries(data[3:])
+    assert len(history) == 1
+    assert history[0]['final-status-code'] == 200
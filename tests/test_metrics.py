@@ -0,0 +1,50 @@
+from croquemort.metrics import Collector, render, series_key
+
+
+def test_series_key():
+    assert series_key('foo_total') == 'foo_total'
+    assert (series_key('foo_total', method='GET', domain='a"b')
+            == 'foo_total{domain="a\\"b",method="GET"}')
+
+
+def test_collector():
+    collector = Collector()
+    collector.inc('croquemort_checks_total', outcome='2xx')
+    collector.inc('croquemort_checks_total', outcome='2xx')
+    collector.observe('croquemort_requests_seconds', 0.3, method='HEAD')
+    collector.observe('croquemort_domain_check_seconds', 0.3, buckets=None,
+                      domain='example.org')
+    pending = collector.pop()
+    assert not collector.pending
+    assert pending['croquemort_checks_total{outcome="2xx"}'] == 2
+    assert pending[
+        'croquemort_requests_seconds_bucket{le="0.25",method="HEAD"}'] == 0
+    assert pending[
+        'croquemort_requests_seconds_bucket{le="0.5",method="HEAD"}'] == 1
+    assert pending[
+        'croquemort_requests_seconds_bucket{le="+Inf",method="HEAD"}'] == 1
+    assert pending['croquemort_requests_seconds_count{method="HEAD"}'] == 1
+    assert not any(key.startswith('croquemort_domain_check_seconds_bucket')
+                   for key in pending)
+    assert pending[
+        'croquemort_domain_check_seconds_sum{domain="example.org"}'] == 0.3
+
+
+def test_render():
+    collector = Collector()
+    collector.inc('croquemort_checks_total', outcome='2xx')
+    collector.observe('croquemort_requests_seconds', 3, method='GET')
+    lines = render({key: str(value) for key, value
+                    in collector.pop().items()}).splitlines()
+    assert lines[0] == '# HELP croquemort_checks_total ' + (
+        'Checks by outcome (status class or error).')
+    assert lines[1] == '# TYPE croquemort_checks_total counter'
+    assert lines[2] == 'croquemort_checks_total{outcome="2xx"} 1'
+    assert lines[4] == '# TYPE croquemort_requests_seconds histogram'
+    buckets = [line for line in lines if '_bucket' in line]
+    # Sorted by upper bound.
+    assert buckets[0].startswith(
+        'croquemort_requests_seconds_bucket{le="0.01",method="GET"}')
+    assert buckets[-1] == (
+        'croquemort_requests_seconds_bucket{le="+Inf",method="GET"} 1')
+    assert 'croquemort_requests_seconds_sum{method="GET"} 3' in lines
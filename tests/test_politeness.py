@@ -0,0 +1,67 @@
+import time
+from collections import namedtuple
+
+from croquemort.politeness import (
+    DomainScheduler, interleave, parse_retry_after
+)
+
+DummyResponse = namedtuple('res', ['status_code', 'headers'])
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('') is None
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('-1') == 0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse_retry_after('not a date') is None
+
+
+def test_interleave():
+    urls = ['http://a.org/1', 'http://a.org/2', 'http://a.org/3',
+            'http://b.org/1', 'http://c.org/1', 'http://c.org/2']
+    assert list(interleave(urls)) == [
+        'http://a.org/1', 'http://b.org/1', 'http://c.org/1',
+        'http://a.org/2', 'http://c.org/2', 'http://a.org/3']
+
+
+def test_scheduler_rate():
+    scheduler = DomainScheduler(rate=20)
+    start = time.time()
+    for _ in range(3):
+        with scheduler.slot('example.org'):
+            pass
+    # Two intervals of 1/20s for the same domain.
+    assert time.time() - start >= 0.1
+    start = time.time()
+    with scheduler.slot('example.com'):
+        pass
+    assert time.time() - start < 0.05
+
+
+def test_scheduler_pruning():
+    scheduler = DomainScheduler(rate=0)
+    for idx in range(100):
+        with scheduler.slot('example{idx}.org'.format(idx=idx)):
+            pass
+    assert not scheduler.semaphores and not scheduler.next_slots
+    # Domains in use are kept.
+    with scheduler.slot('example.org'):
+        with scheduler.slot('example.com'):
+            pass
+        assert 'example.org' in scheduler.semaphores
+    assert not scheduler.semaphores and not scheduler.next_slots
+
+
+def test_scheduler_backoff():
+    scheduler = DomainScheduler(rate=0, max_retry_after=10)
+    assert not scheduler.backoff('example.org', None)
+    assert not scheduler.backoff('example.org', DummyResponse(200, {}))
+    assert not scheduler.backoff('example.org', DummyResponse(429, {}))
+    assert scheduler.backoff('example.org',
+                             DummyResponse(429, {'retry-after': '5'}))
+    assert scheduler.next_slots['example.org'] > time.time() + 4
+    assert not scheduler.backoff('example.com',
+                                 DummyResponse(503, {'retry-after': '3600'}))
+    # The delay is bounded by `max_retry_after`.
+    assert scheduler.next_slots['example.com'] < time.time() + 11
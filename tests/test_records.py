@@ -0,0 +1,46 @@
+from croquemort.records import (
+    both_fields, decode_record, decode_values, encode_record
+)
+
+
+def test_encode_record():
+    mapping, empty = encode_record({
+        'checked-url': 'http://example.org', 'etag': '', 'foo': 'bar',
+    }, compact=True)
+    assert mapping == {'u': 'http://example.org', 'foo': 'bar'}
+    assert empty == ['e']
+    data = {'checked-url': 'http://example.org', 'etag': ''}
+    assert encode_record(data, compact=False) == (data, [])
+
+
+def test_decode_record():
+    record = decode_record({'u': 'http://example.org', 's': '200'},
+                           compact=True, defaults=('etag',))
+    assert record == {'checked-url': 'http://example.org',
+                      'final-status-code': '200', 'etag': ''}
+    # Not checked yet.
+    assert decode_record({'u': 'http://example.org'}, compact=True,
+                         defaults=('etag',)) == {
+        'checked-url': 'http://example.org'}
+    verbose = {'checked-url': 'http://example.org', 'etag': ''}
+    assert decode_record(verbose, compact=False) == verbose
+
+
+def test_decode_record_mixed():
+    data = {'final-status-code': '404', 's': '200', 'group': 'g:1'}
+    assert decode_record(data, compact=True) == {
+        'final-status-code': '200', 'group': 'g:1'}
+    assert decode_record(data, compact=False) == {
+        'final-status-code': '404', 'group': 'g:1'}
+
+
+def test_decode_values():
+    fields = both_fields(('checked-url', 'interval'))
+    assert fields == ['checked-url', 'interval', 'u', 'i']
+    values = ['http://example.org', None, None, '60']
+    assert decode_values(values, compact=True) == ['http://example.org', '60']
+    assert decode_values(values, compact=False) == ['http://example.org',
+                                                    '60']
+    values = ['http://example.org', '3600', None, '60']
+    assert decode_values(values, compact=False)[1] == '3600'
+    assert decode_values(values, compact=True)[1] == '60'
@@ -0,0 +1,46 @@
+import gzip
+
+from croquemort.reports import compute_csv
+
+
+def records(count):
+    for idx in range(count):
+        url = 'http://example{domain}.org/{idx}'.format(domain=idx % 2,
+                                                        idx=idx)
+        yield 'u:{idx}'.format(idx=idx), {
+            'checked-url': url,
+            'final-status-code': '404' if idx % 4 else '200',
+            'content-type': 'text/csv',
+            'updated': '2017-07-10T12:50:20.219819',
+        }
+    yield 'u:unchecked', {'checked-url': 'http://example.org/unchecked'}
+
+
+def test_compute_csv_chunks():
+    response = compute_csv(records(3000), {}, {}, chunk_size=1000)
+    chunks = list(response.response)
+    # Buffered by pages rather than by rows.
+    assert 1 < len(chunks) < 10
+    lines = ''.join(chunks).splitlines()
+    assert lines[0] == 'URL,Status,Content-Type,Updated'
+    assert lines[1] == ('http://example0.org/0,200,text/csv,'
+                        '2017-07-10T12:50:20.219819')
+    assert len(lines) == 3001
+    assert response.headers.get('Content-Encoding') is None
+
+
+def test_compute_csv_filters():
+    response = compute_csv(records(100), {'final-status-code': '200'},
+                           {'domain': 'example1.org'})
+    lines = ''.join(response.response).splitlines()
+    assert len(lines) == 26
+    assert all(',200,' in line for line in lines[1:])
+
+
+def test_compute_csv_gzipped():
+    response = compute_csv(records(3000), {}, {}, gzipped=True)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    content = gzip.decompress(b''.join(response.response)).decode('utf-8')
+    assert content == ''.join(
+        compute_csv(records(3000), {}, {}).response)
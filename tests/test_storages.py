@@ -1,7 +1,19 @@
+from collections import namedtuple
+
+import time
+
+import eventlet
 from nameko.testing.utils import get_extension
 
 from croquemort.http import HttpService
-from croquemort.storages import RedisStorage
+from croquemort.storages import (
+    SCHEDULE, URLS_REGISTRY, WEBHOOK_INFLIGHT, RedisStorage, index_key
+)
+from croquemort.tools import generate_hash_for
+from .utils import RoundTripCounter
+
+DummyResponse = namedtuple('res',
+                           ['url', 'status_code', 'headers', 'history'])
 
 
 def test_frequencies(container_factory, web_container_config):
@@ -16,3 +28,620 @@ def test_frequencies(container_factory, web_container_config):
     assert 'http://example1.com' in urls
     assert 'http://example2.com' in urls
     assert len(urls) == 2
+
+
+def test_frequencies_deduplication(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    for idx in range(5):
+        group = 'group{idx}'.format(idx=idx)
+        storage.store_group('http://example1.com', group)
+        storage.store_frequency('http://example1.com', group, 'daily')
+    storage.store_group('http://example2.com', 'group1')
+    storage.store_group('http://example2.com', 'group5')
+    storage.store_frequency('http://example2.com', 'group5', 'hourly')
+    with RoundTripCounter(storage.database) as counter:
+        urls = list(storage.get_frequency_urls('daily'))
+    assert urls == ['http://example1.com']
+    # One scan and one pipeline per frequency walked.
+    assert counter.count == 4
+    assert list(storage.get_frequency_urls('hourly')) == [
+        'http://example2.com']
+
+
+def test_urls_registry(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    storage.store_url('http://example.com')
+    storage.store_url('http://example.com')
+    storage.store_url('http://example.org')
+    assert storage.database.zcard(URLS_REGISTRY) == 2
+    url_hashes = [url_hash for url_hash, _ in storage.get_all_urls()]
+    assert sorted(url_hashes) == sorted([
+        generate_hash_for('url', 'http://example.com'),
+        generate_hash_for('url', 'http://example.org'),
+    ])
+    url_hash = generate_hash_for('url', 'http://example.com')
+    with RoundTripCounter(storage.database) as counter:
+        storage.delete_url(url_hash)
+    # One to read the record, one to delete it.
+    assert counter.count == 2
+    assert not storage.database.exists(url_hash)
+    assert storage.database.zcard(URLS_REGISTRY) == 1
+
+
+def test_iter_registry(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    # Including members with the same score.
+    storage.database.zadd(URLS_REGISTRY, {
+        'u:{idx:08}'.format(idx=idx): idx // 3 for idx in range(100)})
+    members = []
+    for member in storage.iter_registry(URLS_REGISTRY, page_size=10):
+        members.append(member)
+        if len(members) == 50:
+            storage.database.zadd(URLS_REGISTRY, {'u:new': 1000})
+            storage.database.zrem(URLS_REGISTRY, 'u:00000099')
+    assert len(members) == len(set(members)) == 100
+    assert members[-1] == 'u:new'
+
+
+def test_store_metadata_round_trips(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    headers = {'content-type': 'text/html; charset=utf-8', 'etag': 'abc'}
+    res = DummyResponse('http://example.com/final', 200, headers,
+                        [DummyResponse('http://example.com', 301, None,
+                                       None)])
+    previous = storage.store_url('http://example.com')
+    with RoundTripCounter(storage.database) as counter:
+        stored = storage.store_metadata('http://example.com', res,
+                                        previous=previous)
+    assert counter.count == 1
+    assert stored['checked-url'] == 'http://example.com'
+    assert stored['final-url'] == 'http://example.com/final'
+    assert stored['final-status-code'] == '200'
+    assert stored['content-type'] == 'text/html'
+    assert stored['charset'] == 'utf-8'
+    assert stored['etag'] == 'abc'
+    assert stored['content-length'] == ''
+    assert stored['redirect-status-code'] == '301'
+
+
+def test_get_urls_pipelined(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(5)]
+    for url in urls:
+        storage.store_url(url)
+    url_hashes = [generate_hash_for('url', url) for url in urls]
+    with RoundTripCounter(storage.database) as counter:
+        results = list(storage.get_urls(url_hashes, page_size=2))
+    assert counter.count == 3
+    assert [url_hash for url_hash, _ in results] == url_hashes
+    assert [data['checked-url'] for _, data in results] == urls
+
+
+def test_scan_group(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(300)]
+    for url in urls:
+        storage.store_url(url)
+        storage.store_group(url, 'group1')
+    group_hash = generate_hash_for('group', 'group1')
+    url_hashes, cursor = [], 0
+    while True:
+        cursor, page = storage.scan_group(group_hash, cursor, 50)
+        url_hashes.extend(page)
+        if not cursor:
+            break
+    assert sorted(set(url_hashes)) == sorted(
+        generate_hash_for('url', url) for url in urls)
+    url_hashes, cursor = [], 0
+    while True:
+        cursor, page = storage.scan_registry(URLS_REGISTRY, cursor, 50)
+        url_hashes.extend(page)
+        if not cursor:
+            break
+    assert len(set(url_hashes)) == 300
+
+
+def test_group_versions(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/test_group_versions'
+    group_hash = generate_hash_for('group', 'group1')
+    assert storage.get_group_version(group_hash) == 0
+    storage.store_group(url, 'group1')
+    version = storage.get_group_version(group_hash)
+    assert version
+    response = DummyResponse(url, 200, {'etag': '"abc"'}, [])
+    storage.store_metadata(url, response, previous=storage.store_url(url))
+    assert storage.get_group_version(group_hash) > version
+    version = storage.get_group_version(group_hash)
+    storage.store_metadata(url, DummyResponse(url, 304, {}, []),
+                           previous=storage.store_url(url))
+    assert storage.get_group_version(group_hash) > version
+    version = storage.get_group_version(group_hash)
+    storage.delete_url(generate_hash_for('url', url))
+    assert storage.get_group_version(group_hash) > version
+
+
+def test_stats(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(3)]
+    for url in urls:
+        storage.store_group(url, 'group1')
+        storage.store_metadata(url, DummyResponse(url, 200, {
+            'content-type': 'text/csv'}, []), previous=storage.store_url(url))
+    group_hash = generate_hash_for('group', 'group1')
+    assert storage.get_stats('group', group_hash) == {
+        'final-status-code': {'200': 3}, 'content-type': {'text/csv': 3}}
+    # Transitions move the counts.
+    storage.store_metadata(urls[0], DummyResponse(urls[0], 404, {}, []),
+                           previous=storage.store_url(urls[0]))
+    storage.store_metadata(urls[1], DummyResponse(urls[1], 304, {}, []),
+                           previous=storage.store_url(urls[1]))
+    # Moved atomically, within a single round trip.
+    with RoundTripCounter(storage.database) as counter:
+        storage.store_group(urls[2], 'group2')
+    assert counter.count == 1
+    storage.store_group(urls[2], 'group2')
+    assert storage.get_stats('group', group_hash) == {
+        'final-status-code': {'200': 1, '404': 1},
+        'content-type': {'text/csv': 2}}
+    assert storage.get_stats('group', generate_hash_for('group', 'group2')) \
+        == {'final-status-code': {'200': 1}, 'content-type': {'text/csv': 1}}
+    storage.delete_url(generate_hash_for('url', urls[0]))
+    assert storage.get_stats() == storage.get_stats('domain', 'example.com') \
+        == {'final-status-code': {'200': 2}, 'content-type': {'text/csv': 2}}
+
+
+def test_compact_records(container_factory, web_container_config):
+    web_container_config['COMPACT_RECORDS'] = True
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/test_compact_records'
+    url_hash = generate_hash_for('url', url)
+    storage.store_group(url, 'group1')
+    stored = storage.store_metadata(url, DummyResponse(url, 200, {
+        'content-type': 'text/csv'}, []), previous=storage.store_url(url))
+    assert stored == storage.get_url(url_hash)
+    assert stored['checked-url'] == url
+    assert stored['final-status-code'] == '200'
+    assert stored['content-type'] == 'text/csv'
+    assert stored['etag'] == ''
+    raw = storage.database.hgetall(url_hash)
+    assert raw['u'] == url
+    assert raw['t'] == 'text/csv'
+    assert 'e' not in raw and 'checked-url' not in raw
+    # Verbose records are read too, e.g. prior to the migration.
+    storage.database.hset(url_hash, 'etag', '"abc"')
+    assert storage.get_url(url_hash)['etag'] == '"abc"'
+
+
+def test_indexes(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url, other_url = 'http://example.com/index', 'http://example.org/index'
+    url_hash = generate_hash_for('url', url)
+    other_url_hash = generate_hash_for('url', other_url)
+    headers = {'content-type': 'text/csv'}
+    storage.store_metadata(url, DummyResponse(url, 404, headers, []),
+                           previous=storage.store_url(url))
+    storage.store_metadata(other_url, DummyResponse(url, 404, {}, []),
+                           previous=storage.store_url(other_url))
+    assert storage.database.smembers(
+        index_key('final-status-code', '404')) == {url_hash, other_url_hash}
+    assert storage.database.smembers(
+        index_key('domain', 'example.com')) == {url_hash}
+    # Status transition.
+    storage.store_metadata(url, DummyResponse(url, 200, headers, []),
+                           previous=storage.store_url(url))
+    assert storage.database.smembers(
+        index_key('final-status-code', '404')) == {other_url_hash}
+    selection, filters, excludes = storage.resolve_filters(
+        {'final-status-code': '200', 'content-type': 'text/csv', 'foo': ''},
+        {'domain': 'example.org'})
+    assert selection.candidates == {url_hash}
+    assert selection.excluded == {other_url_hash}
+    assert filters == {'foo': ''}
+    assert excludes == {}
+    assert list(selection.apply([url_hash, other_url_hash])) == [url_hash]
+    storage.delete_url(url_hash)
+    assert not storage.database.sismember(
+        index_key('final-status-code', '200'), url_hash)
+
+
+def test_overlapping_checks(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/overlapping'
+    url_hash = generate_hash_for('url', url)
+    storage.store_group(url, 'group1')
+    storage.store_metadata(url, DummyResponse(url, 200, {
+        'content-type': 'text/csv'}, []), previous=storage.store_url(url))
+    # Both checks read the same previous record.
+    previous = storage.store_url(url)
+    storage.store_metadata(url, DummyResponse(url, 404, {}, []),
+                           previous=previous)
+    storage.store_metadata(url, DummyResponse(url, 500, {
+        'content-type': 'text/html'}, []), previous=previous)
+    for status in ('200', '404', '500'):
+        assert storage.database.sismember(
+            index_key('final-status-code', status), url_hash) == (
+            status == '500')
+    for content_type in ('text/csv', 'text/html'):
+        assert storage.database.sismember(
+            index_key('content-type', content_type), url_hash) == (
+            content_type == 'text/html')
+    assert storage.get_stats() \
+        == storage.get_stats('group', generate_hash_for('group', 'group1')) \
+        == {'final-status-code': {'500': 1}, 'content-type': {'text/html': 1}}
+
+
+def test_acquire_check_flags(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(3)]
+    assert storage.is_currently_checked(urls[0]) is False
+    with RoundTripCounter(storage.database) as counter:
+        assert storage.acquire_check_flags(urls) == urls[1:]
+    assert counter.count == 1
+    assert storage.acquire_check_flags(urls) == []
+    storage.remove_check_flag(urls[2])
+    assert storage.acquire_check_flags(urls) == urls[2:]
+
+
+def test_store_webhooks(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(3)]
+    storage.store_webhook(urls[0], 'http://example.org/cb')
+    with RoundTripCounter(storage.database) as counter:
+        storage.store_webhooks(urls, 'http://example.org/cb')
+    assert counter.count == 1
+    for url in urls:
+        assert storage.get_webhooks_for_url(url) == ['http://example.org/cb']
+
+
+def test_report(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(3)]
+    url_hashes = [generate_hash_for('url', url) for url in urls]
+    for url in urls[:2]:
+        storage.store_metadata(url, DummyResponse(url, 200, {
+            'content-type': 'text/csv; charset=utf-8', 'etag': '"abc"'},
+            []), previous=storage.store_url(url))
+    storage.store_url(urls[2])
+    rows = sorted(storage.iter_report())
+    assert len(rows) == 2
+    # In the order of the registry, whatever the size of the pages.
+    assert list(storage.iter_report(page_size=1)) == rows
+    assert rows[0].startswith('http://example.com/0,200,text/csv,')
+    # Unchecked URLs have no line.
+    assert list(storage.get_report_rows(url_hashes[1:])) == rows[1:]
+    updated = storage.get_url(url_hashes[0])['updated']
+    previous = storage.store_url(urls[0])
+    with RoundTripCounter(storage.database) as counter:
+        storage.store_metadata(urls[0], DummyResponse(urls[0], 304, {}, []),
+                               previous=previous)
+    assert counter.count == 1
+    row, = storage.get_report_rows(url_hashes[:1])
+    assert row.startswith('http://example.com/0,200,text/csv,')
+    assert updated not in row
+    storage.delete_url(url_hashes[0])
+    assert list(storage.iter_report()) == rows[1:]
+    # Checks without headers keep the stored content type.
+    storage.store_metadata(urls[1], DummyResponse(urls[1], 503, {}, []),
+                           previous=storage.store_url(urls[1]))
+    row, = storage.get_report_rows(url_hashes[1:2])
+    assert row.startswith('http://example.com/1,503,text/csv,')
+    assert storage.get_url(url_hashes[1])['content-type'] == 'text/csv'
+
+
+def test_snapshot(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    assert storage.get_snapshot('s:snapshot') == (None, None)
+    timestamp = time.time()
+    chunks = ['chunk{idx}\r\n'.format(idx=idx) for idx in range(5)]
+    for chunk in chunks:
+        storage.append_snapshot('s:snapshot', timestamp, chunk, 60)
+    # Not served until fully built.
+    assert storage.get_snapshot('s:snapshot') == (None, None)
+    storage.publish_snapshot('s:snapshot', timestamp, 60)
+    with RoundTripCounter(storage.database) as counter:
+        built, stored = storage.get_snapshot('s:snapshot', page_size=2)
+        assert list(stored) == chunks
+    assert counter.count == 4
+    assert built == timestamp
+    assert 60 < storage.database.ttl(
+        '{key}-{timestamp}'.format(key='s:snapshot', timestamp=timestamp)
+    ) <= 120
+
+
+def test_webhooks_queue(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    storage.enqueue_webhooks(
+        ['http://example.org/cb', 'http://example.com/cb'],
+        {'checked-url': 'http://example.com'})
+    with RoundTripCounter(storage.database) as counter:
+        jobs = storage.pop_due_webhooks(limit=10, lease=60)
+    assert counter.count == 2
+    assert sorted(job['url'] for _, job in jobs) == [
+        'http://example.com/cb', 'http://example.org/cb']
+    assert jobs[0][1]['data'] == {'checked-url': 'http://example.com'}
+    assert jobs[0][1]['attempts'] == 0
+    # Claimed deliveries are not due anymore.
+    assert storage.pop_due_webhooks(limit=10, lease=60) == []
+    (done_id, _), (failed_id, failed) = jobs
+    storage.complete_webhooks([done_id])
+    failed['attempts'] = 1
+    storage.reschedule_webhooks({failed_id: (failed, time.time() - 1)})
+    assert storage.pop_due_webhooks(limit=10, lease=60) == [
+        (failed_id, failed)]
+    # An expired lease queues the delivery again.
+    storage.database.zadd(WEBHOOK_INFLIGHT, {failed_id: time.time() - 1})
+    assert storage.requeue_expired_webhooks() == [failed_id]
+    assert storage.pop_due_webhooks(limit=10, lease=60) == [
+        (failed_id, failed)]
+    storage.dead_letter_webhooks([(failed_id, dict(failed, error='404'))],
+                                 size=10)
+    assert storage.requeue_expired_webhooks() == []
+    dead_letters = storage.get_dead_letters()
+    assert len(dead_letters) == 1
+    assert dead_letters[0]['id'] == failed_id
+    assert dead_letters[0]['error'] == '404'
+    assert storage.replay_dead_letters() == 1
+    assert storage.get_dead_letters() == []
+    assert storage.pop_due_webhooks(limit=10, lease=60) == [
+        (failed_id, dict(failed, attempts=0))]
+
+
+def test_webhooks_buffers(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    cb_url = 'http://example.org/cb'
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(3)]
+    storage.store_webhooks(urls, cb_url)
+    assert storage.buffer_webhooks([cb_url], {'checked-url': urls[0]},
+                                   size=2) == []
+    assert storage.get_expired_webhook_buffers(latency=0) == [cb_url]
+    assert storage.get_expired_webhook_buffers(latency=60) == []
+    for url in urls[1:]:
+        assert storage.buffer_webhooks([cb_url], {'checked-url': url},
+                                       size=2) == [cb_url]
+    assert storage.flush_webhook_buffer(cb_url, size=2) == 1
+    (_, job), = storage.pop_due_webhooks(limit=10, lease=60)
+    assert job == {'url': cb_url, 'attempts': 0, 'batch': True, 'data': [
+        {'checked-url': urls[0]}, {'checked-url': urls[1]}]}
+    assert storage.get_expired_webhook_buffers(latency=0) == [cb_url]
+    assert storage.flush_webhook_buffer(cb_url, size=2) == 0
+    (_, job), = storage.pop_due_webhooks(limit=10, lease=60)
+    assert job['data'] == [{'checked-url': urls[2]}]
+    assert storage.get_expired_webhook_buffers(latency=0) == []
+    storage.remove_webhooks(urls[:2], cb_url)
+    assert [storage.get_webhooks_for_url(url) for url in urls] == [
+        [], [], [cb_url]]
+
+
+def test_webhooks_circuits(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    endpoints = ['example.org', 'example.com']
+    assert storage.record_webhook_failures(
+        {'example.org': 2, 'example.com': 1}, threshold=3, cooldown=60) == []
+    assert storage.get_open_circuits(endpoints) == {}
+    assert storage.record_webhook_failures(
+        {'example.org': 1}, threshold=3, cooldown=60) == ['example.org']
+    circuits = storage.get_open_circuits(endpoints)
+    assert list(circuits) == ['example.org']
+    assert 59 < circuits['example.org'] <= 60
+    # A success resets the count of consecutive failures.
+    storage.complete_webhooks([], endpoints=['example.com'])
+    assert storage.record_webhook_failures(
+        {'example.com': 2}, threshold=3, cooldown=60) == []
+
+
+def test_check_flag_lease(container_factory, web_container_config):
+    web_container_config['CHECK_LEASE_DURATION'] = 30
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/test_check_flag_lease'
+    with RoundTripCounter(storage.database) as counter:
+        assert storage.is_currently_checked(url) is False
+        storage.remove_check_flag(url)
+    assert counter.count == 2
+    assert storage.is_currently_checked(url) is False
+    assert 0 < storage.database.ttl(generate_hash_for('check', url)) <= 30
+
+
+def test_check_flag_contention(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(10)]
+    pool = eventlet.GreenPool(100)
+    # 10 concurrent fetches per URL, only one of them should crawl it.
+    crawls = list(pool.imap(lambda url: not storage.is_currently_checked(url),
+                            urls * 10))
+    assert crawls.count(True) == len(urls)
+    for url in urls:
+        assert sum(crawled for checked, crawled in zip(urls * 10, crawls)
+                   if checked == url) == 1
+
+
+def test_store_not_modified(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/test_store_not_modified'
+    headers = {'etag': '"abc"', 'content-type': 'text/csv'}
+    first = storage.store_metadata(url, DummyResponse(url, 200, headers, []),
+                                   previous=storage.store_url(url))
+    stored = storage.store_metadata(url, DummyResponse(url, 304, {}, []),
+                                    previous=storage.store_url(url))
+    assert stored['final-status-code'] == '200'
+    assert stored['etag'] == '"abc"'
+    assert stored['content-type'] == 'text/csv'
+    assert stored['updated'] > first['updated']
+
+
+def test_rolling_schedule(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    urls = ['http://example.com/{idx}'.format(idx=idx) for idx in range(10)]
+    for url in urls:
+        storage.store_url(url)
+        storage.store_group(url, 'group1')
+        storage.store_frequency(url, 'group1', 'hourly')
+    # Due dates are spread over the next hour.
+    scores = [score for _, score in
+              storage.database.zrange(SCHEDULE, 0, -1, withscores=True)]
+    assert len(scores) == len(urls)
+    assert max(scores) - time.time() <= 60 * 60
+    assert storage.pop_due_urls(limit=10) == []
+    # Make them all due, late by less than an interval.
+    storage.database.zadd(SCHEDULE, {generate_hash_for('url', url): 1000
+                                     for url in urls}, xx=True)
+    storage.database.zadd(SCHEDULE, {generate_hash_for('url', urls[0]):
+                                     time.time() - 10}, xx=True)
+    with RoundTripCounter(storage.database) as counter:
+        due = storage.pop_due_urls(limit=4)
+    assert counter.count == 3
+    assert len(due) == 4
+    due += storage.pop_due_urls(limit=10)
+    assert sorted(due) == sorted(urls)
+    assert storage.pop_due_urls(limit=10) == []
+    assert min(score for _, score in storage.database.zrange(
+        SCHEDULE, 0, -1, withscores=True)) > time.time()
+    # Popped URLs are claimed from overlapping calls.
+    storage.database.zadd(SCHEDULE, {generate_hash_for('url', url): 1000
+                                     for url in urls}, xx=True)
+    overlapping = []
+
+    def adapt(interval, stable_checks, flaps):
+        overlapping.extend(storage.pop_due_urls(limit=10))
+        return interval
+
+    assert sorted(storage.pop_due_urls(limit=10, adapt=adapt)) == sorted(urls)
+    assert overlapping == []
+
+
+def test_schedule_frequencies(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    for idx, frequencies in enumerate((('daily', 'hourly'),
+                                       ('hourly', 'daily'))):
+        url = 'http://example.com/{idx}'.format(idx=idx)
+        url_hash = generate_hash_for('url', url)
+        for group, frequency in zip(('group1', 'group2'), frequencies):
+            storage.store_group(url, group)
+            storage.store_frequency(url, group, frequency)
+        assert storage.get_url(url_hash)['interval'] == str(60 * 60)
+        assert storage.database.zscore(SCHEDULE, url_hash) \
+            <= time.time() + 60 * 60
+
+
+def test_change_counters(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/test_change_counters'
+
+    def check(status_code, headers):
+        return storage.store_metadata(
+            url, DummyResponse(url, status_code, headers, []),
+            previous=storage.store_url(url))
+
+    stored = check(200, {'etag': '"abc"'})
+    assert (stored['stable-checks'], stored['flaps']) == ('0', '0')
+    check(200, {'etag': '"abc"'})
+    stored = check(304, {})
+    assert (stored['stable-checks'], stored['flaps']) == ('2', '0')
+    stored = check(200, {'etag': '"def"'})
+    assert (stored['stable-checks'], stored['flaps']) == ('0', '0')
+    check(404, {})
+    stored = check(200, {'etag': '"def"'})
+    assert (stored['stable-checks'], stored['flaps']) == ('0', '2')
+
+
+def test_adaptive_schedule(container_factory, web_container_config):
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/test_adaptive_schedule'
+    url_hash = generate_hash_for('url', url)
+    storage.store_url(url)
+    storage.schedule_url(url, 60)
+    storage.database.hset(url_hash, mapping={'stable-checks': 3, 'flaps': 0})
+    storage.database.zadd(SCHEDULE, {url_hash: time.time() - 1}, xx=True)
+    calls = []
+
+    def adapt(interval, stable_checks, flaps):
+        calls.append((interval, stable_checks, flaps))
+        return 3600
+
+    assert storage.pop_due_urls(limit=10, adapt=adapt) == [url]
+    assert calls == [(60, 3, 0)]
+    assert storage.database.zscore(SCHEDULE, url_hash) > time.time() + 3000
+
+
+def test_history(container_factory, web_container_config):
+    web_container_config['CHECK_HISTORY_SIZE'] = 3
+    test_container = container_factory(HttpService, web_container_config)
+    test_container.start()
+    storage = get_extension(test_container, RedisStorage)
+    url = 'http://example.com/test_history'
+    url_hash = generate_hash_for('url', url)
+    storage.store_metadata(url, DummyResponse(url, 200, {
+        'content-length': '42'}, []), previous=storage.store_url(url),
+        latency=0.2)
+    previous = storage.store_url(url)
+    with RoundTripCounter(storage.database) as counter:
+        storage.store_metadata(url, DummyResponse(url, 304, {}, []),
+                               previous=previous)
+    assert counter.count == 1
+    history = storage.get_history(url_hash)
+    assert [(check['final-status-code'], check['latency'],
+             check['content-length']) for check in history] == [
+        (200, 200, 42), (200, None, 42)]
+    for _ in range(3):
+        storage.store_metadata(url, DummyResponse(url, 404, {}, []),
+                               previous=storage.store_url(url))
+    previous = storage.store_url(url)
+    with RoundTripCounter(storage.database) as counter:
+        storage.store_metadata(url, DummyResponse(url, 404, {}, []),
+                               previous=previous)
+    assert counter.count == 1
+    history = storage.get_history(url_hash)
+    assert [check['final-status-code'] for check in history] == [404] * 3
+    # Trimmed to the latest entries once twice as long as the limit.
+    assert storage.database.strlen(url_hash + '-history') == 3 * 18
+    assert storage.database.ttl(url_hash + '-history') > 0
@@ -1,8 +1,11 @@
 from unittest.mock import MagicMock
 
+import pytest
+
 from croquemort.tools import (
-    apply_filters, data_from_request, extract_filters, _generate_hash,
-    generate_hash_for
+    apply_filters, data_from_request, extract_filters, extract_pagination,
+    _generate_hash,
+    generate_hash_for, parse_content_type
 )
 
 
@@ -35,6 +38,17 @@ def test_extract_filters():
     assert extract_filters({'exclude_foo': ''}) == ({}, {'foo': ''})
 
 
+def test_extract_pagination():
+    assert extract_pagination({}) == (None, None)
+    assert extract_pagination({'cursor': '12'}) == (None, None)
+    assert extract_pagination({'limit': '10'}) == (10, 0)
+    assert extract_pagination({'limit': 10, 'cursor': '12'}) == (10, 12)
+    for invalid in ({'limit': 'foo'}, {'limit': '0'},
+                    {'limit': '10', 'cursor': 'bar'}):
+        with pytest.raises(ValueError):
+            extract_pagination(invalid)
+
+
 def test_apply_filters():
     assert apply_filters({}, {}, {}) == {}
     assert apply_filters({'foo': 'bar'}, {}, {}) == {'foo': 'bar'}
@@ -125,3 +139,11 @@ def test_apply_filters_with_domains():
         input,
         {'status': '200'},
         {'domain': 'example.com', 'content-type': 'application/csv'}) == input
+
+
+def test_parse_content_type():
+    assert parse_content_type('text/html; charset=UTF-8') == {
+        'content-type': 'text/html', 'charset': 'utf-8'}
+    assert parse_content_type('Text/CSV;') == {'content-type': 'text/csv'}
+    assert parse_content_type('text/html;h5ai=0.20;charset=UTF-8') == {
+        'content-type': 'text/html', 'charset': 'utf-8'}
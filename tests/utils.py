@@ -1,4 +1,59 @@
+import eventlet
 
 
 def filter_mock_requests(url, requests_l):
     return [r for r in requests_l if url in r.url]
+
+
+def wait_for(predicate, timeout=5):
+    """Wait (cooperatively) until `predicate()` holds, up to `timeout`."""
+    for _ in range(int(timeout * 10)):
+        if predicate():
+            return True
+        eventlet.sleep(.1)
+    return predicate()
+
+
+def get_urls_from(get_url):
+    """Build a mock for `RedisStorage.get_urls` relying on `get_url`."""
+    def get_urls(url_hashes, *args, **kwargs):
+        return ((url_hash, get_url(url_hash)) for url_hash in url_hashes)
+    return get_urls
+
+
+class RoundTripCounter(object):
+    """Count the network round trips issued against a Redis client.
+
+    Each plain command counts as one round trip, as does each
+    pipeline execution whatever the number of queued commands.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+
+    def __enter__(self):
+        execute_command = self.database.execute_command
+        pipeline = self.database.pipeline
+
+        def counted_command(*args, **kwargs):
+            self.count += 1
+            return execute_command(*args, **kwargs)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def counted_execute(*args, **kwargs):
+                self.count += 1
+                return execute(*args, **kwargs)
+            pipe.execute = counted_execute
+            return pipe
+
+        self.database.execute_command = counted_command
+        self.database.pipeline = counted_pipeline
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.database.execute_command
+        del self.database.pipeline